@@ -3,12 +3,19 @@
 
 from numpy import log2
 from copy import deepcopy
+from collections import deque
 
 from utils import *
 from . import bot_utils
 from .dialog_management_components import *
 from . import config as cfg
 from . import entity_checker
+from . import streaming
+from .nlu_message import NLUMessage, to_nlu_message
+from .dialog_policy import get_default_policy
+from .context_serialization import serialize_context, deserialize_contexts
+from .tenant_config import get_tenants_registry
+from .trace_log import TurnTrace, RESTART_BRANCH, get_context_state
 
 from .actions.ActionFactory import ActionFactory
 from .actions import confirmation_requests as confirm
@@ -24,7 +31,12 @@ class DialogManager(object):
     """
     Given the intents and (correct) entities found in the user's messages,
     decides what to do/answer. This is a goal-based dialog manager.
-    Relies on a configuration of goals and on a stack of conversation contexts.
+    Relies on a configuration of goals and on a stack of conversation contexts:
+    when the user switches to another goal before the current one is met, the
+    current context is pushed on a persistent stack (cf. `ContextStack`) and
+    it is resumed (with its slots) once the new goal is met.
+    The changes made during the last turns are journaled so that a turn can be
+    rolled back (cf. `rollback_turn`) without copying the contexts.
     """
     # Thresholds on the confidence values:
     # Any intent/entity with confidence < hard threshold is considered as not understood;
@@ -37,201 +49,250 @@ class DialogManager(object):
 
     RESET_MSG = "restart"
 
-    def __init__(self):
+    def __init__(self, tenant_id=None):
+        """
+        `tenant_id` is the ID of the client the conversation is held with
+        (cf. `tenant_config.py`), `None` to use the default configuration.
+        """
+        # (str) -> ()
+        self.tenant_config = get_tenants_registry().get(tenant_id)
         self.goals_by_trigger = {goal.triggering_intent: goal
                                  for goal in make_goals_list()}  # should always be deepcopied into a new context (never used as is)
 
-        self.context = Context(self.goals_by_trigger["_init"])
-        self.intents_descriptions = cfg.get_intents_descriptions()
-        self.slots_descriptions = cfg.get_slots_descriptions()
-
-        self.action_factory = ActionFactory(cfg.get_utterances_templates())
-
+        self.intents_descriptions = self.tenant_config.intents_descriptions
+        self.slots_descriptions = self.tenant_config.slots_descriptions
+        self._undo_log = None  # the journal of the current turn
+        self._context = None
+        self.context = Context(self.goals_by_trigger["_init"],
+                               self.slots_descriptions)
+        self.interrupted_contexts = None  # ContextStack
+        self._turns_journal = deque(maxlen=cfg.MAX_UNDOABLE_TURNS)
+
+        self.action_factory = \
+            ActionFactory(self.tenant_config.utterances_templates,
+                          self.slots_descriptions)
+        self.policy = get_default_policy()  # can be replaced to try another policy
+
+        # The turns are recorded in the trace log if there is one (cf. `trace_log.py`)
+        self.trace_log = None  # TraceLogWriter
+        self.conversation_id = None  # recorded in the traces
+        self._initial_context_traced = False
+
+
+    @property
+    def context(self):
+        return self._context
+    @context.setter
+    def context(self, context):
+        # (Context) -> ()
+        if self._context is not None:
+            self._context.stop_journaling()
+        self._context = context
+        if self._undo_log is not None:
+            context.start_journaling(self._undo_log)
 
     def reset(self):
         """Reset `self` to its initial state."""
-        self.context = Context(self.goals_by_trigger["_init"])
+        self.context = Context(self.goals_by_trigger["_init"],
+                               self.slots_descriptions)
+        self.interrupted_contexts = None
+
+    def get_serialized_context(self):
+        """
+        Returns the context of the conversation (with the interrupted ones)
+        serialized as bytes (cf. `context_serialization.py`).
+        """
+        # () -> (bytes)
+        return serialize_context(self.context, self.interrupted_contexts)
+    def set_serialized_context(self, data):
+        """
+        Restores the context of the conversation (with the interrupted ones)
+        serialized in `data`. The previous turns can't be rolled back anymore.
+        """
+        # (bytes) -> ()
+        (context, self.interrupted_contexts) = \
+            deserialize_contexts(data, self.slots_descriptions)
+        self._turns_journal.clear()
+        self.context = context
+        self._initial_context_traced = False
+
+    #=========== Goals switching ============
+    def switch_goal(self, goal):
+        """
+        Makes `goal` the current goal in a new context. If the current goal
+        is not met, its context is pushed on the stack of interrupted contexts
+        (unless there are already `cfg.MAX_INTERRUPTED_GOALS` of them) to be
+        resumed once `goal` is met (without the potential new goal and the
+        entity pending for confirmation, which were answered).
+        """
+        # (Goal) -> ()
+        context = self.context
+        if (    context.current_goal != goal
+            and not context.is_current_goal_met()
+            and get_stack_depth(self.interrupted_contexts)
+                < cfg.MAX_INTERRUPTED_GOALS):
+            printDBG("Interrupting goal "+context.current_goal.name)
+            context.discard_potential_new_goal()
+            context.discard_pending_entity()
+            self.interrupted_contexts = \
+                ContextStack(context, self.interrupted_contexts)
+        self.context = Context(goal, self.slots_descriptions)
+
+    def resume_interrupted_goal(self):
+        """
+        Pops the last interrupted context and returns the actions to take
+        to pursue its goal (cf. `pursue_goal`).
+        """
+        # () -> ([Action])
+        if self.interrupted_contexts is None:
+            raise RuntimeError("Tried to resume an interrupted goal while "+
+                               "no goal was interrupted.")
+        self.context = self.interrupted_contexts.context
+        self.interrupted_contexts = self.interrupted_contexts.below
+        printDBG("Resuming goal "+self.context.current_goal.name)
+        return self.pursue_goal()
+
+    #=========== Turns journal ============
+    def _begin_turn(self):
+        self._undo_log = []
+        self._turns_journal.append((self._context, self.interrupted_contexts,
+                                    self._undo_log,
+                                    self._context.potential_new_goal))
+        self._context.start_journaling(self._undo_log)
+    def _end_turn(self):
+        self._context.stop_journaling()
+        self._undo_log = None
+
+    def _rollback_turn(self):
+        (context, interrupted_contexts, undo_log, _) = self._turns_journal.pop()
+        self._context.stop_journaling()
+        undo_changes(undo_log)
+        self._context = context
+        self.interrupted_contexts = interrupted_contexts
+
+    def rollback_turn(self):
+        """
+        Puts `self` back in the state it was in before the last turn
+        (i.e. the last call to `manage_user_msg`). Returns `False` if there
+        is no turn to roll back (cf. `cfg.MAX_UNDOABLE_TURNS`).
+        """
+        # () -> (bool)
+        if self._undo_log is not None:
+            raise RuntimeError("Tried to roll back a turn while handling one.")
+        if len(self._turns_journal) == 0:
+            return False
+        self._rollback_turn()
+        return True
+
+    def rollback_potential_new_goal(self):
+        """
+        While handling a message that denies the potential new goal, undoes
+        what was done for this message until now and rolls back the previous
+        turn if it is the one in which the potential new goal was understood.
+        Returns `False` (and does nothing) otherwise.
+        """
+        # () -> (bool)
+        if self._undo_log is None or len(self._turns_journal) < 2:
+            return False
+        previous_potential_new_goal = self._turns_journal[-2][3]
+        current_potential_new_goal = self._turns_journal[-1][3]
+        if (   previous_potential_new_goal is not None
+            or current_potential_new_goal is None):
+            return False
+        self._rollback_turn()
+        self._rollback_turn()
+        self._begin_turn()
+        return True
 
 
     def manage_user_msg(self, intent_and_entities):
         """
         Called when a new user message is issued, handles the message
-        (represented as a dict with an intent and one or several optional
-        entities) and returns the action/utterance to do.
+        (an `NLUMessage` or the dict given by the NLU, with an intent and one
+        or several optional entities) and returns the action/utterance to do.
         Takes into account the current context and the confidences values to
         make a decision.
         """
-        # (...) -> ([Action])
+        # (NLUMessage or {str: anything}) -> ([Action])
+        message = to_nlu_message(intent_and_entities)
+        trace = None
+        if self.trace_log is not None:
+            trace = self._start_trace(message)
+        self._begin_turn()
+        try:
+            actions = self._handle_user_msg(message, trace)
+        finally:
+            self._end_turn()
+        if trace is not None:
+            trace.action_names = [action.name for action in actions]
+            trace.context_after = get_context_state(self)
+            trace.end()
+            self.trace_log.record(trace)
+        return actions
+
+    def _handle_user_msg(self, message, trace=None):
+        # (NLUMessage, TurnTrace) -> ([Action])
         # Manage restarting of the bot by the user
-        if intent_and_entities["text"] == DialogManager.RESET_MSG:
+        if message.text == DialogManager.RESET_MSG:
             self.reset()
+            if trace is not None:
+                trace.branch = RESTART_BRANCH
             return self.pursue_goal()
 
         # Correct correctable entities and ditch others
-        intent_and_entities["entities"] = \
-            entity_checker.check_entities_val(intent_and_entities["entities"])
+        message.entities = \
+            entity_checker.check_entities_val(message.entities,
+                                              self.slots_descriptions,
+                                              self.tenant_config.slots_synonyms)
+        if trace is not None:
+            trace.corrected_entities = message.entities
+            trace.end_stage("entities-checking")
 
         # Build actions
-        actions = self.formulate_answer(intent_and_entities)
+        actions = self.formulate_answer(message, trace)
+        if trace is not None:
+            trace.end_stage("decision")
         actions =  self.filter_repeated_confirmation_and_rephrase(actions)
         self.context.update_from(actions)
+        if trace is not None:
+            trace.end_stage("context-update")
         return actions
 
-    def formulate_answer(self, intent_and_entities):
+    def _start_trace(self, message):
+        # The message of the NLU is copied as its entities are replaced
+        trace = TurnTrace(self.conversation_id,
+                          NLUMessage(message.intent, message.entities,
+                                     message.intent_ranking, message.text),
+                          tenant_id=self.tenant_config.tenant_id)
+        trace.context_before = get_context_state(self)
+        if not self._initial_context_traced:
+            trace.initial_context = self.get_serialized_context()
+            self._initial_context_traced = True
+        return trace
+
+    def stream_user_msg(self, intent_and_entities):
+        """
+        Same as `manage_user_msg` but runs the actions to do and yields
+        the events (typing indicators and messages) they produce as soon as
+        each of them finishes (cf. `streaming.py`).
+        The message is handled (and the context updated) when this is called,
+        the actions are run while the returned generator is consumed.
+        """
+        # (NLUMessage or {str: anything}) -> (generator of {str: str})
+        actions = self.manage_user_msg(intent_and_entities)
+        return streaming.stream_actions(actions)
+
+    def formulate_answer(self, message, trace=None):
         """
         Using the context and what's been understood from the last user message,
         tries to formulate an answer (may that be asking a rephrase, a
         confirmation request about what was unclear, asking for additionnal info
         or answering a question) and returns this list of actions.
+        The decision is made by the policy of `self` (cf. `dialog_policy.py`)
+        and recorded in `trace` if it is given.
         """
-        # (...) -> ([Action])
-        understood_intent = intent_and_entities["intent"]
-        cumulative_intent_confidence = \
-            self.compute_final_confidence(intent_and_entities,
-                                          understood_intent["name"])
-        printDBG("confidence: "+str(understood_intent["confidence"])+" -> "+
-                 str(cumulative_intent_confidence))
-        # User message was expected
-        if self.context.is_expecting(understood_intent["name"]):
-            print("expected")
-            # Confident in your understanding
-            if cumulative_intent_confidence > DialogManager.EXPECTED_SOFT_THRESHOLD:
-                print("confident: "+understood_intent["name"])
-                if bot_utils.is_triggering(understood_intent["name"]):
-                    # Change goal and formulate answer
-                    next_goal = self.goals_by_trigger[understood_intent["name"]]
-                    print("New goal: "+str(next_goal))
-                    print("GOAL'S MANDATORY SLOTS: "+str(next_goal.mandatory_slots))
-                    # change the context (forget the current slot values)
-                    self.context = Context(next_goal)
-                elif bot_utils.is_informing(understood_intent["name"]):
-                    pass
-                elif bot_utils.is_confirmation_request_answer(understood_intent["name"]):
-                    if self.context.potential_new_goal is not None:
-                        # User confirmed
-                        if bot_utils.is_confirming(understood_intent["name"]):
-                            self.context.new_goal_confirmed()
-                        # User denied
-                        else:
-                            self.context.discard_potential_new_goal()
-                            if self.context.current_goal.is_met(self.context):
-                                # Get back to the initial goal
-                                self.reset()
-                            # Otherwise continue asking for info about the current goal, you certainly misunderstood
-                        return self.pursue_goal()
-                    else:
-                        if bot_utils.is_confirming(understood_intent["name"]):
-                            self.context.pending_entity_confirmed()
-                        else:
-                            self.context.discard_pending_entity()
-                    return self.pursue_goal()
-                else:
-                    # Unreachable
-                    print("unreachable (not understood then)")
-                    rephrase_utterance = self.action_factory \
-                                             .new_utterance("ask-rephrase",
-                                                            self.context)
-                    return [rephrase_utterance]
-
-                slot_confirmation_request_action = \
-                    self.fill_slots(intent_and_entities, msg_was_expected=True)
-                if slot_confirmation_request_action is not None:
-                    return [slot_confirmation_request_action]
-                return self.pursue_goal()
-            # Doubtful in your understanding
-            elif cumulative_intent_confidence > DialogManager.EXPECTED_HARD_THRESHOLD:
-                print("doubtful")
-                if bot_utils.is_triggering(understood_intent["name"]):
-                    print("potential new goal")
-                    self.context.set_potential_new_goal(
-                        self.goals_by_trigger[understood_intent["name"]]
-                    )
-                    confirmation_utterance = self.action_factory \
-                                                .new_confirmation_request_utterance(
-                                                    understood_intent["name"],
-                                                    self.context
-                                                )
-                    return [confirmation_utterance]
-                elif bot_utils.is_informing(understood_intent["name"]):
-                    # Consider you understood well
-                    print("not sure but ok")
-                    slot_confirmation_request_action = \
-                        self.fill_slots(intent_and_entities, msg_was_expected=True)
-                    if slot_confirmation_request_action is not None:
-                        return [slot_confirmation_request_action]
-                    return self.pursue_goal()
-                elif bot_utils.is_confirmation_request_answer(understood_intent["name"]):
-                    # Consider you understood well
-                    if self.context.potential_new_goal is not None:
-                        # User confirmed
-                        if bot_utils.is_confirming(understood_intent["name"]):
-                            self.context.new_goal_confirmed()
-                        # User denied
-                        else:
-                            if self.context.current_goal.is_met(self.context):
-                                # Get back to the initial goal
-                                self.reset()
-                            # Otherwise continue asking for info about the current goal, you certainly misunderstood
-                        return self.pursue_goal()
-                    else:
-                        if bot_utils.is_confirming(understood_intent["name"]):
-                            self.context.pending_entity_confirmed()
-                        else:
-                            self.context.discard_pending_entity()
-                    return self.pursue_goal()
-            # Not understood
-            else:
-                print("not understood")
-                rephrase_utterance = \
-                    self.action_factory.new_utterance("ask-rephrase",
-                                                      self.context)
-                return [rephrase_utterance]
-        # User message was not expected
-        else:
-            print("unexpected")
-            # Confident in your understanding
-            if cumulative_intent_confidence > DialogManager.UNEXPECTED_SOFT_THRESHOLD:
-                if bot_utils.is_triggering(understood_intent["name"]):
-                    print("potential new goal")
-                    self.context.set_potential_new_goal(
-                        self.goals_by_trigger[understood_intent["name"]]
-                    )
-                    confirmation_utterance = self.action_factory \
-                                                .new_confirmation_request_utterance(
-                                                    understood_intent["name"],
-                                                    self.context
-                                                )
-                    return [confirmation_utterance]
-                elif self.context.potential_new_goal is not None:
-                    print("potential new goal again?")
-                    # Try to confirm the new goal again
-                    confirmation_utterance = self.action_factory \
-                                                .new_confirmation_request_utterance(
-                                                    understood_intent["name"],
-                                                    self.context
-                                                )
-                    return [confirmation_utterance]
-                elif bot_utils.is_informing(understood_intent["name"]):
-                    # Consider you understood well
-                    print("not sure but ok")
-                    slot_confirmation_request_action = \
-                        self.fill_slots(intent_and_entities, msg_was_expected=True)
-                    if slot_confirmation_request_action is not None:
-                        return [slot_confirmation_request_action]
-                    return self.pursue_goal()
-                else:
-                    print("not really understood")
-                    rephrase_utterance = \
-                        self.action_factory.new_utterance("ask-rephrase",
-                                                          self.context)
-                    return [rephrase_utterance]
-            # Not understood # TODO: should it do something else when hard_threshold < confidence < soft_threshold
-            else:
-                print("not understood")
-                rephrase_utterance = \
-                    self.action_factory.new_utterance("ask-rephrase",
-                                                      self.context)
-                return [rephrase_utterance]
+        # (NLUMessage, TurnTrace) -> ([Action])
+        return self.policy.decide(self, message, trace)
 
     def pursue_goal(self):
         """
@@ -255,6 +316,8 @@ class DialogManager(object):
                     break
             if lacking_slot_name is None:  # Goal is met
                 printDBG("Goal "+self.context.current_goal.name+" is met")
+                if self.interrupted_contexts is not None:
+                    return actions + self.resume_interrupted_goal()
                 return actions
         # Goal is not met
         printDBG("Goal "+self.context.current_goal.name+" is not met")
@@ -262,7 +325,7 @@ class DialogManager(object):
                 .new_ask_for_slot_utterance(lacking_slot_name,
                                             deepcopy(self.context))]
 
-    def fill_slots(self, intent_and_entities, msg_was_expected=False):
+    def fill_slots(self, message, msg_was_expected=False):
         """
         Fills the slots with the entities found and asks for a confirmation request
         in case one of them is not clearly understood, i.e. it returns an
@@ -278,7 +341,7 @@ class DialogManager(object):
                 return entity1
             elif entity1 not in mandatory_slots and entity2 in mandatory_slots:
                 return entity2
-            elif entity1["confidence"] >= entity2["confidence"]:
+            elif entity1.confidence >= entity2.confidence:
                 return entity1
             return entity2
 
@@ -288,18 +351,18 @@ class DialogManager(object):
             hard_threshold = DialogManager.EXPECTED_HARD_THRESHOLD
             soft_threshold = DialogManager.EXPECTED_SOFT_THRESHOLD
         entity_to_confirm = None
-        for entity in intent_and_entities["entities"]:
-            if entity["confidence"] >= soft_threshold:
-                self.context.set_slot(entity["entity"], entity["value"])
-            elif (    entity["confidence"] >= hard_threshold
-                and entity["confidence"] < soft_threshold):
+        for entity in message.entities:
+            if entity.confidence >= soft_threshold:
+                self.context.set_slot(entity.entity, entity.value)
+            elif (    entity.confidence >= hard_threshold
+                and entity.confidence < soft_threshold):
                 entity_to_confirm = \
                     choose_which_to_request_confirmation(entity_to_confirm,
                                                          entity)
             # otherwise discard the entity
         if entity_to_confirm is not None:
-            slot_name = entity_to_confirm["entity"]
-            value = entity_to_confirm["value"]
+            slot_name = entity_to_confirm.entity
+            value = entity_to_confirm.value
             self.context.set_entity_pending_for_confirmation(slot_name, value)
             return self.action_factory \
                        .new_confirmation_request_utterance((slot_name, value),
@@ -337,7 +400,7 @@ class DialogManager(object):
         # Neither a confirmation or rephrase request
         return actions
 
-    def compute_final_confidence(self, intent_and_entities, intent_name):
+    def compute_final_confidence(self, message, intent_name):
         """
         Computes a new value of confidence for the intent `intent_name`
         based on the confidence of understanding this intent and
@@ -356,13 +419,9 @@ class DialogManager(object):
         The final confidence in the intent will then be the weighted mean value
         of this and the intent confidence and will be returned by this method.
         """ # TODO: problem if there is no slots to fill
-        # ({"intent": {"name": str, "confidence": float},
-        # "entities": [{"confidence": float, ...}],
-        # "intent_ranking": [{"name": str, "confidence": float}],
-        # "text": str}) -> (float)
-        # NOTE: the input format is shown here: http://rasa.com/docs/nlu/0.12.3/tutorial/
+        # (NLUMessage, str) -> (float)
         intent_description = None
-        intent_descriptions = cfg.get_intents_descriptions()
+        intent_descriptions = self.intents_descriptions
         if intent_name not in intent_descriptions:
             raise RuntimeError("The bot understood an inexistant intent ('"+
                                intent_name+"').")
@@ -375,15 +434,15 @@ class DialogManager(object):
         if (    len(intent_description["expected-entities"]) <= 0
             and len(intent_description["allowed-entities"]) <= 0):
             print("no expected or allowed entities => no correction")
-            return intent_and_entities["intent"]["confidence"]
+            return message.intent.confidence
         elif len(intent_description["expected-entities"]) <= 0:
             print("no expected entities")
             P_sum_confidences = 0
             P_count = 0
-            for detected_entity in intent_and_entities["entities"]:
-                if detected_entity["entity"] in intent_description["allowed-entities"]:
+            for detected_entity in message.entities:
+                if detected_entity.entity in intent_description["allowed-entities"]:
                     P_count += 1
-                    P_sum_confidences += detected_entity["confidence"]
+                    P_sum_confidences += detected_entity.confidence
             P = 0.0
             if P_count > 0:
                 P = float(P_sum_confidences)/float(P_count)
@@ -395,20 +454,20 @@ class DialogManager(object):
             print("expected entities and allowed entities")
             M_sum_confidences = 0
             M_count = 0
-            for detected_entity in intent_and_entities["entities"]:
-                if detected_entity["entity"] in intent_description["expected-entities"]:
+            for detected_entity in message.entities:
+                if detected_entity.entity in intent_description["expected-entities"]:
                     M_count += 1
-                    M_sum_confidences += detected_entity["confidence"]
+                    M_sum_confidences += detected_entity.confidence
             M = 0.0
             if M_count > 0:
                 M = float(M_sum_confidences)/float(M_count)
 
             P_sum_confidences = 0
             P_count = 0
-            for detected_entity in intent_and_entities["entities"]:
-                if detected_entity["entity"] in intent_description["allowed-entities"]:
+            for detected_entity in message.entities:
+                if detected_entity.entity in intent_description["allowed-entities"]:
                     P_count += 1
-                    P_sum_confidences += detected_entity["confidence"]
+                    P_sum_confidences += detected_entity.confidence
             P = 0.0
             if P_count > 0:
                 P = float(P_sum_confidences)/float(P_count)
@@ -421,11 +480,11 @@ class DialogManager(object):
 
         U_sum_confidences = 0
         U_count = 0
-        for detected_entity in intent_and_entities["entities"]:
-            if (    detected_entity["entity"] not in intent_description["expected-entities"]
-                and detected_entity["entity"] not in intent_description["allowed-entities"]):
+        for detected_entity in message.entities:
+            if (    detected_entity.entity not in intent_description["expected-entities"]
+                and detected_entity.entity not in intent_description["allowed-entities"]):
                 U_count += 1
-                U_sum_confidences += detected_entity["confidence"]
+                U_sum_confidences += detected_entity.confidence
         U = 0.0
         if U_count > 0:
             U = float(U_sum_confidences)/float(U_count)
@@ -434,11 +493,7 @@ class DialogManager(object):
 
         F = C_MO/(log2(U+1)+1)
 
-        intent_confidence = None
-        for intent in intent_and_entities["intent_ranking"]:
-            if intent["name"] == intent_name:
-                intent_confidence = intent["confidence"]
-                break
+        intent_confidence = message.get_ranked_confidence(intent_name)
 
         print("\tF = "+str(F))
         answer = (4*intent_confidence + 3*F)/7.0  # weighted average
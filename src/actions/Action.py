@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import re
+import threading
 
 from utils import *
+from bot.caching import LRUCache, SingleFlight
+import bot.config as cfg
 
 
 class Action(object):
@@ -12,7 +15,17 @@ class Action(object):
     name and a code to run and uses a context (with slot values, a current
     goal and so forth).
     Actions should always be immutable.
+
+    An action whose result only depends on the values of some slots and on
+    some data (that is versioned) can declare those slots in `RELEVANT_SLOTS`
+    and override `get_data_version`: the results of such actions are then
+    cached (with a time-to-live) and concurrent runs with the same slot values
+    and data version are coalesced into one (cf. `execute`).
+    Cached results are shared by all the conversations and must thus never
+    be modified.
     """
+    RELEVANT_SLOTS = None  # Names of the slots the result of `run` depends on (`None` if unknown)
+
     def __init__(self, name, context):
         if name is None:
             raise ValueError("Tried to create an action without a name.")
@@ -20,10 +33,52 @@ class Action(object):
         self.context = context
 
     def run(self):
-        """Runs the action and returns the potentially fetched informations."""
-        # () -> ({str: str} or BotErrorMessage)
+        """
+        Runs the action and returns the potentially fetched informations
+        (pieces of information that are costly to compute and that not all
+        the templates display can be computed lazily, cf. `LazyFetchedInfo`).
+        """
+        # () -> ({str: str} or LazyFetchedInfo or BotErrorMessage)
         return dict()
 
+    def execute(self):
+        """
+        Runs the action and returns the potentially fetched informations.
+        This should be used instead of calling `run` directly: the result of
+        an identical run (cf. `get_run_key`) made recently is reused, and
+        identical runs happening concurrently in several conversations are
+        made only once and share their result.
+        """
+        # () -> ({str: str} or BotErrorMessage)
+        run_key = self.get_run_key()
+        if run_key is None:
+            return self.run()
+        return _results_cache.get_or_compute(
+            run_key, lambda: _in_flight_runs.do(run_key, self.run)
+        )
+
+    def get_data_version(self):
+        """
+        Returns the version of the data the action fetches information from,
+        or `None` if it doesn't fetch versioned data.
+        """
+        # () -> (anything)
+        return None
+
+    def get_run_key(self):
+        """
+        Returns a key identifying the result `run` would return (made of the
+        class of `self`, the values of its relevant slots and the data version)
+        or `None` if the action didn't declare its relevant slots.
+        """
+        # () -> (tuple or None)
+        if self.RELEVANT_SLOTS is None:
+            return None
+        return (type(self).__name__,
+                tuple(self.context.get_slot_value(slot_name)
+                      for slot_name in self.RELEVANT_SLOTS),
+                self.get_data_version())
+
     def promote_needed_optional_slots(self, context_to_update):
         """
         Using all the slot values that are already filled, checks if
@@ -84,6 +139,10 @@ class MsgTemplate(object):
     OPTIONAL_TEMPLATE_REGEX = \
         re.compile(r"(?<!\\)"+OPTIONAL_TEMPLATE_BOUNDARY_CHAR+
                    r".*?(?<!\\)"+OPTIONAL_TEMPLATE_BOUNDARY_CHAR)
+    PLACEHOLDER_REGEX = \
+        re.compile("(?=[{0}]([^{0}]*)[{0}])".format(
+            re.escape(TEMPLATE_BOUNDARY_CHAR+OPTIONAL_TEMPLATE_BOUNDARY_CHAR)
+        ))  # overlapping matches, to find every part between two boundaries
 
     def __init__(self, template):
         if not isinstance(template, str):
@@ -104,48 +163,142 @@ class MsgTemplate(object):
         Generates a message sendable to the user and uses for this the slot
         values from the `context` and the `fetched_info` fetched by previous
         actions.
+        The message only depends on the template and on the values of the
+        placeholders it references, which are thus used as the key of a cache
+        of the generated messages (cf. `get_renders_cache_metrics`).
         """
         # (Context, {str: str}) -> (str)
-        msg = self.template
-        for slot_name in context.slots:
-            slot_value = context.get_slot_value(slot_name)
-            if slot_value is not None:
-                slot_value = str(slot_value)
-                try:
-                    if context.slots[slot_name].type_str == "percentage":
-                        slot_value = "{:.1f}".format((100*float(slot_value)))  # To display it in percents
-                    elif context.slots[slot_name].type_str == "float":
-                        slot_value = "{:.1f}".format(float(slot_value))
-                except ValueError:
-                    import warnings
-                    warnings.warn("A slot of type 'float' or 'percentage' has "+
-                                  "a value of another type ('"+slot_value+"').")
-
-            if slot_value is not None:
-                msg = msg.replace(MsgTemplate.TEMPLATE_BOUNDARY_CHAR + slot_name +
-                                  MsgTemplate.TEMPLATE_BOUNDARY_CHAR,
-                                  slot_value)
-                msg = msg.replace(MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR+
-                                  slot_name+
-                                  MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR,
-                                  slot_value)
-        for info_name in fetched_info:
-            if fetched_info[info_name] is not None:
-                piece_of_info = fetched_info[info_name]
-                if isinstance(piece_of_info, float):
-                    piece_of_info = "{:.1f}".format(piece_of_info)
+        values = self._get_placeholders_values(context, fetched_info)
+        if not cfg.MEMOIZE_RENDERS:
+            return self._render(values)
+        key = (self.template, tuple(values))
+        msg = _renders_cache.get(key)
+        if msg is None:
+            msg = self._render(values)
+            if len(msg) <= cfg.RENDERS_CACHE_MAX_MSG_LENGTH:
+                _renders_cache.put(key, msg)
+        return msg
+
+    def get_placeholders(self):
+        """
+        Returns the names that may be placeholders in the template, i.e. all
+        the parts of the template between two boundary characters (which
+        includes some text that is not a placeholder).
+        """
+        # () -> ((str,))
+        placeholders = _placeholders_by_template.get(self.template)
+        if placeholders is None:
+            placeholders = []
+            for name in MsgTemplate.PLACEHOLDER_REGEX.findall(self.template):
+                if len(name) > 0 and name not in placeholders:
+                    placeholders.append(name)
+            placeholders = tuple(placeholders)
+            _placeholders_by_template[self.template] = placeholders
+        return placeholders
+
+    def _get_placeholders_values(self, context, fetched_info):
+        """
+        Returns the values (as they should be displayed) of the placeholders of
+        the template that have one, as a list of tuples (name, value).
+        """
+        # (Context, {str: str}) -> ([(str, str)])
+        values = []
+        for name in self.get_placeholders():
+            slot = context.slots.get(name)
+            if slot is not None and slot.is_set():  # slots take precedence
+                value = slot.get_display_value()  # e.g. percentages in percents
+            else:
+                value = fetched_info.get(name)
+                if value is None:
+                    continue
+                if isinstance(value, float):
+                    value = "{:.1f}".format(value)
                 else:
-                    piece_of_info = str(piece_of_info)
-                msg = msg.replace(MsgTemplate.TEMPLATE_BOUNDARY_CHAR + info_name +
-                                  MsgTemplate.TEMPLATE_BOUNDARY_CHAR,
-                                  piece_of_info)
-                msg = msg.replace(MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR+
-                                  info_name+
-                                  MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR,
-                                  piece_of_info)
+                    value = str(value)
+            values.append((name, value))
+        return values
+
+    def _render(self, values):
+        # ([(str, str)]) -> (str)
+        msg = self.template
+        for (name, value) in values:
+            msg = msg.replace(MsgTemplate.TEMPLATE_BOUNDARY_CHAR + name +
+                              MsgTemplate.TEMPLATE_BOUNDARY_CHAR,
+                              value)
+            msg = msg.replace(MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR+
+                              name+
+                              MsgTemplate.OPTIONAL_TEMPLATE_BOUNDARY_CHAR,
+                              value)
         msg = re.sub(MsgTemplate.OPTIONAL_TEMPLATE_REGEX, "", msg)
         return msg
 
+class LazyFetchedInfo(object):
+    """
+    Information fetched by an action (used as a read-only dict by the
+    templates), some pieces of which are only computed when they are read,
+    i.e. when the template that was chosen references them
+    (cf. `MsgTemplate.generate`).
+    Pieces are added with `set` (computed values) or `set_lazy` (functions
+    without arguments returning the value, called at most once).
+    As results of actions can be cached (cf. `Action.execute`), the functions
+    must only use data that won't change afterwards, and should only keep
+    the little data they need (they live as long as the cached result).
+    Cached results are shared by the conversations: the pieces are read and
+    computed under a lock of their own.
+    """
+    def __init__(self, info=None):
+        # ({str: anything}) -> ()
+        if info is None:
+            info = dict()
+        self._values = dict(info)
+        self._thunks = dict()  # name -> () -> (anything)
+        self._lock = threading.RLock()  # reentrant as a function may read other pieces
+
+    def set(self, name, value):
+        with self._lock:
+            self._thunks.pop(name, None)
+            self._values[name] = value
+    def set_lazy(self, name, compute):
+        # (str, () -> (anything)) -> ()
+        with self._lock:
+            self._values.pop(name, None)
+            self._thunks[name] = compute
+
+    def get(self, name, default=None):
+        with self._lock:
+            if name in self._values:
+                return self._values[name]
+            compute = self._thunks.get(name)
+            if compute is None:
+                return default
+            value = compute()
+            self._values[name] = value
+            self._thunks.pop(name, None)
+            return value
+    def __getitem__(self, name):
+        if name not in self:
+            raise KeyError(name)
+        return self.get(name)
+    def __contains__(self, name):
+        with self._lock:
+            return (name in self._values or name in self._thunks)
+    def keys(self):
+        with self._lock:
+            return list(self._values.keys())+list(self._thunks.keys())
+    def __iter__(self):
+        return iter(self.keys())
+    def __len__(self):
+        with self._lock:
+            return len(self._values)+len(self._thunks)
+
+    def __str__(self):
+        with self._lock:
+            pieces = [repr(name)+": "+repr(value)
+                      for (name, value) in self._values.items()]
+            pieces += [repr(name)+": <not computed>" for name in self._thunks]
+        return "{"+", ".join(pieces)+"}"
+
+
 class BotErrorMessage(object):
     """
     An instance of a class will be returned by 'fetching' actions (custom
@@ -165,3 +318,34 @@ class BotErrorMessage(object):
 
     def __str__(self):
         return "<BotErrorMessage: "+self.msg+">"
+
+
+_results_cache = LRUCache(max_entries=cfg.ACTIONS_RESULTS_CACHE_MAX_ENTRIES,
+                          ttl=cfg.ACTIONS_RESULTS_CACHE_TTL)
+_in_flight_runs = SingleFlight()
+
+def get_results_cache_metrics():
+    """Returns the hit/miss metrics of the cache of the actions results."""
+    # () -> ({str: int or float})
+    return _results_cache.metrics.as_dict()
+def clear_results_cache():
+    _results_cache.clear()
+
+_renders_cache = LRUCache(max_entries=cfg.RENDERS_CACHE_MAX_ENTRIES,
+                          max_bytes=cfg.RENDERS_CACHE_MEMORY_BUDGET)
+_placeholders_by_template = dict()  # template -> placeholders (cf. `MsgTemplate.get_placeholders`)
+
+def get_renders_cache_metrics():
+    """Returns the hit/miss metrics of the cache of the generated messages."""
+    # () -> ({str: int or float})
+    return _renders_cache.metrics.as_dict()
+def clear_renders_cache():
+    _renders_cache.clear()
+
+def get_coalescing_metrics():
+    """
+    Returns how many runs of actions were executed and how many were
+    coalesced with an identical run that was in flight.
+    """
+    # () -> ({str: int})
+    return _in_flight_runs.as_dict()
@@ -8,14 +8,15 @@ import bot.config as cfg
 
 class ActionAskSlotValue(ActionUtter):
     """Represents the action of asking the user for the value of some slot."""
-    def __init__(self, context, slot_description):
-        # (Context, {"summary": str, ...}) -> ()
+    def __init__(self, context, slot_description, template_msgs=None):
+        # (Context, {"summary": str, ...}, [str]) -> ()
         if not isinstance(slot_description, dict):
             raise TypeError("Tried to create an 'ask slot' utterance action "+
                             "with a slot description of invalid type: "+
                             type(slot_description).__name__+" instead of dict.")
         name = cfg.ASK_SLOT_VAL_ACTION_NAME
-        template_msgs = cfg.get_utterances_templates()[name]
+        if template_msgs is None:
+            template_msgs = cfg.get_utterances_templates()[name]
         super(ActionAskSlotValue, self).__init__(name, template_msgs, context)
         self.slot_description = slot_description
 
@@ -2,6 +2,7 @@
 # -*- coding: utf-8 -*-
 
 import importlib
+import time
 
 from .Action import *
 from .confirmation_requests import *
@@ -31,17 +32,50 @@ def import_action_class(class_name, module_name=None):
     return getattr(m, class_name)
 
 
+# Resolved action classes, indexed by class name: the import machinery is only
+# used once per class. Errors and the `ActionNoAPI` fallback are not cached, as
+# they may only be temporary.
+_ACTION_CLASSES_CACHE = dict()
+
+def get_action_class(class_name):
+    """
+    Same as `import_action_class` for custom actions, but the classes that were
+    resolved are cached so that each class is only imported once.
+    Whether the API is accessible is still checked on every call.
+    """
+    # (str) -> (Class)
+    if not is_API_accessible():
+        return ActionNoAPI
+    action_class = _ACTION_CLASSES_CACHE.get(class_name)
+    if action_class is None:
+        action_class = import_action_class(class_name)
+        if action_class is not ActionNoAPI:  # The API may have gone down meanwhile
+            _ACTION_CLASSES_CACHE[class_name] = action_class
+    return action_class
+
+def is_custom_action_name(action_name):
+    """
+    Returns `True` if `action_name` refers to a custom action
+    (i.e. neither a special action nor an utterance).
+    """
+    return not (   action_name in cfg.PARAMETRIZED_ACTIONS_NAMES
+                or action_name in cfg.SPECIAL_ACTIONS_NAMES
+                or action_name.startswith(cfg.UTTERANCE_ACTION_PREFIX))
+
+
 class ActionFactory(object):
     """
     A factory for actions: creates actions based solely on their name and loads
     their templates if needed.
     """
-    def __init__(self, templates):
+    def __init__(self, templates, slots_descriptions=None):
         """
         `templates` is a dict indexed with utterances name and whose values are
         lists of templates for this utterance.
+        `slots_descriptions` are the descriptions of the slots of the current
+        client (defaults to the ones of the bot's configuration).
         """
-        # ({str: [str]}) -> ()
+        # ({str: [str]}, {str: {str: ...}}) -> ()
         if not isinstance(templates, dict):
             raise TypeError("Tried to create an action factory with a template "+
                             "inventory of invalid type: "+
@@ -49,7 +83,9 @@ class ActionFactory(object):
         self.templates = templates
 
         self.intents_descriptions = cfg.get_intents_descriptions()
-        self.slots_descriptions = cfg.get_slots_descriptions()
+        if slots_descriptions is None:
+            slots_descriptions = cfg.get_slots_descriptions()
+        self.slots_descriptions = slots_descriptions
 
     def new_action(self, action_name, context):
         """
@@ -68,12 +104,39 @@ class ActionFactory(object):
             return self.new_utterance(action_name, context)
         # Try to return the right action
         try:
-            action_class = import_action_class(action_name)
+            action_class = get_action_class(action_name)
         except (ImportError, AttributeError) as e:
             raise ValueError("Couldn't instantiate action '"+action_name+
                              "': this class doesn't exist.")
         return action_class(action_name, context)
 
+    def warm_up(self):
+        """
+        Resolves (and caches) the classes of all the custom actions referenced
+        in the goals descriptions, so that no module gets imported while
+        answering the user. This should be called at startup.
+        Returns a report indexed by action name, telling for each action how
+        much time it took to import its module (in seconds) and the error that
+        was met if it couldn't be resolved (`None` otherwise).
+        """
+        # () -> ({str: {"import-time": float, "error": str or None}})
+        report = dict()
+        goals_descriptions = cfg.get_goals_descriptions()
+        for goal_name in goals_descriptions:
+            for action_name in goals_descriptions[goal_name].get("actions", []):
+                if action_name in report or not is_custom_action_name(action_name):
+                    continue
+                start_time = time.time()
+                error = None
+                try:
+                    get_action_class(action_name)
+                except (ImportError, AttributeError) as e:
+                    error = type(e).__name__+": "+str(e)
+                    print("Couldn't load custom action '"+action_name+"': "+error)
+                report[action_name] = {"import-time": time.time()-start_time,
+                                       "error": error}
+        return report
+
     def new_utterance(self, utterance_name, context):
         """
         Creates an `ActionUtter` with name `utterance_name` and templates linked
@@ -99,11 +162,13 @@ class ActionFactory(object):
             # Request a confirmation of slot and value
             slot_description = self.slots_descriptions[intent_or_entity[0]]
             return ActionUtterConfirmEntity(context, slot_description,
-                                           intent_or_entity[1])
+                                           intent_or_entity[1],
+                                           self.templates[cfg.REQUEST_CONFIRMATION_SLOT_VAL_ACTION_NAME])
         else:
             # Request a confirmation of intent
             intent_description = self.intents_descriptions[intent_or_entity]
-            return ActionUtterConfirmIntent(context, intent_description)
+            return ActionUtterConfirmIntent(context, intent_description,
+                                            self.templates[cfg.REQUEST_CONFIRMATION_INTENT_ACTION_NAME])
 
     def new_ask_for_slot_utterance(self, slot_name, context):
         """
@@ -111,4 +176,5 @@ class ActionFactory(object):
         for the value of `slot_name`.
         """
         slot_description = self.slots_descriptions[slot_name]
-        return ActionAskSlotValue(context, slot_description)
+        return ActionAskSlotValue(context, slot_description,
+                                  self.templates[cfg.ASK_SLOT_VAL_ACTION_NAME])
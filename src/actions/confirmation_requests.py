@@ -15,14 +15,15 @@ class ActionUtterConfirmIntent(ActionUtter):
     The `generate_confirmation_request` method can be given which intent
     the bot should ask confirmation for.
     """
-    def __init__(self, context, intent_to_confirm):
-        # (Context, {"summary": str, ...}) -> ()
+    def __init__(self, context, intent_to_confirm, template_msgs=None):
+        # (Context, {"summary": str, ...}, [str]) -> ()
         if not isinstance(intent_to_confirm, dict):
             raise TypeError("Tried to create a confirmation request intent action with an "+
                             "intent to confirm of invalid type: "+
                             type(intent_to_confirm).__name__+" instead of dict.")
         name = cfg.REQUEST_CONFIRMATION_INTENT_ACTION_NAME
-        template_msgs = cfg.get_utterances_templates()[name]
+        if template_msgs is None:
+            template_msgs = cfg.get_utterances_templates()[name]
         super(ActionUtterConfirmIntent, self).__init__(name, template_msgs, context)
         self.intent_to_confirm = intent_to_confirm  # dict as described in the config, {"summary": str, ...}
 
@@ -53,8 +54,8 @@ class ActionUtterConfirmEntity(ActionUtter):
     The `generate_confirmation_request` method can be given which slot
     the bot should request confirmation for.
     """
-    def __init__(self, context, slot_to_confirm, slot_value):
-        # (Context, {"summary": str, ...}, str) -> ()
+    def __init__(self, context, slot_to_confirm, slot_value, template_msgs=None):
+        # (Context, {"summary": str, ...}, str, [str]) -> ()
         if not isinstance(slot_to_confirm, dict):
             raise TypeError("Tried to create an entity confirmation request action with "+
                             "a slot to confirm of invalid type: "+
@@ -67,7 +68,8 @@ class ActionUtterConfirmEntity(ActionUtter):
                                     "action with a slot value of invalid type: "+
                                     type(slot_value).__name__+" instead of str.")
         name = cfg.REQUEST_CONFIRMATION_SLOT_VAL_ACTION_NAME
-        template_msgs = cfg.get_utterances_templates()[name]
+        if template_msgs is None:
+            template_msgs = cfg.get_utterances_templates()[name]
         super(ActionUtterConfirmEntity, self).__init__(name, template_msgs, context)
         self.slot_to_confirm = slot_to_confirm
         self.slot_value = slot_value
@@ -2,11 +2,16 @@
 # -*- coding: utf-8 -*-
 
 from bot.actions.Action import Action, BotErrorMessage
-
-import Phi
+from bot.actions.custom.plan_snapshot import get_plan_version
+from bot.actions.custom.planning_lookups import LookupScope
 
 
 class ActionLookUpMachinePlanning(Action):
+    RELEVANT_SLOTS = ("production_line", "line_number", "time_window")
+
+    def get_data_version(self):
+        return get_plan_version()
+
     def promote_needed_optional_slots(self, context_to_update):
         """
         From the context `context_to_update`, checks whether there is missing
@@ -23,7 +28,7 @@ class ActionLookUpMachinePlanning(Action):
                                "promotion while all mandarory slots where not "+
                                "filled ('production_line' missing).")
 
-        if Phi.findLine(prod_line_name) is None:
+        if self._get_lookups().find_line(prod_line_name) is None:
             return context_to_update.promote_slot("line_number")
         return False
 
@@ -35,30 +40,57 @@ class ActionLookUpMachinePlanning(Action):
             - The total number of time buckets
             - The percentage of the time the line is used
             - ... TODO?
+        If the user asked about a range of time buckets (slot 'time_window'),
+        this information only concerns those time buckets.
         """
-        line = self._get_relevant_line()
-        if line is None:
-            line_name = self._get_line_name()
+        line_name = self._get_line_name()
+        print("looking for "+str(line_name))
+        line_aggregates = self._get_lookups().get_line_aggregates(line_name)
+        if line_aggregates is None:
             print("Line "+str(line_name)+" not found")
             return BotErrorMessage("I <b>couldn't find the line "+str(line_name)+
                                    "</b>. I'm afraid it doesn't exist.")
-        print("Found line "+str(line.getName()))
-
-        nb_buckets = Phi.getNumberOfTimeBuckets()
-        nb_buckets_of_use = 0
-        utilization_percent = 0.0
-        for i in range(nb_buckets):
-            current_utilization = line.getUtilisation(Phi.getTimeBucket(i))
-            if current_utilization > 0.0:
-                nb_buckets_of_use += 1
-                utilization_percent += current_utilization
-        utilization_percent *= 100/nb_buckets
+        print("Found line "+str(line_name))
 
-        info = {
-            "total-number-buckets": nb_buckets,
-            "number-buckets-of-use": nb_buckets_of_use,
-            "utilization-percentage": utilization_percent,
-        }
+        plan = self._get_lookups().get_plan_snapshot()  # the one of `line_aggregates`
+        time_window = self.context.get_slot_value("time_window")
+        if time_window is None:
+            info = {
+                "total-number-buckets": plan.nb_buckets,
+                "number-buckets-of-use":
+                    line_aggregates["number-buckets-of-use"],
+                "utilization-percentage":
+                    line_aggregates["utilization-percentage"],
+                "time-window-description": None,
+            }
+        else:
+            bucket_range = self.context.get_typed_slot_value("time_window")  # parsed when the slot was set
+            if bucket_range is None:
+                return BotErrorMessage("I <b>didn't understand which time "+
+                                       "buckets</b> you are interested in ('"+
+                                       str(time_window)+"').")
+            (first_bucket_nb, last_bucket_nb) = bucket_range
+            if first_bucket_nb < 1 or last_bucket_nb > plan.nb_buckets:
+                return BotErrorMessage("I <b>can't look at time buckets "+
+                                       str(first_bucket_nb)+" to "+
+                                       str(last_bucket_nb)+"</b>: the plan "+
+                                       "only has time buckets 1 to "+
+                                       str(plan.nb_buckets)+".")
+            # Bucket numbers start at 1 and include the last bucket
+            (first_bucket, last_bucket) = (first_bucket_nb-1, last_bucket_nb)
+            line_index = line_aggregates["line-index"]
+            info = {
+                "total-number-buckets": last_bucket-first_bucket,
+                "number-buckets-of-use":
+                    plan.get_nb_busy_buckets(line_index, first_bucket,
+                                             last_bucket),
+                "utilization-percentage":
+                    plan.get_utilization_percentage(line_index, first_bucket,
+                                                    last_bucket),
+                "time-window-description":
+                    " (between time buckets "+str(first_bucket_nb)+" and "+
+                    str(last_bucket_nb)+")",
+            }
         print("finally: "+str(info))
         return info
 
@@ -77,12 +109,12 @@ class ActionLookUpMachinePlanning(Action):
                 line_name += str(line_nb)
             self._line_name = line_name
         return self._line_name
-    def _get_relevant_line(self):
+    def _get_lookups(self):
         """
-        Finds the line the user talked about and returns it.
-        Returns `None` if the line wasn't found.
+        Returns the scope in which the planning API lookups of this action
+        (thus of this turn) are memoized.
         """
-        # () -> (Phi.Line)
-        line_name = self._get_line_name()
-        print("looking for "+str(line_name))
-        return Phi.findLine(line_name)
+        # () -> (LookupScope)
+        if not hasattr(self, "_lookups"):
+            self._lookups = LookupScope()
+        return self._lookups
@@ -1,12 +1,17 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from bot.actions.Action import Action, BotErrorMessage
-
-import Phi
+from bot.actions.Action import Action, BotErrorMessage, LazyFetchedInfo
+from bot.actions.custom.plan_snapshot import get_plan_version
+from bot.actions.custom.order_index import get_order_index
 
 
 class ActionLookUpOrdersTime(Action):
+    RELEVANT_SLOTS = ("filter_time",)
+
+    def get_data_version(self):
+        return get_plan_version()
+
     def promote_needed_optional_slots(self, context_to_update):
         return False
 
@@ -30,49 +35,50 @@ class ActionLookUpOrdersTime(Action):
         else:  # slot value should be "on time" (always)
             filter_late_orders = False
 
-        nb_orders = Phi.getNumOrders()
-        nb_forbidden_orders = 0
-        filtered_orders = []
-        for i in range(nb_orders):
-            current_order = Phi.getOrder(i)
-            planned_lateness_buckets = \
-                current_order.getPlannedBucketsOfLateness()
-            if filter_late_orders and planned_lateness_buckets > 0:
-                filtered_orders.append(current_order)
-            elif not filter_late_orders and planned_lateness_buckets <= 0:
-                filtered_orders.append(current_order)
-            if current_order.isForbidden():
-                nb_forbidden_orders += 1
+        orders = get_order_index()
+        nb_orders = orders.nb_orders
+        nb_forbidden_orders = orders.nb_forbidden
+        if filter_late_orders:
+            filter_mask = orders.late
+        else:
+            filter_mask = orders.on_time
 
-        nb_filtered_orders = len(filtered_orders)
+        nb_filtered_orders = orders.count(filter_mask)
         if filter_late_orders:
             nb_late_orders = nb_filtered_orders
         else:
             nb_late_orders = nb_orders-nb_filtered_orders
-        if nb_filtered_orders > 0:
+
+        # The names are taken now rather than when the list is made: the
+        # cached result mustn't keep the order index of an old plan alive
+        first_orders_names = orders.get_first_names(filter_mask, 3)
+
+        def make_small_list_orders_str():
+            if nb_filtered_orders <= 0:
+                return None
             if nb_filtered_orders <= 3:
                 small_list_orders_str = "Here is a list of their names:"
-                for order in filtered_orders:
-                    small_list_orders_str += "\n- "+str(order.getName())
             else:
                 small_list_orders_str = "Here are the names of the first 3 ones:"
-                for i in range(3):
-                    small_list_orders_str += "\n- "+str(filtered_orders[i].getName())
+            for order_name in first_orders_names:
+                small_list_orders_str += "\n- "+str(order_name)
+            if nb_filtered_orders > 3:
                 small_list_orders_str += "\n- ..."
-        else:
-            small_list_orders_str = None
-        if nb_late_orders > 0:
-            percentage_late_orders_forbidden = \
-                100.0 * (float(nb_forbidden_orders)/float(nb_late_orders))
-        else:
-            percentage_late_orders_forbidden = 0.0
+            return small_list_orders_str
+        def compute_percentage_late_orders_forbidden():
+            if nb_late_orders > 0:
+                return 100.0 * (float(nb_forbidden_orders)/float(nb_late_orders))
+            return 0.0
 
-        info = {
+        # The list and the percentage are only made if the chosen template
+        # displays them
+        info = LazyFetchedInfo({
             "total-number-orders": nb_orders,
-            "number-filtered-orders": len(filtered_orders),
-            "orders-list": small_list_orders_str,
+            "number-filtered-orders": nb_filtered_orders,
             "number-forbidden-orders": nb_forbidden_orders,
-            "percentage-late-orders-forbidden": percentage_late_orders_forbidden,
-        }
+        })
+        info.set_lazy("orders-list", make_small_list_orders_str)
+        info.set_lazy("percentage-late-orders-forbidden",
+                      compute_percentage_late_orders_forbidden)
         print("finally "+str(info))
         return info
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the diagnosis of why a production line is not used at its
+full capacity (cf. `ActionLookUpWhyMachineUtilization`).
+The diagnosis only depends on the plan: an optional background worker can
+thus compute it for every line each time a new plan is published (cf.
+`start_diagnosis_precomputation`), so that the users' questions are answered
+from this precomputed table. Lines that are not in the table are diagnosed
+when the question is asked.
+"""
+
+import threading
+
+from utils import float_equal
+from bot.caching import CacheMetrics
+from bot.actions.custom.plan_snapshot import add_plan_listener, \
+                                              remove_plan_listener
+from bot.actions.custom.pf_line_incidence import get_pf_line_incidence
+
+
+def diagnose_line(line_name, incidence=None):
+    """
+    Checks several things about the line named `line_name` to try and analyze
+    why it wouldn't be used at its full potential. Returns its utilization (in
+    percents) as "fetched-utilization" and the explanation found as
+    "machine-utilization-explanation", or `None` if the line is not part of
+    the plan.
+    The plan snapshot and the order index used are the ones `incidence` was
+    built from, so that they all come from the same plan version (`incidence`
+    defaults to the incidence index of the current plan).
+    """
+    # (str, ProductFamilyLineIncidence) -> ({str: float or str} or None)
+    if incidence is None:
+        incidence = get_pf_line_incidence()
+    plan = incidence.plan
+    line_index = plan.line_indices_by_name.get(line_name)
+    if line_index is None:
+        return None
+    line = plan.lines[line_index]
+    utilization = plan.get_utilization_percentage(line_index)
+
+    # Check 0: is the line saturated?
+    print("doing check #0")
+    if float_equal(utilization, 100.0):
+        print("Line "+str(line.getName())+" is saturated")
+        return {
+            "fetched-utilization": 100.0,
+            "machine-utilization-explanation":
+                "which means it is <b>saturated</b>. The point is to "+
+                "fulfill a maximum number of orders, right?",
+        }
+
+    # Check 1: is all demand planned?
+    print("doing check #1")
+    orders = incidence.orders
+    nb_orders = orders.nb_orders
+    nb_orders_planned = orders.nb_planned
+    nb_orders_forbidden = orders.nb_forbidden
+
+    if nb_orders - nb_orders_forbidden == nb_orders_planned:
+        return {
+            "fetched-utilization": utilization,
+            "machine-utilization-explanation":
+                "because <b>all the orders are planned</b>: "+
+                str(nb_orders_planned)+" out of "+str(nb_orders)+" are "+
+                "planned (where "+str(nb_orders_forbidden)+" orders are "+
+                "forbidden)",
+        }
+
+    # Check 2: is there a part of the unplanned demand that actually goes through this line?
+    print("doing check #2")
+    unplanned_pf_codes = orders.get_product_families_codes(orders.unplanned)
+    if not incidence.is_line_used_by_any(line_index, unplanned_pf_codes):
+        return {
+            "fetched-utilization": utilization,
+            "machine-utilization-explanation":
+                "because it seems there is <b>no unplanned orders "+
+                "that need to go through this production line</b>",
+        }
+
+    # Check 3: is it possible to plan the unplanned orders within the horizon (are they already late)?
+    print("doing check #3")
+    if orders.some_due_after_horizon:
+        return {
+            "fetched-utilization": utilization,
+            "machine-utilization-explanation":
+                "because <b>some orders have their due date after the time "+
+                "horizon</b> (the end time of the last time bucket), "+
+                "therefore the solver decided not to plan them",
+        }
+
+    # Check 4: are there other lines which are saturated over the horizon?
+    print("doing check #4")
+    # Saturated lines through which go unplanned orders that also go through this line
+    blocking_lines_indices = \
+        incidence.get_blocking_saturated_lines(line_index, unplanned_pf_codes)
+    if len(blocking_lines_indices) > 0:
+        other_saturated_line = plan.lines[blocking_lines_indices[0]]
+        return {
+            "fetched-utilization": utilization,
+            "machine-utilization-explanation":
+                "because <b>production line "+
+                str(other_saturated_line.getName())+" is saturated</b> "+
+                "which prevents some of the unplanned commands that go "+
+                "through line "+str(line.getName())+" to be completed. "+
+                "The solver does not plan such commands completely",
+        }
+
+    # Check 5: are there any limiting flow constraints on the line?
+    print("doing check #5")
+    # Check 6: are there any stock max constraints on some successive lines?
+    print("doing check #6")
+
+    return {
+        "fetched-utilization": utilization,
+        "machine-utilization-explanation":
+            "but I <b>couldn't find out why</b>.\nIf after analyzing the "+
+            "plan, you still can't understand why this is the case, don't "+
+            "hesitate to <b>call a consultant</b>",
+    }
+
+
+def get_line_diagnosis(line_name):
+    """
+    Returns the diagnosis of the line named `line_name` in the current plan
+    (cf. `diagnose_line`), taken from the precomputed table if it is there and
+    computed otherwise. Returns `None` if the line is not part of the plan.
+    """
+    # (str) -> ({str: float or str} or None)
+    incidence = get_pf_line_incidence()
+    if _precomputer is not None:
+        diagnosis = _precomputer.get(line_name, incidence.plan_version)
+        if diagnosis is not None:
+            return diagnosis
+    return diagnose_line(line_name, incidence)
+
+
+class DiagnosisPrecomputer(object):
+    """
+    Background worker that diagnoses all the lines of the plan each time a new
+    plan is published. The table of diagnoses is indexed by line name and
+    only contains the diagnoses of a single plan version.
+    """
+    def __init__(self):
+        self._table = (None, dict())  # (plan version, {line name: diagnosis}), replaced as a whole
+        self._new_plan = threading.Event()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._work,
+                                        name="diagnosis-precomputer")
+        self._thread.daemon = True
+        self.metrics = CacheMetrics()
+
+    def start(self):
+        """Starts the worker, which diagnoses the lines of the current plan."""
+        add_plan_listener(self.on_new_plan)
+        self._thread.start()
+        self._new_plan.set()
+    def stop(self):
+        """Stops the worker (the table stays available)."""
+        remove_plan_listener(self.on_new_plan)
+        self._stopped = True
+        self._new_plan.set()
+        self._thread.join()
+
+    def on_new_plan(self, plan_version):
+        self._new_plan.set()
+
+    def get(self, line_name, plan_version):
+        """
+        Returns the precomputed diagnosis of the line named `line_name` in the
+        plan with version `plan_version` or `None` if it wasn't computed.
+        """
+        # (str, int) -> ({str: float or str} or None)
+        (table_version, diagnoses) = self._table
+        diagnosis = None
+        if table_version == plan_version:
+            diagnosis = diagnoses.get(line_name)
+        if diagnosis is None:
+            self.metrics.misses += 1
+        else:
+            self.metrics.hits += 1
+        return diagnosis
+
+    def _work(self):
+        while True:
+            self._new_plan.wait()
+            self._new_plan.clear()
+            if self._stopped:
+                return
+            try:
+                incidence = get_pf_line_incidence()
+                diagnoses = dict()
+                for line in incidence.plan.lines:
+                    if self._new_plan.is_set():
+                        break  # Diagnosing this plan is useless now
+                    line_name = line.getName()
+                    diagnoses[line_name] = diagnose_line(line_name, incidence)
+                else:
+                    self._table = (incidence.plan_version, diagnoses)
+            except Exception as e:
+                print("Couldn't precompute the diagnoses of the lines: "+str(e))
+
+
+_precomputer = None
+
+def start_diagnosis_precomputation():
+    """
+    Starts diagnosing all the lines in the background each time a new plan is
+    published (does nothing if it was already started).
+    """
+    # () -> (DiagnosisPrecomputer)
+    global _precomputer
+    if _precomputer is None:
+        _precomputer = DiagnosisPrecomputer()
+        _precomputer.start()
+    return _precomputer
+def stop_diagnosis_precomputation():
+    """Stops diagnosing the lines in the background."""
+    global _precomputer
+    if _precomputer is not None:
+        _precomputer.stop()
+        _precomputer = None
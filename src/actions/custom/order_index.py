@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains an index of the orders of the current plan, used by the
+custom actions instead of going through all the orders with the planning API
+for each user question.
+The characteristics of the orders are stored in columns (NumPy arrays), built
+once per plan version, so that filtering and counting orders are vectorized
+operations.
+"""
+
+import numpy as np
+
+from bot.actions.custom.plan_snapshot import get_plan_data
+
+import Phi
+
+
+def get_order_index(plan_version=None):
+    """
+    Returns the index of the orders of the current plan,
+    building it if the plan changed since it was last built
+    (cf. `get_plan_data` for `plan_version`).
+    """
+    # (int) -> (OrderIndex)
+    return get_plan_data("orders", OrderIndex, plan_version)
+
+
+class OrderIndex(object):
+    """
+    The orders of the plan with version `plan_version`, stored as columns with
+    one row per order (in the order of the API):
+        - `names`: the names of the orders
+        - `lateness`: the number of planned buckets of lateness
+        - `late`/`on_time`: whether the orders are planned late or on time
+        - `forbidden`: whether the orders are forbidden
+        - `completion_dates`/`due_dates`: the dates as returned by the API
+        - `planned`: whether the orders are completed before the horizon date
+          (i.e. the end date of the last time bucket)
+        - `product_family_codes`: the index of the final product family of
+          the orders in `product_families` (-1 if they don't have one)
+    An order index is immutable and can thus be shared by all the
+    conversations.
+    """
+    def __init__(self, plan_version):
+        # (int) -> ()
+        self.plan_version = plan_version
+        self.nb_orders = Phi.getNumOrders()
+        nb_buckets = Phi.getNumberOfTimeBuckets()
+        self.horizon_date = None
+        if nb_buckets > 0:
+            self.horizon_date = Phi.getTimeBucket(nb_buckets-1).getEndDate()
+
+        self.names = []
+        self.lateness = np.zeros(self.nb_orders, dtype=np.int64)
+        self.forbidden = np.zeros(self.nb_orders, dtype=bool)
+        self.completion_dates = np.empty(self.nb_orders, dtype=object)
+        self.due_dates = np.empty(self.nb_orders, dtype=object)
+        self.planned = np.zeros(self.nb_orders, dtype=bool)
+        self.product_families = []  # [Phi.ProductFamily]
+        self.product_family_codes = np.full(self.nb_orders, -1, dtype=np.int64)
+        self.some_due_after_horizon = False  # Is an order due after the horizon date?
+
+        product_families_codes = dict()
+        for i in range(self.nb_orders):
+            order = Phi.getOrder(i)
+            self.names.append(order.getName())
+            self.lateness[i] = order.getPlannedBucketsOfLateness()
+            self.forbidden[i] = order.isForbidden()
+            completion_date = order.getCompletionDate()
+            self.completion_dates[i] = completion_date
+            self.planned[i] = (completion_date < self.horizon_date)  # QUESTION: should the horizon date be included?
+            due_date = order.getDueDate()
+            self.due_dates[i] = due_date
+            if due_date is not None and due_date > self.horizon_date:
+                self.some_due_after_horizon = True
+            product_family = order.getFinalPF()  # QUESTION: what to do if this returns `None`?
+            if product_family is not None:
+                if product_family not in product_families_codes:
+                    product_families_codes[product_family] = \
+                        len(self.product_families)
+                    self.product_families.append(product_family)
+                self.product_family_codes[i] = \
+                    product_families_codes[product_family]
+
+        self.late = self.lateness > 0
+        self.on_time = ~self.late
+        self.unplanned = ~self.planned
+        self.nb_forbidden = int(np.count_nonzero(self.forbidden))
+        self.nb_planned = int(np.count_nonzero(self.planned))
+
+    @staticmethod
+    def count(mask):
+        """Returns the number of orders selected by the boolean array `mask`."""
+        # (np.ndarray) -> (int)
+        return int(np.count_nonzero(mask))
+
+    def get_first_names(self, mask, nb_names):
+        """
+        Returns the names of the (at most) `nb_names` first orders selected by
+        the boolean array `mask`.
+        """
+        # (np.ndarray, int) -> ([str])
+        return [self.names[i] for i in np.flatnonzero(mask)[:nb_names]]
+
+    def get_product_families_codes(self, mask):
+        """
+        Returns the (sorted) codes of the distinct final product families of the
+        orders selected by the boolean array `mask`, ignoring orders without a
+        final product family.
+        """
+        # (np.ndarray) -> (np.ndarray)
+        codes = np.unique(self.product_family_codes[mask])
+        return codes[codes >= 0]
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains an index of which (final) product families of the orders
+go through which production lines in the current plan. It is used to find out
+which lines prevent unplanned orders from being planned without querying the
+planning API for each pair of line and order.
+"""
+
+import numpy as np
+
+from bot.actions.custom.plan_snapshot import get_plan_data, get_plan_snapshot
+from bot.actions.custom.order_index import get_order_index
+
+
+def get_pf_line_incidence():
+    """
+    Returns the product family/line incidence index of the current plan,
+    building it if the plan changed since it was last built.
+    """
+    # () -> (ProductFamilyLineIncidence)
+    return get_plan_data("pf-line-incidence", ProductFamilyLineIncidence)
+
+
+class ProductFamilyLineIncidence(object):
+    """
+    Boolean matrix `uses` with one row per product family (indexed by their
+    codes in the order index) and one column per line (indexed as in the plan
+    snapshot), telling whether a product family uses a line.
+    `saturated_lines` tells for each line whether it is saturated.
+    The plan snapshot and the order index it was built from (of the same plan
+    version) are kept as `plan` and `orders`.
+    An incidence index is immutable and can thus be shared by all the
+    conversations.
+    """
+    def __init__(self, plan_version):
+        # (int) -> ()
+        self.plan_version = plan_version
+        plan = get_plan_snapshot(plan_version)
+        orders = get_order_index(plan_version)
+        self.plan = plan
+        self.orders = orders
+        self.uses = np.zeros((len(orders.product_families), len(plan.lines)),
+                             dtype=bool)
+        for (pf_code, product_family) in enumerate(orders.product_families):
+            for (line_index, line) in enumerate(plan.lines):
+                self.uses[pf_code, line_index] = \
+                    (line.isPFUsed(product_family) != 0)
+        self.saturated_lines = plan.saturated_lines
+
+    def is_line_used_by_any(self, line_index, pf_codes):
+        """
+        Returns `True` if at least one of the product families whose codes are
+        in `pf_codes` uses the line `line_index`.
+        """
+        # (int, np.ndarray) -> (bool)
+        return bool(self.uses[pf_codes, line_index].any())
+
+    def get_blocking_saturated_lines(self, line_index, pf_codes):
+        """
+        Returns the indices of the saturated lines (other than `line_index`)
+        that are used by at least one of the product families whose codes are
+        in `pf_codes` and that also use the line `line_index`.
+        """
+        # (int, np.ndarray) -> (np.ndarray)
+        pf_codes_through_line = pf_codes[self.uses[pf_codes, line_index]]
+        blocking_lines = self.uses[pf_codes_through_line].any(axis=0) \
+                         & self.saturated_lines
+        blocking_lines[line_index] = False
+        return np.flatnonzero(blocking_lines)
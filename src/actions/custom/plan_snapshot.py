@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a snapshot of the current plan, used by the custom actions
+instead of querying the planning API bucket by bucket for each user question.
+The snapshot pulls the utilization of all the lines for all the time buckets
+into a NumPy matrix once per plan version and answers questions about it with
+vectorized reductions.
+The planner (or whatever gets notified of new solutions) must call
+`publish_new_plan` whenever a new plan is published, which invalidates
+everything that was computed from the previous plan (cf. `get_plan_data`).
+"""
+
+import threading
+
+import numpy as np
+
+import Phi
+
+
+# Utilizations (ratios) this close to 1 are considered as saturating a line
+SATURATION_TOLERANCE = 1e-3
+
+_plan_version = 0
+_plan_data = dict()  # name -> data built from the plan (with a `plan_version` attribute)
+_plan_lock = threading.RLock()  # Reentrant as some data is built from other data
+_plan_listeners = []
+
+
+def get_plan_version():
+    """Returns the version of the plan currently published by the planner."""
+    # () -> (int)
+    return _plan_version
+
+def publish_new_plan():
+    """
+    Informs the bot that the planner published a new plan: all data
+    computed from the previous plan is invalidated and the plan listeners
+    are notified. Returns the new plan version.
+    """
+    # () -> (int)
+    global _plan_version
+    with _plan_lock:
+        _plan_version += 1
+        plan_version = _plan_version
+    for listener in list(_plan_listeners):
+        listener(plan_version)
+    return plan_version
+
+def add_plan_listener(listener):
+    """
+    Registers `listener`, which will be called with the new plan version
+    each time a new plan is published.
+    """
+    # ((int) -> ()) -> ()
+    _plan_listeners.append(listener)
+def remove_plan_listener(listener):
+    if listener in _plan_listeners:
+        _plan_listeners.remove(listener)
+
+def get_plan_data(name, build, plan_version=None):
+    """
+    Returns the data named `name` computed from the current plan, building it
+    with `build(plan_version)` if it doesn't exist yet or if it was computed
+    from a previous plan. The built object must have a `plan_version`
+    attribute.
+    If `plan_version` is given, raises a `RuntimeError` if the current plan
+    has another version. This can't happen while building data from the plan
+    (i.e. within `build`), as publishing a new plan waits for the builds.
+    """
+    # (str, (int) -> (anything), int) -> (anything)
+    data = _plan_data.get(name)
+    if data is None or data.plan_version != _plan_version:
+        with _plan_lock:
+            data = _plan_data.get(name)
+            if data is None or data.plan_version != _plan_version:
+                data = build(_plan_version)
+                _plan_data[name] = data
+    if plan_version is not None and data.plan_version != plan_version:
+        raise RuntimeError("Tried to get the data '"+name+"' of the plan "+
+                           "version "+str(plan_version)+" while the current "+
+                           "plan has version "+str(data.plan_version)+".")
+    return data
+
+def get_plan_snapshot(plan_version=None):
+    """
+    Returns the snapshot of the current plan,
+    building it if the plan changed since the last snapshot was taken
+    (cf. `get_plan_data` for `plan_version`).
+    """
+    # (int) -> (PlanSnapshot)
+    return get_plan_data("snapshot", PlanSnapshot, plan_version)
+
+
+class PlanSnapshot(object):
+    """
+    Utilization of every line during every time bucket of the plan with
+    version `plan_version`, stored as a matrix with one row per line and one
+    column per time bucket. Per-line aggregates are computed once when the
+    snapshot is taken.
+    Per-line prefix sums of the utilization and of the number of busy buckets
+    are also computed, so that aggregates over any range of time buckets are
+    answered in constant time. Ranges of time buckets are given as the index
+    of their first bucket (included) and of their last bucket (excluded),
+    the first bucket having index 0; they default to the whole plan.
+    A snapshot is immutable and can thus be shared by all the conversations.
+    """
+    def __init__(self, plan_version):
+        # (int) -> ()
+        self.plan_version = plan_version
+        self.nb_buckets = Phi.getNumberOfTimeBuckets()
+        buckets = [Phi.getTimeBucket(i) for i in range(self.nb_buckets)]
+
+        nb_lines = Phi.getNumberOfLines()
+        self.lines = []  # [Phi.Line]
+        self.line_indices_by_name = dict()
+        rows = []
+        for i in range(nb_lines):
+            line = Phi.getLine(i)
+            if line is None:
+                continue
+            self.line_indices_by_name[line.getName()] = len(self.lines)
+            self.lines.append(line)
+            rows.append([line.getUtilisation(bucket) for bucket in buckets])
+        self.utilization = np.array(rows, dtype=np.float64) \
+                             .reshape((len(self.lines), self.nb_buckets))
+
+        # Prefix sums: column `i` is the sum over the buckets before bucket `i`
+        self.cumulative_utilization = \
+            np.zeros((len(self.lines), self.nb_buckets+1), dtype=np.float64)
+        np.cumsum(self.utilization, axis=1,
+                  out=self.cumulative_utilization[:, 1:])
+        self.cumulative_busy_buckets = \
+            np.zeros((len(self.lines), self.nb_buckets+1), dtype=np.int64)
+        np.cumsum(self.utilization > 0.0, axis=1,
+                  out=self.cumulative_busy_buckets[:, 1:])
+
+        self.utilization_sums = self.cumulative_utilization[:, -1]
+        if self.nb_buckets > 0:
+            mean_utilization = self.utilization_sums/float(self.nb_buckets)
+        else:
+            mean_utilization = np.zeros(len(self.lines))
+        self.saturated_lines = np.abs(mean_utilization-1.0) <= SATURATION_TOLERANCE
+
+    def get_line_index(self, line):
+        """
+        Returns the index of the row of `line` in the snapshot
+        or `None` if the line is not part of the plan.
+        """
+        # (Phi.Line) -> (int or None)
+        return self.line_indices_by_name.get(line.getName())
+
+    def get_utilization_sum(self, line_index, first_bucket=0, last_bucket=None):
+        """
+        Returns the sum of the utilizations of a line over a range of
+        time buckets.
+        """
+        # (int, int, int) -> (float)
+        if last_bucket is None:
+            last_bucket = self.nb_buckets
+        return float(  self.cumulative_utilization[line_index, last_bucket]
+                     - self.cumulative_utilization[line_index, first_bucket])
+    def get_utilization_percentage(self, line_index, first_bucket=0,
+                                   last_bucket=None):
+        """
+        Returns the mean utilization of a line over a range of time buckets
+        as a percentage.
+        """
+        # (int, int, int) -> (float)
+        if last_bucket is None:
+            last_bucket = self.nb_buckets
+        if last_bucket <= first_bucket:
+            return 0.0
+        return 100.0 * self.get_utilization_sum(line_index, first_bucket,
+                                                last_bucket) \
+               / (last_bucket-first_bucket)
+    def get_nb_busy_buckets(self, line_index, first_bucket=0, last_bucket=None):
+        """
+        Returns the number of time buckets during which a line is used
+        in a range of time buckets.
+        """
+        # (int, int, int) -> (int)
+        if last_bucket is None:
+            last_bucket = self.nb_buckets
+        return int(  self.cumulative_busy_buckets[line_index, last_bucket]
+                   - self.cumulative_busy_buckets[line_index, first_bucket])
+
+    def is_line_saturated(self, line_index):
+        """Returns `True` if a line is used at full capacity during the whole plan."""
+        # (int) -> (bool)
+        return bool(self.saturated_lines[line_index])
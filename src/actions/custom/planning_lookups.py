@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the caches that sit in front of the planning API for the
+custom actions:
+    - a `LookupScope` deduplicates the identical lookups made while handling
+      one turn of a conversation (e.g. finding the same line when checking
+      whether a slot needs a promotion and when running the action);
+    - a cache shared by all the conversations keeps the results that don't
+      depend on the conversation (resolution of line names and per-line
+      aggregates), keyed by plan version so that they are never used once a
+      new plan is published.
+"""
+
+import threading
+
+from bot.caching import LRUCache, CacheMetrics
+import bot.config as cfg
+from bot.actions.custom.plan_snapshot import get_plan_version, get_plan_snapshot
+
+import Phi
+
+
+_shared_lookups = LRUCache(max_entries=cfg.SHARED_LOOKUPS_MAX_ENTRIES,
+                           ttl=cfg.SHARED_LOOKUPS_TTL)
+_turn_metrics = CacheMetrics()  # of all the scopes, which may be in different threads
+_turn_metrics_lock = threading.Lock()
+
+
+def get_lookups_metrics():
+    """
+    Returns the metrics of the per-turn deduplication ("turn")
+    and of the cache shared by all conversations ("shared").
+    """
+    # () -> ({str: {str: int or float}})
+    with _turn_metrics_lock:
+        turn_metrics = _turn_metrics.as_dict()
+    return {"turn": turn_metrics,
+            "shared": _shared_lookups.metrics.as_dict()}
+
+def clear_shared_lookups():
+    """Drops everything from the cache shared by all conversations."""
+    _shared_lookups.clear()
+
+
+class LookupScope(object):
+    """
+    Memoizes the planning API lookups made while handling a single turn.
+    Custom actions are created for a single turn, hence each of them can
+    simply use its own scope.
+    All the lookups of a scope are made on the plan that was current when the
+    scope was created, and the results computed from the plan snapshot on
+    the snapshot of the scope (cf. `get_plan_snapshot`), keyed by its version.
+    """
+    def __init__(self):
+        self.plan_version = get_plan_version()
+        self._plan = None
+        self._results = dict()
+
+    def get_plan_snapshot(self):
+        """
+        Returns the plan snapshot used by the lookups of this scope
+        (the current one when this is first called).
+        """
+        # () -> (PlanSnapshot)
+        if self._plan is None:
+            self._plan = get_plan_snapshot()
+        return self._plan
+
+    def lookup(self, key, compute, shared=False):
+        """
+        Returns the result of the lookup identified by the tuple `key`,
+        computing it with `compute()` if it wasn't looked up yet during this
+        turn. If `shared` is `True`, the result is also looked up in (and
+        stored into) the cache shared by all conversations.
+        """
+        # ((anything,), () -> (anything), bool) -> (anything)
+        if key in self._results:
+            with _turn_metrics_lock:
+                _turn_metrics.hits += 1
+            return self._results[key]
+        with _turn_metrics_lock:
+            _turn_metrics.misses += 1
+        if shared:
+            result = _shared_lookups.get_or_compute((self.plan_version,)+key,
+                                                    compute)
+        else:
+            result = compute()
+        self._results[key] = result
+        return result
+
+    def find_line(self, line_name):
+        """
+        Same as `Phi.findLine(line_name)`: returns the line named `line_name`
+        or `None` if there is no such line.
+        """
+        # (str) -> (Phi.Line or None)
+        return self.lookup(("find-line", line_name),
+                           lambda: Phi.findLine(line_name), shared=True)
+
+    def get_line_aggregates(self, line_name):
+        """
+        Returns the aggregates of the line named `line_name` over the whole
+        plan or `None` if the line is not part of the plan:
+            - "line-index": the index of the line in the plan snapshot of
+              `self` (cf. `get_plan_snapshot`)
+            - "utilization-percentage": its mean utilization (in percents)
+            - "number-buckets-of-use": the number of buckets it is used in
+            - "saturated": whether it is saturated
+        """
+        # (str) -> ({str: int or float or bool} or None)
+        plan = self.get_plan_snapshot()
+        def compute_aggregates():
+            line = self.find_line(line_name)
+            if line is None:
+                return None
+            line_index = plan.get_line_index(line)
+            if line_index is None:
+                return None
+            return {
+                "line-index": line_index,
+                "utilization-percentage":
+                    plan.get_utilization_percentage(line_index),
+                "number-buckets-of-use": plan.get_nb_busy_buckets(line_index),
+                "saturated": plan.is_line_saturated(line_index),
+            }
+        return self.lookup(("line-aggregates", plan.plan_version, line_name),
+                           compute_aggregates, shared=True)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the generic caching facilities used throughout the bot:
+a thread-safe LRU cache with optional time-to-live, entry-count and memory
+budgets, and the helpers it needs (size estimation and hit/miss metrics), as
+well as the coalescing of identical concurrent computations ("single-flight").
+"""
+
+import sys
+import time
+import threading
+from collections import OrderedDict, deque
+
+
+def estimate_size(obj, _seen=None):
+    """
+    Returns a rough estimation of the memory used by `obj` in bytes,
+    following containers and the attributes of objects.
+    Objects that are reachable several times are only counted once.
+    """
+    # (anything) -> (int)
+    if _seen is None:
+        _seen = set()
+    obj_id = id(obj)
+    if obj_id in _seen:
+        return 0
+    _seen.add(obj_id)
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for (key, value) in obj.items():
+            size += estimate_size(key, _seen) + estimate_size(value, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        for item in obj:
+            size += estimate_size(item, _seen)
+    elif hasattr(obj, "__dict__"):
+        size += estimate_size(vars(obj), _seen)
+    elif hasattr(obj, "__slots__"):
+        for attr_name in obj.__slots__:
+            if hasattr(obj, attr_name):
+                size += estimate_size(getattr(obj, attr_name), _seen)
+    return size
+
+
+class CacheMetrics(object):
+    """Counts what happened in a cache (hits, misses, evictions, ...)."""
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def hit_rate(self):
+        """Returns the ratio of lookups that were hits (0 if no lookups)."""
+        # () -> (float)
+        nb_lookups = self.hits + self.misses
+        if nb_lookups <= 0:
+            return 0.0
+        return float(self.hits)/float(nb_lookups)
+
+    def as_dict(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "evictions": self.evictions, "expirations": self.expirations,
+                "hit-rate": self.hit_rate()}
+
+    def __str__(self):
+        return "<CacheMetrics: "+str(self.as_dict())+">"
+
+
+class LRUCache(object):
+    """
+    A thread-safe dict-like cache which evicts its least recently used entries
+    when it contains more than `max_entries` entries or when the estimated
+    size of its values exceeds `max_bytes` bytes.
+    Entries older than `ttl` seconds are considered expired and dropped.
+    Any of those limits can be `None`, in which case it is not enforced.
+    `on_evict` is called with the key and value of each entry that gets
+    evicted to respect the budgets (not for expired or explicitly
+    removed entries) and `on_expire` with those of each expired entry that
+    gets dropped.
+    """
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None,
+                 size_of=estimate_size, on_evict=None, clock=time.time,
+                 on_expire=None):
+        # (int, int, float, (anything) -> (int), (anything, anything) -> (), () -> (float), (anything, anything) -> ()) -> ()
+        if max_entries is not None and max_entries <= 0:
+            raise ValueError("Tried to create a cache with an invalid maximum "+
+                             "number of entries ("+str(max_entries)+").")
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError("Tried to create a cache with an invalid memory "+
+                             "budget ("+str(max_bytes)+" bytes).")
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._size_of = size_of
+        self._on_evict = on_evict
+        self._on_expire = on_expire
+        self._clock = clock
+
+        self._entries = OrderedDict()  # key -> (value, insertion time, size); least recently used first
+        self._nb_bytes = 0
+        self._lock = threading.RLock()
+        self.metrics = CacheMetrics()
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for `key` (marking it as recently used)
+        or `default` if there is none.
+        """
+        expired_value = _MISSING
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry):
+                expired_value = self._remove(key)
+                self.metrics.expirations += 1
+                entry = None
+            if entry is None:
+                self.metrics.misses += 1
+            else:
+                self.metrics.hits += 1
+                self._entries[key] = self._entries.pop(key)
+        if expired_value is not _MISSING and self._on_expire is not None:
+            self._on_expire(key, expired_value)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def put(self, key, value):
+        """Caches `value` for `key` and evicts entries if needed."""
+        size = 0
+        if self.max_bytes is not None:
+            size = self._size_of(value)
+        evicted = []
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, self._clock(), size)
+            self._nb_bytes += size
+            while (   (    self.max_entries is not None
+                       and len(self._entries) > self.max_entries)
+                   or (    self.max_bytes is not None
+                       and self._nb_bytes > self.max_bytes
+                       and len(self._entries) > 1)):
+                oldest_key = next(iter(self._entries))
+                evicted.append((oldest_key, self._remove(oldest_key)))
+                self.metrics.evictions += 1
+        if self._on_evict is not None:
+            for (evicted_key, evicted_value) in evicted:
+                self._on_evict(evicted_key, evicted_value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Returns the value cached for `key`, computing it with `compute()` and
+        caching it if there was none. `compute` is called outside of the lock,
+        hence several threads may compute the same missing value concurrently.
+        """
+        # (anything, () -> (anything)) -> (anything)
+        sentinel = _MISSING
+        value = self.get(key, sentinel)
+        if value is sentinel:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        """Removes the entry for `key` and returns its value (or `default`)."""
+        with self._lock:
+            if key not in self._entries:
+                return default
+            return self._remove(key)
+
+    def expire(self):
+        """Drops all the expired entries and returns how many there were."""
+        # () -> (int)
+        if self.ttl is None:
+            return 0
+        with self._lock:
+            expired_keys = [key for (key, entry) in self._entries.items()
+                            if self._is_expired(entry)]
+            expired = [(key, self._remove(key)) for key in expired_keys]
+            self.metrics.expirations += len(expired)
+        if self._on_expire is not None:
+            for (expired_key, expired_value) in expired:
+                self._on_expire(expired_key, expired_value)
+        return len(expired)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nb_bytes = 0
+
+    def keys(self):
+        """Returns the cached keys, from least to most recently used."""
+        with self._lock:
+            return list(self._entries.keys())
+    def items(self):
+        """
+        Returns the cached keys and values, from least to most recently used
+        (without marking them as used nor checking if they expired).
+        """
+        with self._lock:
+            return [(key, entry[0]) for (key, entry) in self._entries.items()]
+
+    @property
+    def nb_bytes(self):
+        """Estimated size of the cached values (0 if there is no memory budget)."""
+        return self._nb_bytes
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return (entry is not None and not self._is_expired(entry))
+    def __len__(self):
+        return len(self._entries)
+
+
+    def _is_expired(self, entry):
+        return (self.ttl is not None and self._clock() - entry[1] > self.ttl)
+    def _remove(self, key):
+        (value, _, size) = self._entries.pop(key)
+        self._nb_bytes -= size
+        return value
+
+
+_MISSING = object()
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls made for the same key: while a call for a key is
+    in flight, other calls for this key wait for it to finish and get its
+    result (or a new exception of the same type and with the same arguments as
+    its exception) instead of doing the computation again.
+    The result is not kept once the call finished (cf. `LRUCache` for that).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = dict()  # key -> _InFlightCall
+        self.nb_executed = 0
+        self.nb_coalesced = 0
+
+    def do(self, key, compute):
+        """
+        Returns `compute()`, or the result of the call for `key` that was
+        already in flight if there was one.
+        """
+        # (anything, () -> (anything)) -> (anything)
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = (call is None)
+            if is_leader:
+                call = _InFlightCall()
+                self._calls[key] = call
+                self.nb_executed += 1
+            else:
+                self.nb_coalesced += 1
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.make_error()
+            return call.result
+
+        try:
+            call.result = compute()
+        except Exception as e:
+            call.error = (type(e), e.args)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def as_dict(self):
+        return {"executed": self.nb_executed, "coalesced": self.nb_coalesced}
+
+class _InFlightCall(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None  # (type, arguments) of the exception of the call
+
+    def make_error(self):
+        """
+        Returns a new exception like the one the call raised, for a thread that
+        waited for it (sharing the instance would mix their tracebacks).
+        """
+        # () -> (Exception)
+        (error_type, error_args) = self.error
+        try:
+            return error_type(*error_args)
+        except Exception:  # the type can't be built from its arguments
+            return RuntimeError(error_type.__name__+": "+
+                                ", ".join(str(arg) for arg in error_args))
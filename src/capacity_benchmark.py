@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a benchmark of the capacity of the dialog manager, i.e. how
+many concurrent sessions (dialog managers and their contexts) fit in memory
+and what a turn allocates.
+Sessions are driven by synthetic conversations made from the goals, intents and
+slots descriptions (cf. `make_synthetic_conversation`), the planning API being
+simulated (cf. `phi_simulator.py`). Memory is measured with `tracemalloc`:
+    - the memory the sessions hold, once all their turns were handled;
+    - the memory allocated by a turn (still allocated at its end, i.e. the
+      actions and rendered messages included but not the temporary objects),
+      broken down by call site (cf. `get_call_sites`), and the peak memory of
+      a turn.
+The report is a dict that can be saved as JSON and compared to the report of
+a previous release (cf. `compare_capacity_reports`).
+
+Usage:
+    python -m bot.capacity_benchmark --sessions 1000 --output capacity.json
+"""
+
+import gc
+import copy
+import json
+import random
+import inspect
+import argparse
+import platform
+import tracemalloc
+
+from . import config as cfg
+from .phi_simulator import SimulatedPlan, install
+
+
+CAPACITY_REPORT_VERSION = 1
+OTHER_CALL_SITE = "other"
+
+
+#============= Synthetic conversations =============
+def make_synthetic_conversation(rng, uncertainty_ratio=0.2, typo_ratio=0.2):
+    """
+    Returns a conversation (a list of messages as given by the NLU) in which
+    the user asks for a random goal, gives some of its slots with the
+    triggering intent and informs the others afterwards. An entity is given
+    with a doubtful confidence (and confirmed by the next message) with a
+    probability `uncertainty_ratio`, and its value is misspelled (to be
+    corrected) with a probability `typo_ratio`.
+    """
+    # (random.Random, float, float) -> ([{str: anything}])
+    goals_descriptions = cfg.get_goals_descriptions()
+    intents_descriptions = cfg.get_intents_descriptions()
+    slots_descriptions = cfg.get_slots_descriptions()
+    goal_names = sorted(goal_name for goal_name in goals_descriptions
+                        if goals_descriptions[goal_name]["triggering-intent"] != "_init")
+    goal_description = goals_descriptions[rng.choice(goal_names)]
+    slots_to_fill = goal_description.get("slots-to-fill") or dict()
+    mandatory_slots = slots_to_fill.get("mandatory") or []
+    optional_slots = slots_to_fill.get("optional") or []
+
+    conversation = []
+    def add_message(intent_name, slot_names):
+        uncertain = (len(slot_names) > 0 and rng.random() < uncertainty_ratio)
+        entities = []
+        for (i, slot_name) in enumerate(slot_names):
+            confidence = rng.uniform(0.85, 1.0)
+            if uncertain and i == 0:
+                confidence = rng.uniform(0.55, 0.65)
+            entities.append(_make_entity(rng, slot_name,
+                                         slots_descriptions[slot_name],
+                                         confidence, typo_ratio))
+        conversation.append(_make_message(intent_name, rng.uniform(0.85, 1.0),
+                                          entities))
+        if uncertain:
+            conversation.append(_make_message(_find_confirming_intent(intents_descriptions),
+                                              rng.uniform(0.85, 1.0)))
+
+    given_slots = [slot_name for slot_name in mandatory_slots+optional_slots
+                   if rng.random() < 0.5]
+    add_message(goal_description["triggering-intent"], given_slots)
+    for slot_name in mandatory_slots:
+        if slot_name in given_slots:
+            continue
+        informing_intent = _find_informing_intent(intents_descriptions, slot_name)
+        if informing_intent is not None:
+            add_message(informing_intent, [slot_name])
+    return conversation
+
+def iter_synthetic_messages(rng, uncertainty_ratio=0.2, typo_ratio=0.2):
+    """Yields the messages of synthetic conversations, one after the other."""
+    # (random.Random, float, float) -> (generator of {str: anything})
+    while True:
+        for message in make_synthetic_conversation(rng, uncertainty_ratio,
+                                                   typo_ratio):
+            yield message
+
+def _make_message(intent_name, confidence, entities=None):
+    if entities is None:
+        entities = []
+    return {"intent": {"name": intent_name, "confidence": confidence},
+            "entities": entities,
+            "intent_ranking": [{"name": intent_name, "confidence": confidence}],
+            "text": ""}
+
+def _make_entity(rng, slot_name, slot_description, confidence, typo_ratio):
+    if len(slot_description["values"]) > 0:
+        value = str(rng.choice(slot_description["values"]))
+    elif slot_description["type"] == "bucket-range":
+        first_bucket = rng.randint(1, 40)
+        value = str(first_bucket)+"-"+str(first_bucket+rng.randint(0, 12))
+    else:
+        value = str(rng.randint(1, 10))
+    if rng.random() < typo_ratio:
+        try:
+            if slot_description["type"] == "percentage":
+                value = str(int(round(100*float(value))))+"%"
+        except ValueError:  # not a number (accepted as is)
+            pass
+        value = value.lower()
+    return {"entity": slot_name, "value": value, "confidence": confidence,
+            "start": 0, "end": len(value), "extractor": "synthetic"}
+
+def _find_informing_intent(intents_descriptions, slot_name):
+    for intent_name in sorted(intents_descriptions):
+        intent_description = intents_descriptions[intent_name]
+        if (    intent_description["category"] == "informing"
+            and slot_name in (intent_description.get("expected-entities") or [])):
+            return intent_name
+    return None
+
+def _find_confirming_intent(intents_descriptions):
+    for intent_name in sorted(intents_descriptions):
+        if intents_descriptions[intent_name].get("sub-category") == "confirm":
+            return intent_name
+    raise ValueError("No confirming intent is described.")
+
+
+#============= Call sites =============
+def get_call_sites():
+    """
+    Returns the call sites the allocations of a turn are attributed to, as
+    tuples (name, function, callee): an allocation is attributed to the
+    innermost call site it was made in, i.e. in `function` and, if `callee`
+    is not `None`, directly in a call to `callee` from `function`.
+    """
+    # () -> ([(str, function, function)])
+    from .DialogManager import DialogManager
+    from .dialog_management_components import Context
+    from .actions.Action import MsgTemplate
+    from . import entity_checker
+    return [
+        ("Context.__init__", Context.__init__, None),
+        ("deepcopy in DialogManager.pursue_goal", DialogManager.pursue_goal,
+         copy.deepcopy),
+        ("entity_checker._build_correct_entity",
+         entity_checker._build_correct_entity, None),
+        ("MsgTemplate.generate", MsgTemplate.generate, None),
+    ]
+
+class _CallSitesMatcher(object):
+    """Attributes the tracebacks of allocations to call sites (cf. above)."""
+    def __init__(self, call_sites):
+        # ([(str, function, function)]) -> ()
+        self.names = [name for (name, _, _) in call_sites]
+        self._sites = []  # (name, filename, first line, last line, callee filename)
+        for (name, function, callee) in call_sites:
+            (lines, first_line) = inspect.getsourcelines(function)
+            callee_filename = None
+            if callee is not None:
+                callee_filename = inspect.getsourcefile(callee)
+            self._sites.append((name, inspect.getsourcefile(function),
+                                first_line, first_line+len(lines)-1,
+                                callee_filename))
+        self._cache = dict()  # traceback -> name
+
+    def match(self, traceback):
+        # (tracemalloc.Traceback) -> (str)
+        name = self._cache.get(traceback)
+        if name is None:
+            name = self._match(traceback)
+            self._cache[traceback] = name
+        return name
+    def _match(self, traceback):
+        frames = list(traceback)  # from the oldest to the most recent
+        for i in range(len(frames)-1, -1, -1):
+            frame = frames[i]
+            for (name, filename, first_line, last_line,
+                 callee_filename) in self._sites:
+                if (   frame.filename != filename
+                    or frame.lineno < first_line or frame.lineno > last_line):
+                    continue
+                if callee_filename is None:
+                    return name
+                if i+1 < len(frames) and frames[i+1].filename == callee_filename:
+                    return name
+        return OTHER_CALL_SITE
+
+
+#============= Benchmark =============
+def run_capacity_benchmark(nb_sessions=1000, nb_turns_per_session=6,
+                           nb_profiled_turns=200, seed=0, traceback_depth=32,
+                           plan=None):
+    """
+    Runs the benchmark (cf. above) and returns its report.
+    `nb_sessions` sessions each handle `nb_turns_per_session` messages
+    (the turns of the sessions being interleaved) to measure the memory per
+    session, and `nb_profiled_turns` turns are profiled before that.
+    The planning API is simulated with `plan` (a default simulated plan
+    if it is `None`).
+    """
+    # (int, int, int, int, int, SimulatedPlan) -> ({str: anything})
+    if plan is None:
+        plan = SimulatedPlan(seed=seed)
+    install(plan)
+    from .DialogManager import DialogManager
+    from .streaming import render_actions
+    from .worker_pool import preload_configuration
+
+    preload_configuration()
+    rng = random.Random(seed)
+    matcher = _CallSitesMatcher(get_call_sites())
+
+    # Warm up (loads and caches everything that is shared by the sessions)
+    warm_up_sessions = [(DialogManager(), iter_synthetic_messages(rng))
+                        for _ in range(10)]
+    for _ in range(nb_turns_per_session):
+        for (dialog_manager, messages) in warm_up_sessions:
+            render_actions(dialog_manager.manage_user_msg(next(messages)))
+
+    tracemalloc.start(traceback_depth)
+    try:
+        # Allocations per turn
+        allocations = {name: {"bytes": 0, "count": 0}
+                       for name in matcher.names+[OTHER_CALL_SITE]}
+        total_peak = 0
+        for turn_index in range(nb_profiled_turns):
+            (dialog_manager, messages) = \
+                warm_up_sessions[turn_index % len(warm_up_sessions)]
+            message = next(messages)
+            before = _take_snapshot()
+            if hasattr(tracemalloc, "reset_peak"):  # Python >= 3.9
+                tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+            actions = dialog_manager.manage_user_msg(message)
+            msgs = render_actions(actions)
+            total_peak += tracemalloc.get_traced_memory()[1] - start_memory
+            after = _take_snapshot()
+            for stat in after.compare_to(before, "traceback"):
+                if stat.size_diff <= 0:
+                    continue
+                site_allocations = allocations[matcher.match(stat.traceback)]
+                site_allocations["bytes"] += stat.size_diff
+                site_allocations["count"] += max(0, stat.count_diff)
+            del actions, msgs, before, after
+        nb_profiled_turns = max(1, nb_profiled_turns)
+        allocations_per_turn = {
+            name: {"bytes": float(site_allocations["bytes"])/nb_profiled_turns,
+                   "count": float(site_allocations["count"])/nb_profiled_turns}
+            for (name, site_allocations) in allocations.items()
+        }
+
+        # Memory per session
+        gc.collect()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        sessions = [(DialogManager(), iter_synthetic_messages(rng))
+                    for _ in range(nb_sessions)]
+        for _ in range(nb_turns_per_session):
+            for (dialog_manager, messages) in sessions:
+                render_actions(dialog_manager.manage_user_msg(next(messages)))
+        gc.collect()
+        session_bytes = \
+            float(tracemalloc.get_traced_memory()[0] - start_memory)/max(1, nb_sessions)
+    finally:
+        tracemalloc.stop()
+
+    serialized_bytes = 0.0
+    if nb_sessions > 0:
+        serialized_bytes = \
+            sum(len(dialog_manager.get_serialized_context())
+                for (dialog_manager, _) in sessions)/float(nb_sessions)
+    return {
+        "version": CAPACITY_REPORT_VERSION,
+        "python": platform.python_version(),
+        "seed": seed,
+        "nb-sessions": nb_sessions,
+        "nb-turns-per-session": nb_turns_per_session,
+        "bytes-per-session": session_bytes,
+        "sessions-per-GB": (1024**3)/max(1.0, session_bytes),
+        "serialized-bytes-per-session": serialized_bytes,
+        "nb-profiled-turns": nb_profiled_turns,
+        "peak-bytes-per-turn": float(total_peak)/nb_profiled_turns,
+        "allocated-bytes-per-turn":
+            sum(site["bytes"] for site in allocations_per_turn.values()),
+        "allocations-per-turn": allocations_per_turn,
+    }
+
+def _take_snapshot():
+    snapshot = tracemalloc.take_snapshot()
+    return snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+
+def compare_capacity_reports(previous_report, report):
+    """
+    Returns the relative change (e.g. `0.1` for +10%) of each metric of
+    `report` from `previous_report` (`None` if it wasn't measured before).
+    """
+    # ({str: anything}, {str: anything}) -> ({str: float})
+    def relative_change(previous_value, value):
+        if previous_value is None or previous_value == 0:
+            return None
+        return (value - previous_value)/float(previous_value)
+
+    changes = dict()
+    for metric in ("bytes-per-session", "sessions-per-GB",
+                   "serialized-bytes-per-session", "peak-bytes-per-turn",
+                   "allocated-bytes-per-turn"):
+        changes[metric] = relative_change(previous_report.get(metric),
+                                          report[metric])
+    previous_allocations = previous_report.get("allocations-per-turn", dict())
+    for (name, site_allocations) in report["allocations-per-turn"].items():
+        previous_bytes = previous_allocations.get(name, dict()).get("bytes")
+        changes["allocations-per-turn/"+name] = \
+            relative_change(previous_bytes, site_allocations["bytes"])
+    return changes
+
+
+def print_capacity_report(report, changes=None):
+    # ({str: anything}, {str: float}) -> ()
+    if changes is None:
+        changes = dict()
+    def format_change(key):
+        change = changes.get(key)
+        if change is None:
+            return ""
+        return "  ({:+.1f}%)".format(100*change)
+
+    print("Capacity report (Python "+report["python"]+", "+
+          str(report["nb-sessions"])+" sessions of "+
+          str(report["nb-turns-per-session"])+" turns)")
+    for (label, key) in (("memory per session", "bytes-per-session"),
+                         ("serialized context", "serialized-bytes-per-session"),
+                         ("peak memory per turn", "peak-bytes-per-turn"),
+                         ("allocated per turn", "allocated-bytes-per-turn")):
+        print("  "+label+": "+"{:.0f}".format(report[key])+" B"+
+              format_change(key))
+    print("  sessions per GB: "+"{:.0f}".format(report["sessions-per-GB"])+
+          format_change("sessions-per-GB"))
+    print("  allocations per turn (over "+str(report["nb-profiled-turns"])+
+          " turns):")
+    allocations = report["allocations-per-turn"]
+    for name in sorted(allocations, key=lambda name: -allocations[name]["bytes"]):
+        print("    "+name+": "+"{:.0f}".format(allocations[name]["bytes"])+
+              " B in "+"{:.1f}".format(allocations[name]["count"])+" blocks"+
+              format_change("allocations-per-turn/"+name))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measures how many "+
+                                     "sessions fit in memory and what a turn "+
+                                     "allocates.")
+    parser.add_argument("--sessions", type=int, default=1000)
+    parser.add_argument("--turns-per-session", type=int, default=6)
+    parser.add_argument("--profiled-turns", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--depth", type=int, default=32,
+                        help="number of frames kept for each allocation")
+    parser.add_argument("--output", default=None,
+                        help="file to which the report is written (in JSON)")
+    parser.add_argument("--compare", default=None,
+                        help="report (in JSON) of a previous release to "+
+                             "compare to")
+    args = parser.parse_args()
+
+    report = run_capacity_benchmark(args.sessions, args.turns_per_session,
+                                    args.profiled_turns, args.seed, args.depth)
+    changes = None
+    if args.compare is not None:
+        with open(args.compare) as previous_file:
+            changes = compare_capacity_reports(json.load(previous_file), report)
+    print_capacity_report(report, changes)
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
@@ -76,23 +76,31 @@ def _load_slots_descriptions():
     and checks that it is well formatted.
     """
     global SLOTS_DESCRIPTIONS
-    with io.open(SLOTS_DESCRIPTIONS_FILEPATH, 'r') as f:
+    SLOTS_DESCRIPTIONS = parse_slots_descriptions(SLOTS_DESCRIPTIONS_FILEPATH)
+def parse_slots_descriptions(filepath):
+    """
+    Reads the slots descriptions file at `filepath`, checks that it is well
+    formatted and returns its content.
+    """
+    # (str) -> ({str: {"type": str, "values": [str]}})
+    with io.open(filepath, 'r') as f:
         tmp = yaml.load(f, Loader=yaml.BaseLoader)  # BaseLoader disables automatic casting
         for slot_name in tmp:
             tmp[slot_name]["name"] = slot_name
-        SLOTS_DESCRIPTIONS = cast_to_unicode(tmp)
+        slots_descriptions = cast_to_unicode(tmp)
     # Check the format
-    for slot_name in SLOTS_DESCRIPTIONS:
-        current_slot_desc = SLOTS_DESCRIPTIONS[slot_name]
+    for slot_name in slots_descriptions:
+        current_slot_desc = slots_descriptions[slot_name]
         if (   "type" not in current_slot_desc
             or "summary" not in current_slot_desc
             or "values" not in current_slot_desc
             or not isinstance(current_slot_desc["values"], list)):
                 raise SyntaxError("The file containing the slots descriptions ("+
-                                  SLOTS_DESCRIPTIONS_FILEPATH+") is proper YAML "+
+                                  filepath+") is proper YAML "+
                                   "but is incorrectly formatted: each slot name "+
                                   "must have a 'summary', a 'type' and "+
                                   "a list of values called 'values'.")
+    return slots_descriptions
 def get_slots_descriptions():
     """Loads the slots descriptions if needed and returns them"""
     # () -> ({str: {"type": str, "values": [str]}})
@@ -103,16 +111,23 @@ def get_slots_descriptions():
 def _load_slot_values_synonyms():
     """Loads the slot values synonyms from the Rasa NLU input data."""
     global SLOTS_SYNONYMS
-    with io.open(SLOTS_SYNONYMS_FILEPATH, 'r') as f:
+    SLOTS_SYNONYMS = parse_slot_values_synonyms(SLOTS_SYNONYMS_FILEPATH)
+def parse_slot_values_synonyms(filepath):
+    """
+    Reads the Rasa NLU input data at `filepath` and returns the slot values
+    synonyms it contains.
+    """
+    # (str) -> ({str: [str]})
+    with io.open(filepath, 'r') as f:
         tmp = json.load(f)
         if (   "rasa_nlu_data" not in tmp
             or "entity_synonyms" not in tmp["rasa_nlu_data"]):
             raise SyntaxError("The Rasa NLU data cannot be used by other parts "+
                               "of the bot because it isn't in the right data "+
                               "format (that for rasa NLU 0.13.1).")
-        SLOTS_SYNONYMS = {slot_syn["value"]: slot_syn["synonyms"]
-                          for slot_syn in tmp["rasa_nlu_data"]["entity_synonyms"]
-                          if len(slot_syn["synonyms"]) > 0}
+        return {slot_syn["value"]: slot_syn["synonyms"]
+                for slot_syn in tmp["rasa_nlu_data"]["entity_synonyms"]
+                if len(slot_syn["synonyms"]) > 0}
 def get_slots_values_synonyms():
     """
     Loads the slots synonyms from Rasa NLU input data if needed and
@@ -137,6 +152,18 @@ PARAMETRIZED_ACTIONS_NAMES = [REQUEST_CONFIRMATION_INTENT_ACTION_NAME,
                               ASK_SLOT_VAL_ACTION_NAME]
 SPECIAL_ACTIONS_NAMES = ["ask-rephrase", "ask-start-over"]
 
+# Results of the actions that declare their relevant slots (cf. `Action`)
+ACTIONS_RESULTS_CACHE_MAX_ENTRIES = 1024
+ACTIONS_RESULTS_CACHE_TTL = 5*60  # seconds
+# Messages generated from the templates (cf. `MsgTemplate.generate`)
+MEMOIZE_RENDERS = True
+RENDERS_CACHE_MAX_ENTRIES = 4096
+RENDERS_CACHE_MEMORY_BUDGET = 4*1024*1024  # bytes
+RENDERS_CACHE_MAX_MSG_LENGTH = 1024  # longer messages are not memoized
+# Lookups of the planning API shared by all the conversations (cf. `planning_lookups.py`)
+SHARED_LOOKUPS_MAX_ENTRIES = 4096
+SHARED_LOOKUPS_TTL = 15*60  # seconds
+
 #-------------- Goals --------------------
 GOALS_DESCRIPTIONS_FILEPATH = "../data/dialog/goals.yml"
 GOALS_DESCRIPTIONS = None
@@ -194,6 +221,12 @@ def get_custom_actions_module_path():
         _load_goals_descriptions()
     return CUSTOM_ACTIONS_MODULE_PATH
 
+# Goals the user interrupted, resumed once the interrupting goal is met
+# (cf. `DialogManager.switch_goal`)
+MAX_INTERRUPTED_GOALS = 3
+# Number of turns that can be undone (cf. `DialogManager.rollback_turn`)
+MAX_UNDOABLE_TURNS = 8
+
 ############# Utterance templates descriptions ##################
 UTTERANCES_TEMPLATES_DESCRIPTIONS_FILEPATH = \
     "../data/dialog/utterance-templates.yml"
@@ -205,13 +238,22 @@ def _load_utterances_templates():
     `UTTERANCES_TEMPLATES` and checks that it is well formatted.
     """
     global UTTERANCES_TEMPLATES
-    with io.open(UTTERANCES_TEMPLATES_DESCRIPTIONS_FILEPATH, 'r') as f:
-        UTTERANCES_TEMPLATES = cast_to_unicode(yaml.load(f, Loader=yaml.BaseLoader))  # BaseLoader disables automatic casting
+    UTTERANCES_TEMPLATES = \
+        parse_utterances_templates(UTTERANCES_TEMPLATES_DESCRIPTIONS_FILEPATH)
+def parse_utterances_templates(filepath):
+    """
+    Reads the utterances templates file at `filepath`, checks that it is well
+    formatted and returns its content.
+    """
+    # (str) -> ({str: [str]})
+    with io.open(filepath, 'r') as f:
+        utterances_templates = cast_to_unicode(yaml.load(f, Loader=yaml.BaseLoader))  # BaseLoader disables automatic casting
     # Check the format
-    for utterance_name in UTTERANCES_TEMPLATES:
-        if not isinstance(UTTERANCES_TEMPLATES[utterance_name], list):
+    for utterance_name in utterances_templates:
+        if not isinstance(utterances_templates[utterance_name], list):
             raise SyntaxError("The templates for utterance '"+utterance_name+
                               "' is not a list.")
+    return utterances_templates
 def get_utterances_templates():
     """Loads the utterances templates if needed and returns them."""
     # () -> ({str: [str]})
@@ -219,3 +261,46 @@ def get_utterances_templates():
     if UTTERANCES_TEMPLATES is None:
         _load_utterances_templates()
     return UTTERANCES_TEMPLATES
+
+############# Tenants ##################
+# Several clients (tenants) can be served by the same process. Each of them has
+# a folder named after its ID in `TENANTS_DIR_PATH`, containing its own slots
+# descriptions, NLU data (for the slot values synonyms) and utterance
+# templates. A tenant without one of those files uses the default one above.
+# Goals and intents descriptions are shared by all the tenants.
+TENANTS_DIR_PATH = "../data/dialog/tenants/"
+TENANT_SLOTS_DESCRIPTIONS_FILENAME = "slots-descriptions.yml"
+TENANT_SLOTS_SYNONYMS_FILENAME = "nlu-data.json"
+TENANT_UTTERANCES_TEMPLATES_FILENAME = "utterance-templates.yml"
+
+# Budgets of the tenants registry: idle tenants are unloaded when they are exceeded
+MAX_LOADED_TENANTS = 128
+TENANTS_MEMORY_BUDGET = 512*1024*1024  # bytes
+
+############### Sessions ##########################
+# Persistence of the contexts of the conversations (cf. `session_store.py`)
+SESSIONS_DB_FILEPATH = "../data/sessions.db"
+SESSIONS_WRITE_BATCH_SIZE = 64  # number of contexts written at once
+SESSIONS_FLUSH_INTERVAL = 1.0  # seconds (checked when a context is saved)
+# Sessions held in memory by each worker (cf. `session_manager.py`)
+SESSIONS_IDLE_TTL = 30*60  # seconds
+MAX_SESSIONS_PER_WORKER = 10000
+SESSIONS_MEMORY_BUDGET_PER_WORKER = 256*1024*1024  # bytes
+SESSIONS_EXPIRY_CHECK_INTERVAL = 60  # seconds
+SESSIONS_SIZE_ESTIMATE_INTERVAL = 16  # turns between two estimations of the size of a session
+# Trace log of the turns (cf. `trace_log.py`)
+TRACE_LOG_BATCH_SIZE = 256  # number of traces written at once
+TRACE_LOG_FLUSH_INTERVAL = 1.0  # seconds
+TRACE_LOG_MAX_PENDING = 10000  # traces waiting to be written (others are dropped)
+
+############### Serving ##########################
+NB_WORKERS = None  # number of worker processes (cf. `worker_pool.py`), `None` to use one per CPU
+# HTTP/WebSocket server (cf. `server.py`)
+SERVER_HOST = "127.0.0.1"
+SERVER_PORT = 8080
+MAX_PENDING_REQUESTS = 1024  # messages being handled at once (others are rejected)
+MAX_PENDING_REQUESTS_PER_SESSION = 8
+MAX_REQUEST_BYTES = 64*1024
+KEEP_ALIVE_TIMEOUT = 30  # seconds an idle HTTP connection is kept open
+REPLY_TIMEOUT = 30  # seconds
+SHUTDOWN_TIMEOUT = 10  # seconds given to the connections to finish when stopping
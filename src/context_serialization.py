@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the (de)serialization of conversation contexts, so that
+they can be stored outside of the process (cf. `session_store.py`) and a
+conversation can be continued by another worker or after a restart.
+A serialized context is made of a magic header, a format version (one byte)
+and the state of the context (cf. `Context.get_state`) along with the states
+of the interrupted contexts (from the top of the stack, cf. `ContextStack`),
+serialized with `marshal`, which is compact and much faster than pickling
+objects since the states only contain builtin types.
+Contexts serialized with the first version of the format (without the
+interrupted contexts) can still be deserialized.
+"""
+
+import struct
+import marshal
+
+from .dialog_management_components import Context, ContextStack
+
+
+CONTEXT_MAGIC = b"DLGC"
+CONTEXT_FORMAT_VERSION = 2
+_MARSHAL_VERSION = 2  # supported by all Python versions the bot runs on
+_HEADER = CONTEXT_MAGIC + struct.pack("B", CONTEXT_FORMAT_VERSION)
+_HEADER_LENGTH = len(_HEADER)
+
+
+def serialize_context(context, interrupted_contexts=None):
+    """
+    Returns the context `context` and the stack of interrupted contexts
+    `interrupted_contexts` serialized as bytes.
+    """
+    # (Context, ContextStack) -> (bytes)
+    interrupted_states = tuple(interrupted_context.get_state()
+                               for interrupted_context in interrupted_contexts or ())
+    return _HEADER + marshal.dumps((context.get_state(), interrupted_states),
+                                   _MARSHAL_VERSION)
+
+def deserialize_contexts(data, slots_descriptions=None):
+    """
+    Returns the context and the stack of interrupted contexts serialized in
+    `data`, whose slots are described by `slots_descriptions` (defaults to
+    the ones of the bot's configuration).
+    Raises a `ValueError` if `data` is not a serialized context or was
+    serialized with an unsupported version of the format.
+    """
+    # (bytes, {str: {"type": str, ...}}) -> ((Context, ContextStack))
+    if (   len(data) < _HEADER_LENGTH
+        or data[:len(CONTEXT_MAGIC)] != CONTEXT_MAGIC):
+        raise ValueError("Tried to deserialize data that is not a "+
+                         "serialized context.")
+    version = struct.unpack("B", data[len(CONTEXT_MAGIC):_HEADER_LENGTH])[0]
+    if version not in (1, CONTEXT_FORMAT_VERSION):
+        raise ValueError("Tried to deserialize a context serialized with an "+
+                         "unsupported version of the format ("+str(version)+
+                         ").")
+    try:
+        payload = marshal.loads(data[_HEADER_LENGTH:])
+    except (EOFError, TypeError) as e:
+        raise ValueError("Tried to deserialize a corrupted context: "+str(e))
+    if version == 1:
+        payload = (payload, ())
+    (state, interrupted_states) = payload
+    interrupted_contexts = None
+    for interrupted_state in reversed(interrupted_states):
+        interrupted_contexts = \
+            ContextStack(Context.from_state(interrupted_state,
+                                            slots_descriptions),
+                         interrupted_contexts)
+    return (Context.from_state(state, slots_descriptions), interrupted_contexts)
+
+def deserialize_context(data, slots_descriptions=None):
+    """
+    Returns the context serialized in `data` (without the interrupted
+    contexts, cf. `deserialize_contexts`).
+    """
+    # (bytes, {str: {"type": str, ...}}) -> (Context)
+    return deserialize_contexts(data, slots_descriptions)[0]
@@ -1,52 +1,108 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import sys
 from copy import deepcopy
 
 from . import config as cfg
+from .entity_checker import parse_bucket_range
 from .actions import Action as action, confirmation_requests as confirm, ActionAskSlotValue as ask
 
 
+def _parse_bool(value):
+    # (str) -> (bool)
+    if str(value).strip().lower() in ("true", "yes", "1"):
+        return True
+    if str(value).strip().lower() in ("false", "no", "0"):
+        return False
+    raise ValueError("Not a boolean: '"+str(value)+"'.")
+
+def _display_float(typed_value):
+    return "{:.1f}".format(typed_value)
+def _display_percentage(typed_value):
+    return "{:.1f}".format(100*typed_value)  # To display it in percents
+
+_text_type = str
+if sys.version_info[0] == 2:
+    _text_type = unicode
+
+# Slot type name -> (type (for warnings), parser of the values,
+#                    formatter of the parsed values or `None` to display the
+#                    values as they were given)
+SLOT_TYPES = {
+    "categorical": (_text_type, _text_type, None),
+    "integer": (int, int, None),
+    "float": (float, float, _display_float),
+    "percentage": (float, float, _display_percentage),  # TODO: there is a percentage that has value 'not fully' somewhere (it is kept as a `str`)
+    "bool": (bool, _parse_bool, None),
+    "bucket-range": (parse_bucket_range, parse_bucket_range, None),
+}
+
+
 class Slot(object):
-    """Represents a slot, with a type and a value (empty or not)"""
+    """
+    Represents a slot, with a type and a value (empty or not).
+    The value is kept as it was given (`value`, a `str`) and parsed once
+    according to the type of the slot when it is set (`typed_value`, `None`
+    if the value doesn't match the type). The form in which it is displayed
+    to the user is computed the first time it is needed.
+    """
+    __slots__ = ("name", "type_str", "type", "_parse", "_display",
+                 "value", "typed_value", "_display_value")
+
     def __init__(self, name, type):
         self.name = name
         self.type_str = type
-        if type == "categorical":
-            self.type = str
-            import sys
-            if sys.version_info[0] == 2:
-                self.type = unicode
-        elif type == "integer":
-            self.type = int
-        elif type == "float" or type == "percentage":  # TODO: there is a percentage that has value 'not fully' somewhere (that will crash everything)
-            self.type = float
-        elif type == "bool":
-            self.type = bool
-        else:
+        if type not in SLOT_TYPES:
             raise AttributeError("Unexpected slot type: "+str(type))
+        (self.type, self._parse, self._display) = SLOT_TYPES[type]
         self.value = None  # str
+        self.typed_value = None
+        self._display_value = None
 
-    def set(self, value):
-        # (str) -> ()
+    def set(self, value, warn=True):
+        """
+        Sets the value of the slot to `value`. If it doesn't match the type of
+        the slot, warns about it if `warn` is `True`.
+        """
+        # (str, bool) -> ()
+        # NOTE: using slot values is not a hard constraint (for example
+        #       'not 100%' could be logical in a percentage), hence the warning
+        #       rather than an exception. `self.value` is thus a `str`
+        #       (`unicode` in Python 2), and `self.typed_value` is `None`.
+        self.value = value
+        self.typed_value = None
+        self._display_value = None
+        if value is None:
+            return
         try:
-            # Check that the value is in a format that seems coherent with the announced type
-            # NOTE: the casted value is NOT used as the value since using slot
-            #       values is not a hard constraint (for example 'not 100%'
-            #       could be logical in a percentage), hence the warning.
-            #       `self.value` is thus a `str` (`unicode` in Python 2).
-            casted_value = self.type(value)
+            self.typed_value = self._parse(value)
         except ValueError:
-            import warnings
-            warnings.warn("Tried to set a slot of type "+self.type.__name__+
-                          " to a value of another type ('"+str(value)+"': "+
-                          type(value).__name__+")")
-        self.value = value
+            if warn:
+                import warnings
+                warnings.warn("Tried to set a slot of type "+self.type.__name__+
+                              " to a value of another type ('"+str(value)+"': "+
+                              type(value).__name__+")")
     def unset(self):
         self.value = None
+        self.typed_value = None
+        self._display_value = None
     def is_set(self):
         return (self.value is not None)
 
+    def get_display_value(self):
+        """
+        Returns the value as it should be displayed to the user
+        (`None` if the slot is not set).
+        """
+        # () -> (str)
+        if self._display_value is None and self.value is not None:
+            if self._display is None or self.typed_value is None:
+                self._display_value = str(self.value)
+            else:
+                self._display_value = self._display(self.typed_value)
+        return self._display_value
+
 
 class Goal(object):
     """
@@ -86,6 +142,8 @@ class Goal(object):
 
 
     def is_met(self, context):  # QUESTION: is this useful?
+        if context.current_goal is self:
+            return context.is_current_goal_met()
         for slot_name in self.mandatory_slots:
             if not context.is_set(slot_name):
                 return False
@@ -95,6 +153,8 @@ class Goal(object):
         """
         Upgrades a slot from optional to mandatory.
         If the slot wasn't optional, raises an `KeyError`.
+        NOTE: the slots of the current goal of a context must be promoted
+              through the context (cf. `Context.promote_slot`).
         """
         if slot_name not in self.optional_slots:
             raise KeyError("Tried to make mandatory a slot that was "+
@@ -128,26 +188,72 @@ class Goal(object):
         return goal_name in Goal.goals_descriptions
 
 
+def _get_goal_state(goal):
+    # (Goal) -> ((str, (str,), (str,)))
+    return (goal.name, tuple(goal.mandatory_slots), tuple(goal.optional_slots))
+def _make_goal_from_state(goal_state):
+    # ((str, (str,), (str,))) -> (Goal)
+    (name, mandatory_slots, optional_slots) = goal_state
+    goal = Goal(name)  # raises a `ValueError` if the goal doesn't exist anymore
+    goal.mandatory_slots = list(mandatory_slots)
+    goal.optional_slots = list(optional_slots)
+    return goal
+
+
+# Kinds of entries of the undo logs (cf. `Context.start_journaling`)
+_UNDO_CHECKPOINT = 0  # (kind, context, checkpoint)
+_UNDO_SLOT = 1  # (kind, slot, previous value)
+_UNDO_PROMOTION = 2  # (kind, goal, slot name, previous index in the optional slots)
+
+def undo_changes(undo_log):
+    """
+    Undoes the changes recorded in `undo_log` (cf. `Context.start_journaling`),
+    from the most recent one to the oldest, and empties it.
+    """
+    # ([tuple]) -> ()
+    for entry in reversed(undo_log):
+        if entry[0] == _UNDO_SLOT:
+            entry[1].set(entry[2], warn=False)
+        elif entry[0] == _UNDO_PROMOTION:
+            (_, goal, slot_name, index) = entry
+            goal.mandatory_slots.remove(slot_name)
+            goal.optional_slots.insert(index, slot_name)
+        else:
+            entry[1].restore_checkpoint(entry[2])
+    del undo_log[:]
+
+
 class Context(object):
     """
     Represents the current context of the dialog, i.e. which goal is currently
     being worked on, which slots are filled and their value and what kind of
     intent is expected in the next utterance of the user.
+    The mandatory slots of the current goal that are not set yet are tracked
+    as a bitmask (bit i being set iff the i-th mandatory slot is missing),
+    which is updated when a slot is set or unset, when a slot is promoted and
+    when the current goal changes, so that checking if the goal is met and
+    finding the next slot to ask for don't go through all the slots. Hence,
+    slots and goals must only be changed through the methods of the context.
+    The changes made to a context during a turn can be journaled to be undone
+    without copying the context (cf. `start_journaling` and `undo_changes`).
     """
     MAX_CONSECUTIVE_MISUNDERSTANDING_MSG = 3
     MAX_CONSECUTIVE_ASK_REPHRASE = 2
     MAX_CONSECUTIVE_ASK_CONFIRMATION = 1
 
-    def __init__(self, goal):
-        # (Goal) -> ()
-        self.current_goal = deepcopy(goal)
+    def __init__(self, goal, slots_descriptions=None):
+        # (Goal, {str: {"type": str, ...}}) -> ()
+        # NOTE: `slots_descriptions` are those of the tenant this conversation
+        #       belongs to (defaults to the ones of the bot's configuration).
         self.expected_replies = []  # contains a list of possible replies (broad: intent categories or precise: intent names)
 
         self.intents_descriptions = cfg.get_intents_descriptions()
-        slots_descriptions = cfg.get_slots_descriptions()
+        if slots_descriptions is None:
+            slots_descriptions = cfg.get_slots_descriptions()
         self.slots = {slot_name: Slot(slot_name,
                                       slots_descriptions[slot_name]["type"])
                       for slot_name in slots_descriptions}
+        self.current_goal = deepcopy(goal)  # needs the slots (cf. below)
 
         self._confirmation_request_count = 0
         self._rephrase_count = 0
@@ -156,17 +262,117 @@ class Context(object):
         self.potential_new_goal = None
         self.entity_pending_for_confirmation = None  # stores a dict: {"slot-name": str, "value": str}
 
+        self._undo_log = None  # cf. `start_journaling`
         self.init()
     def init(self):
         """Puts `self` in its initial state."""
         self.expected_replies = [{"category": "triggering"}]
 
+    def __getstate__(self):
+        # The undo log is not copied along with the context
+        state = dict(self.__dict__)
+        state["_undo_log"] = None
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    @property
+    def current_goal(self):
+        return self._current_goal
+    @current_goal.setter
+    def current_goal(self, goal):
+        # (Goal) -> ()
+        self._current_goal = goal
+        self._update_missing_mandatory_slots()
+
+    #========== State (cf. `context_serialization.py`) ===============
+    def get_state(self):
+        """
+        Returns the state of `self` as a tuple only made of builtin types:
+        (current goal, potential new goal, set slots, expected replies,
+        counters, entity pending for confirmation), where each goal is a
+        tuple (name, mandatory slots, optional slots) to keep the promotions
+        that were made.
+        """
+        # () -> (tuple)
+        potential_new_goal_state = None
+        if self.potential_new_goal is not None:
+            potential_new_goal_state = _get_goal_state(self.potential_new_goal)
+        pending_entity_state = None
+        if self.entity_pending_for_confirmation is not None:
+            pending_entity_state = \
+                (self.entity_pending_for_confirmation["slot-name"],
+                 self.entity_pending_for_confirmation["value"])
+        return (_get_goal_state(self.current_goal), potential_new_goal_state,
+                tuple((slot_name, slot.value)
+                      for (slot_name, slot) in self.slots.items()
+                      if slot.value is not None),
+                self.expected_replies,
+                (self._confirmation_request_count, self._rephrase_count,
+                 self._consecutive_misunderstanding_count),
+                pending_entity_state)
+
+    @classmethod
+    def from_state(cls, state, slots_descriptions=None):
+        """
+        Returns a context in the state `state` (as returned by `get_state`),
+        whose slots are described by `slots_descriptions`.
+        Raises a `ValueError` if the state references inexistant goals or
+        slots.
+        """
+        # (tuple, {str: {"type": str, ...}}) -> (Context)
+        (goal_state, potential_new_goal_state, slot_values, expected_replies,
+         counts, pending_entity_state) = state
+        context = cls.__new__(cls)
+        context.expected_replies = list(expected_replies)
+
+        context.intents_descriptions = cfg.get_intents_descriptions()
+        if slots_descriptions is None:
+            slots_descriptions = cfg.get_slots_descriptions()
+        context.slots = {slot_name: Slot(slot_name,
+                                         slots_descriptions[slot_name]["type"])
+                         for slot_name in slots_descriptions}
+        for (slot_name, value) in slot_values:
+            if slot_name not in context.slots:
+                raise ValueError("Tried to restore the value of a non-existing "+
+                                 "slot ("+slot_name+").")
+            context.slots[slot_name].set(value, warn=False)
+        context.current_goal = _make_goal_from_state(goal_state)  # needs the slots
+
+        (context._confirmation_request_count, context._rephrase_count,
+         context._consecutive_misunderstanding_count) = counts
+
+        context.potential_new_goal = None
+        if potential_new_goal_state is not None:
+            context.potential_new_goal = \
+                _make_goal_from_state(potential_new_goal_state)
+        context.entity_pending_for_confirmation = None
+        context._undo_log = None
+        if pending_entity_state is not None:
+            context.entity_pending_for_confirmation = \
+                {"slot-name": pending_entity_state[0],
+                 "value": pending_entity_state[1]}
+        return context
+
     #========== Slot related methods ===============
     def set_slot(self, slot_name, value):
         if slot_name not in self.slots:
             raise ValueError("Tried to set the value of a non-existing slot ("+
                              slot_name+").")
-        self.slots[slot_name].set(value)
+        slot = self.slots[slot_name]
+        if self._undo_log is not None:
+            self._undo_log.append((_UNDO_SLOT, slot, slot.value))
+        slot.set(value)
+        self._update_missing_mandatory_slot(slot_name)
+    def unset_slot(self, slot_name):
+        if slot_name not in self.slots:
+            raise ValueError("Tried to unset a non-existing slot ("+
+                             slot_name+").")
+        slot = self.slots[slot_name]
+        if self._undo_log is not None:
+            self._undo_log.append((_UNDO_SLOT, slot, slot.value))
+        slot.unset()
+        self._update_missing_mandatory_slot(slot_name)
     def is_set(self, slot_name):
         if slot_name not in self.slots:
             raise ValueError("Tried to get the state of a non-existing slot ("+
@@ -177,21 +383,53 @@ class Context(object):
             raise ValueError("Tried to get the value of a non-existing slot ("+
                              slot_name+").")
         return self.slots[slot_name].value
+    def get_typed_slot_value(self, slot_name):
+        """
+        Returns the value of the slot `slot_name` parsed according to its type
+        (`None` if it is not set or if its value doesn't match its type).
+        """
+        if slot_name not in self.slots:
+            raise ValueError("Tried to get the value of a non-existing slot ("+
+                             slot_name+").")
+        return self.slots[slot_name].typed_value
     def reset_slots(self):
-        slots_descriptions = cfg.get_slots_descriptions()
-        self.slots = {slot_name: Slot(slot_name,
-                                      slots_descriptions[slot_name]["type"])
-                      for slot_name in slots_descriptions}
+        self.slots = {slot_name: Slot(slot_name, self.slots[slot_name].type_str)
+                      for slot_name in self.slots}
+        self._update_missing_mandatory_slots()
 
     def get_lacking_slot_names(self):
         """
-        Returns the name of an empty mandatory slot in the current goal
+        Returns the name of the first empty mandatory slot in the current goal
         or `None` if there was none.
         """
-        for slot_name in self.current_goal.mandatory_slots:
-            if not self.is_set(slot_name):
-                return slot_name
-        return None
+        missing_mask = self._missing_mandatory_mask
+        if missing_mask == 0:
+            return None
+        first_missing_index = (missing_mask & -missing_mask).bit_length() - 1
+        return self._current_goal.mandatory_slots[first_missing_index]
+    def is_current_goal_met(self):
+        """Returns `True` iff all the mandatory slots of the current goal are set."""
+        return (self._missing_mandatory_mask == 0)
+
+    def _update_missing_mandatory_slots(self):
+        """Recomputes the missing mandatory slots of the current goal."""
+        self._mandatory_slots_bits = dict()  # slot name -> bit(s) in the mask
+        self._missing_mandatory_mask = 0
+        for (index, slot_name) in enumerate(self._current_goal.mandatory_slots):
+            self._add_mandatory_slot_bit(slot_name, 1 << index)
+    def _add_mandatory_slot_bit(self, slot_name, bit):
+        self._mandatory_slots_bits[slot_name] = \
+            self._mandatory_slots_bits.get(slot_name, 0) | bit
+        if not self.is_set(slot_name):
+            self._missing_mandatory_mask |= bit
+    def _update_missing_mandatory_slot(self, slot_name):
+        bits = self._mandatory_slots_bits.get(slot_name)
+        if bits is None:  # not mandatory
+            return
+        if self.slots[slot_name].is_set():
+            self._missing_mandatory_mask &= ~bits
+        else:
+            self._missing_mandatory_mask |= bits
 
     def promote_slot(self, slot_name):
         """
@@ -202,11 +440,16 @@ class Context(object):
         if slot_name not in self.slots:
             raise KeyError("Tried to promote an inexistant slot from "+
                            "'optional' to 'mandatory' ('"+slot_name+"').")
-        try:
-            self.current_goal.make_mandatory(slot_name)
-            return True
-        except KeyError:
+        goal = self._current_goal
+        if slot_name not in goal.optional_slots:
             return False
+        if self._undo_log is not None:
+            self._undo_log.append((_UNDO_PROMOTION, goal, slot_name,
+                                   goal.optional_slots.index(slot_name)))
+        goal.make_mandatory(slot_name)
+        self._add_mandatory_slot_bit(slot_name,
+                                     1 << (len(self._current_goal.mandatory_slots)-1))
+        return True
 
     #========== Expected message related methods ============
     #---------- Type of message ------------
@@ -230,7 +473,7 @@ class Context(object):
         if not isinstance(expected_reply, dict):
             raise ValueError("Tried to add an illegal expected reply to "+
                              "the list: "+str(expected_reply))
-        self.expected_replies.append(expected_reply)
+        self.expected_replies = self.expected_replies + [expected_reply]  # never modified in place (cf. `get_checkpoint`)
 
     def is_expecting(self, intent_name):
         """Returns `True` if `intent_name` was expected in this context"""
@@ -301,6 +544,40 @@ class Context(object):
         """
         self.entity_pending_for_confirmation = None
 
+    #=========== Journaling of the changes ============
+    def start_journaling(self, undo_log):
+        """
+        Records in the list `undo_log` how to undo the changes that are made
+        to `self` from now on (cf. `undo_changes`). The log starts with a
+        checkpoint of `self` (cf. `get_checkpoint`): the other attributes are
+        never modified in place, only the slots and the promotions are
+        recorded one by one.
+        """
+        # ([tuple]) -> ()
+        self._undo_log = undo_log
+        undo_log.append((_UNDO_CHECKPOINT, self, self.get_checkpoint()))
+    def stop_journaling(self):
+        self._undo_log = None
+
+    def get_checkpoint(self):
+        """
+        Returns the references to what can change in `self` apart from the
+        values of the slots and the promotions (nothing is copied).
+        """
+        # () -> (tuple)
+        return (self._current_goal, self.slots, self.expected_replies,
+                self._confirmation_request_count, self._rephrase_count,
+                self._consecutive_misunderstanding_count,
+                self.potential_new_goal, self.entity_pending_for_confirmation)
+    def restore_checkpoint(self, checkpoint):
+        # (tuple) -> ()
+        (goal, self.slots, self.expected_replies,
+         self._confirmation_request_count, self._rephrase_count,
+         self._consecutive_misunderstanding_count,
+         self.potential_new_goal, self.entity_pending_for_confirmation) = \
+            checkpoint
+        self.current_goal = goal  # needs the slots
+
     #=========== Rephrasing permisions related methods ============
     def reset_counts(self):
         self._confirmation_request_count = 0
@@ -353,3 +630,33 @@ class Context(object):
         print("updated context: confcount: "+str(self._confirmation_request_count))
         print("\trephrase count: "+str(self._rephrase_count))
         print("\texpecting: "+str(self.expected_replies))
+
+
+class ContextStack(object):
+    """
+    A persistent stack of contexts: a stack is never modified, pushing a
+    context makes a new stack that shares the previous one (thus pushing and
+    popping never copy anything). The empty stack is `None`.
+    """
+    __slots__ = ("context", "below", "depth")
+
+    def __init__(self, context, below=None):
+        # (Context, ContextStack) -> ()
+        self.context = context
+        self.below = below
+        self.depth = 1
+        if below is not None:
+            self.depth += below.depth
+
+    def __iter__(self):
+        """Iterates over the contexts, from the top of the stack."""
+        stack = self
+        while stack is not None:
+            yield stack.context
+            stack = stack.below
+
+def get_stack_depth(stack):
+    # (ContextStack) -> (int)
+    if stack is None:
+        return 0
+    return stack.depth
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the policy of the dialog manager, i.e. how it decides what
+to answer to a message of the user (cf. `DialogManager.formulate_answer`).
+A policy is a transition table indexed by:
+    - whether the message was expected ("expected" or "unexpected");
+    - the confidence band of the understood intent ("confident", "doubtful"
+      or "not-understood", cf. the thresholds of `DialogManager`);
+    - the category of the intent ("triggering", "informing",
+      "confirmation-request-answer" or "other");
+    - whether a new goal is pending for confirmation ("new-goal" or "none").
+Each entry is a handler, i.e. a function that takes the dialog manager and the
+message and returns the actions to take. The table is compiled from a list of
+rules (in which any part of the key can be `ANY`) so that choosing the
+handler is a single dict lookup, and each entry counts how many times it was
+used (cf. `DialogPolicy.get_hits`).
+Other policies can be built from other rules and set on dialog managers
+(cf. `DialogManager.policy`) to be compared (cf. `compare_policies`).
+"""
+
+import time
+
+from utils import *
+from . import bot_utils
+
+
+EXPECTATIONS = ("expected", "unexpected")
+CONFIDENCE_BANDS = ("confident", "doubtful", "not-understood")
+INTENT_CATEGORIES = ("triggering", "informing", "confirmation-request-answer",
+                     "other")
+PENDING_STATES = ("new-goal", "none")
+ANY = None
+
+
+#=============== Handlers ====================
+def ask_rephrase(dialog_manager, message):
+    print("not understood")
+    return [dialog_manager.action_factory.new_utterance("ask-rephrase",
+                                                        dialog_manager.context)]
+
+def fill_slots_and_pursue_goal(dialog_manager, message):
+    """
+    Fills the slots with the entities of the message (asking for a
+    confirmation if one of them is unclear) and pursues the current goal.
+    """
+    slot_confirmation_request_action = \
+        dialog_manager.fill_slots(message, msg_was_expected=True)
+    if slot_confirmation_request_action is not None:
+        return [slot_confirmation_request_action]
+    return dialog_manager.pursue_goal()
+
+def change_goal(dialog_manager, message):
+    """
+    Switches to the goal triggered by the message (the current goal is
+    resumed once it is met if it was not met, cf. `DialogManager.switch_goal`).
+    """
+    next_goal = dialog_manager.goals_by_trigger[message.intent.name]
+    print("New goal: "+str(next_goal))
+    print("GOAL'S MANDATORY SLOTS: "+str(next_goal.mandatory_slots))
+    dialog_manager.switch_goal(next_goal)
+    return fill_slots_and_pursue_goal(dialog_manager, message)
+
+def ask_confirm_new_goal(dialog_manager, message):
+    """Asks whether the user really wants to switch to the triggered goal."""
+    print("potential new goal")
+    dialog_manager.context.set_potential_new_goal(
+        dialog_manager.goals_by_trigger[message.intent.name]
+    )
+    return ask_confirm_new_goal_again(dialog_manager, message)
+
+def ask_confirm_new_goal_again(dialog_manager, message):
+    return [dialog_manager.action_factory
+            .new_confirmation_request_utterance(message.intent.name,
+                                                dialog_manager.context)]
+
+def answer_new_goal_confirmation(dialog_manager, message):
+    """
+    The user confirmed or denied switching to the potential new goal.
+    If they denied, the turn in which the new goal was understood is rolled
+    back (cf. `DialogManager.rollback_potential_new_goal`) and, if the
+    current goal is met, gets back to the initial goal; otherwise continues
+    asking for info about the current goal.
+    """
+    if bot_utils.is_confirming(message.intent.name):
+        dialog_manager.switch_goal(dialog_manager.context.potential_new_goal)
+    else:
+        dialog_manager.rollback_potential_new_goal()
+        dialog_manager.context.discard_potential_new_goal()
+        if dialog_manager.context.current_goal.is_met(dialog_manager.context):
+            dialog_manager.reset()
+    return dialog_manager.pursue_goal()
+
+def answer_doubtful_new_goal_confirmation(dialog_manager, message):
+    """
+    Same as `answer_new_goal_confirmation`, but the potential new goal is not
+    discarded when the user denied (it will be asked again if the user
+    asks something unexpected).
+    """
+    if bot_utils.is_confirming(message.intent.name):
+        dialog_manager.switch_goal(dialog_manager.context.potential_new_goal)
+    elif dialog_manager.context.current_goal.is_met(dialog_manager.context):
+        dialog_manager.reset()
+    return dialog_manager.pursue_goal()
+
+def answer_entity_confirmation(dialog_manager, message):
+    """The user confirmed or denied the value of the entity pending for confirmation."""
+    if bot_utils.is_confirming(message.intent.name):
+        dialog_manager.context.pending_entity_confirmed()
+    else:
+        dialog_manager.context.discard_pending_entity()
+    return dialog_manager.pursue_goal()
+
+
+# The rules of the default policy, from the most to the least specific
+# (the first rule that matches a key is used for it)
+DEFAULT_RULES = [
+    (("expected", "confident", "triggering", ANY), change_goal),
+    (("expected", "confident", "informing", ANY), fill_slots_and_pursue_goal),
+    (("expected", "confident", "confirmation-request-answer", "new-goal"),
+     answer_new_goal_confirmation),
+    (("expected", "confident", "confirmation-request-answer", "none"),
+     answer_entity_confirmation),
+    (("expected", "doubtful", "triggering", ANY), ask_confirm_new_goal),
+    (("expected", "doubtful", "informing", ANY), fill_slots_and_pursue_goal),  # consider you understood well
+    (("expected", "doubtful", "confirmation-request-answer", "new-goal"),
+     answer_doubtful_new_goal_confirmation),
+    (("expected", "doubtful", "confirmation-request-answer", "none"),
+     answer_entity_confirmation),
+    (("unexpected", "confident", "triggering", ANY), ask_confirm_new_goal),
+    (("unexpected", "confident", ANY, "new-goal"), ask_confirm_new_goal_again),
+    (("unexpected", "confident", "informing", "none"),
+     fill_slots_and_pursue_goal),  # consider you understood well
+    ((ANY, ANY, ANY, ANY), ask_rephrase),  # TODO: should it do something else when unexpected and doubtful?
+]
+
+
+def compile_rules(rules):
+    """
+    Returns the transition table made from the rules `rules`
+    (cf. `DEFAULT_RULES`), which contains every possible key.
+    """
+    # ([((str,)*4, (DialogManager, NLUMessage) -> ([Action]))]) -> ({(str,)*4: handler})
+    transitions = dict()
+    for expectation in EXPECTATIONS:
+        for band in CONFIDENCE_BANDS:
+            for category in INTENT_CATEGORIES:
+                for pending_state in PENDING_STATES:
+                    key = (expectation, band, category, pending_state)
+                    for (pattern, handler) in rules:
+                        if all(part is ANY or part == key_part
+                               for (part, key_part) in zip(pattern, key)):
+                            transitions[key] = handler
+                            break
+                    else:
+                        raise ValueError("The rules of the policy don't "+
+                                         "say what to do for "+str(key)+".")
+    return transitions
+
+
+class DialogPolicy(object):
+    """A policy of the dialog manager (cf. above), built from `rules`."""
+    def __init__(self, name, rules):
+        # (str, [((str,)*4, handler)]) -> ()
+        self.name = name
+        self.transitions = compile_rules(rules)
+        self.hits = {key: 0 for key in self.transitions}
+
+    def get_key(self, dialog_manager, message):
+        """Returns the key of the transition to take for the message `message`."""
+        # (DialogManager, NLUMessage) -> ((str, str, str, str))
+        return self.get_key_and_confidence(dialog_manager, message)[0]
+    def get_key_and_confidence(self, dialog_manager, message):
+        """
+        Returns the key of the transition to take for the message `message`
+        and the final confidence in its intent.
+        """
+        # (DialogManager, NLUMessage) -> (((str, str, str, str), float))
+        intent_name = message.intent.name
+        confidence = dialog_manager.compute_final_confidence(message,
+                                                             intent_name)
+        printDBG("confidence: "+str(message.intent.confidence)+" -> "+
+                 str(confidence))
+        context = dialog_manager.context
+        if context.is_expecting(intent_name):
+            expectation = "expected"
+            hard_threshold = dialog_manager.EXPECTED_HARD_THRESHOLD
+            soft_threshold = dialog_manager.EXPECTED_SOFT_THRESHOLD
+        else:
+            expectation = "unexpected"
+            hard_threshold = dialog_manager.UNEXPECTED_HARD_THRESHOLD
+            soft_threshold = dialog_manager.UNEXPECTED_SOFT_THRESHOLD
+        if confidence > soft_threshold:
+            band = "confident"
+        elif confidence > hard_threshold:
+            band = "doubtful"
+        else:
+            band = "not-understood"
+        category = dialog_manager.intents_descriptions[intent_name]["category"]
+        if category not in INTENT_CATEGORIES:
+            category = "other"
+        pending_state = "none"
+        if context.potential_new_goal is not None:
+            pending_state = "new-goal"
+        return ((expectation, band, category, pending_state), confidence)
+
+    def decide(self, dialog_manager, message, trace=None):
+        """
+        Returns the actions to take in answer to the message `message`.
+        The final confidence and the transition are recorded in `trace`
+        if it is given (cf. `trace_log.py`).
+        """
+        # (DialogManager, NLUMessage, TurnTrace) -> ([Action])
+        (key, confidence) = self.get_key_and_confidence(dialog_manager, message)
+        print("transition: "+str(key))
+        self.hits[key] += 1
+        if trace is not None:
+            trace.final_confidence = confidence
+            trace.branch = key
+        return self.transitions[key](dialog_manager, message)
+
+    def get_hits(self):
+        """Returns how many times each transition was used (for the used ones)."""
+        # () -> ({str: int})
+        return {"/".join(key): nb_hits for (key, nb_hits) in self.hits.items()
+                if nb_hits > 0}
+    def reset_hits(self):
+        self.hits = {key: 0 for key in self.transitions}
+
+
+_default_policy = None
+
+def get_default_policy():
+    """Returns the default policy (shared by all the dialog managers)."""
+    # () -> (DialogPolicy)
+    global _default_policy
+    if _default_policy is None:
+        _default_policy = DialogPolicy("default", DEFAULT_RULES)
+    return _default_policy
+
+
+def compare_policies(policies, conversations, make_dialog_manager):
+    """
+    Runs each conversation of `conversations` (lists of messages) with each of
+    the policies `policies`, in dialog managers created by
+    `make_dialog_manager()`, and returns for each policy (by name) the time
+    it took to handle all the messages ("time", in seconds), the number of
+    messages ("nb-messages") and the hits of its transitions ("hits").
+    """
+    # ([DialogPolicy], [[NLUMessage or dict]], () -> (DialogManager)) -> ({str: {str: anything}})
+    reports = dict()
+    for policy in policies:
+        policy.reset_hits()
+        total_time = 0.0
+        nb_messages = 0
+        for conversation in conversations:
+            dialog_manager = make_dialog_manager()
+            dialog_manager.policy = policy
+            for message in conversation:
+                start_time = time.time()
+                dialog_manager.manage_user_msg(message)
+                total_time += time.time() - start_time
+                nb_messages += 1
+        reports[policy.name] = {"time": total_time, "nb-messages": nb_messages,
+                                "hits": policy.get_hits()}
+    return reports
+
@@ -3,15 +3,16 @@
 
 import io
 import yaml
-import copy
 import re
 
 from utils import *
 from . import config as cfg
+from .nlu_message import Entity
 
 
 regex_int = re.compile(r"[0-9]+")
 regex_float = re.compile(r"[0-9]+(\.[0-9]+)?")  # NOTE: finds percentages as well
+regex_bucket_range = re.compile(r"([0-9]+)(?:\s*(?:-|to|and|until)\s*([0-9]+))?")
 
 _MAX_EDIT_DISTANCE_FACTOR = 5.0*1/50.0
 # NOTE: two strings can be considered the same (typos)
@@ -19,22 +20,31 @@ _MAX_EDIT_DISTANCE_FACTOR = 5.0*1/50.0
 #       => Here we consider that you can add/remove a word or two and still have
 #          the same string.
 
-def check_entities_val(entities):
+def check_entities_val(entities, slots_descriptions=None,
+                       slot_values_synonyms=None):
     """
     Checks that the entities have a value that is
     in the list of accepted entities for the current client.
     Returns a list with only correct entity values. (TODO maybe just mark incorrect entities?)
+    `entities` are `Entity`s (dicts from the NLU are accepted as well).
+    `slots_descriptions` and `slot_values_synonyms` are those of the current
+    client and default to the ones of the bot's configuration.
     """
-    slots_descriptions = cfg.get_slots_descriptions()
-    slot_values_synonyms = cfg.get_slots_values_synonyms()
+    # ([Entity or {str: anything}], {str: {str: anything}}, {str: [str]}) -> ([Entity])
+    if slots_descriptions is None:
+        slots_descriptions = cfg.get_slots_descriptions()
+    if slot_values_synonyms is None:
+        slot_values_synonyms = cfg.get_slots_values_synonyms()
 
     correct_entities = []
     for entity in entities:
+        if not isinstance(entity, Entity):
+            entity = Entity.from_dict(entity)
         corrected = False
-        current_slot_name = entity["entity"]
-        current_str = entity["value"]
+        current_slot_name = entity.entity
+        current_str = entity.value
         if current_slot_name not in slots_descriptions:
-            raise ValueError("Unexpected entity type: "+str(entity["entity"]))
+            raise ValueError("Unexpected entity type: "+str(entity.entity))
 
         # Has the NLU module understood the entity correctly?
         if current_str.strip() in slots_descriptions[current_slot_name]:
@@ -98,6 +108,16 @@ def check_entities_val(entities):
                 corrected = True
             except (AttributeError, ValueError):
                 pass
+        elif slots_descriptions[current_slot_name]["type"] == "bucket-range":
+            try:
+                (first_bucket, last_bucket) = parse_bucket_range(current_str)
+                found_str = str(first_bucket)+"-"+str(last_bucket)
+                correct_entities.append(
+                    _build_correct_entity(entity, found_str, 0.08)
+                )
+                corrected = True
+            except ValueError:
+                pass
         if corrected:
             continue
 
@@ -132,13 +152,33 @@ def check_entities_val(entities):
     return correct_entities
 
 
+def parse_bucket_range(value):
+    """
+    Returns the range of time buckets described in the string `value`
+    (such as "10-20", "buckets 10 to 20" or "12") as a tuple of the numbers
+    of the first and last buckets (both included).
+    Raises a `ValueError` if `value` doesn't describe a valid range.
+    """
+    # (str) -> ((int, int))
+    match = regex_bucket_range.search(str(value))
+    if match is None:
+        raise ValueError("Couldn't find a range of time buckets in '"+
+                         str(value)+"'.")
+    first_bucket = int(match.group(1))
+    last_bucket = first_bucket
+    if match.group(2) is not None:
+        last_bucket = int(match.group(2))
+    if first_bucket > last_bucket:
+        raise ValueError("Invalid range of time buckets (the first bucket "+
+                         "comes after the last one): '"+str(value)+"'.")
+    return (first_bucket, last_bucket)
+
+
 def _build_correct_entity(entity, correct_val, confidence_drop=0.10):
-    printDBG("Correcting '"+entity["value"]+"' -> '"+correct_val+
+    # (Entity, str, float) -> (Entity)
+    printDBG("Correcting '"+entity.value+"' -> '"+correct_val+
              "' (confidence drop: "+str(confidence_drop)+")")
-    correct_entity = copy.deepcopy(entity)
-    correct_entity["value"] = correct_val
-    correct_entity["confidence"] -= confidence_drop
-    return correct_entity
+    return entity.corrected(correct_val, confidence_drop)
 
 
 def _levenshtein_edit_distance(s1, s2):
@@ -1,7 +1,30 @@
 #!/usr/bin/env python3
 
+import argparse
 import warnings
 
 
 if __name__ == "__main__":
-    warnings.warn("This library is not supposed to be run as is but to be used inside your projects.")
+    parser = argparse.ArgumentParser(description="Goal-based dialog manager.")
+    subparsers = parser.add_subparsers(dest="command")
+    serve_parser = subparsers.add_parser("serve", help="serve the bot over "+
+                                         "HTTP and WebSocket (cf. `server.py`)")
+    serve_parser.add_argument("--host", default=None)
+    serve_parser.add_argument("--port", type=int, default=None)
+    serve_parser.add_argument("--workers", type=int, default=None,
+                              help="number of worker processes")
+    serve_parser.add_argument("--sessions-db", default=None,
+                              help="SQLite database to which idle sessions "+
+                                   "are spilled (cf. `session_manager.py`)")
+    serve_parser.add_argument("--trace-log", default=None,
+                              help="file to which the turns are recorded, "+
+                                   "suffixed with the ID of each worker "+
+                                   "(cf. `trace_log.py`)")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        from bot.server import serve_forever
+        serve_forever(args.host, args.port, args.workers, args.sessions_db,
+                      args.trace_log)
+    else:
+        warnings.warn("This library is not supposed to be run as is but to be used inside your projects.")
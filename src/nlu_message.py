@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the representation of the messages of the user as they
+were understood by the NLU: an intent (with a ranking of the other possible
+intents) and entities.
+The NLU gives those messages as dicts (cf. http://rasa.com/docs/nlu/0.12.3/tutorial/):
+    {"intent": {"name": str, "confidence": float},
+     "entities": [{"entity": str, "value": str, "confidence": float, ...}],
+     "intent_ranking": [{"name": str, "confidence": float}],
+     "text": str}
+which can be converted with `NLUMessage.from_dict` or parsed directly from
+JSON with `NLUMessage.from_json`.
+"""
+
+import json
+
+
+class Entity(object):
+    """An entity found in a message (`entity` is the name of its slot)."""
+    __slots__ = ("entity", "value", "confidence", "start", "end", "extractor")
+
+    def __init__(self, entity, value, confidence, start=None, end=None,
+                 extractor=None):
+        # (str, str, float, int, int, str) -> ()
+        self.entity = entity
+        self.value = value
+        self.confidence = confidence
+        self.start = start
+        self.end = end
+        self.extractor = extractor
+
+    def corrected(self, value, confidence_drop):
+        """
+        Returns a copy of `self` with the value `value` and a confidence
+        lowered by `confidence_drop`.
+        """
+        # (str, float) -> (Entity)
+        return Entity(self.entity, value, self.confidence-confidence_drop,
+                      self.start, self.end, self.extractor)
+
+    @staticmethod
+    def from_dict(entity_dict):
+        """Returns the entity represented by the dict `entity_dict` (from the NLU)."""
+        # ({str: anything}) -> (Entity)
+        try:
+            return Entity(entity_dict["entity"], entity_dict["value"],
+                          float(entity_dict["confidence"]),
+                          entity_dict.get("start"), entity_dict.get("end"),
+                          entity_dict.get("extractor"))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Tried to create an entity from an invalid "+
+                             "description ("+str(entity_dict)+"): "+str(e))
+    def to_dict(self):
+        return {"entity": self.entity, "value": self.value,
+                "confidence": self.confidence, "start": self.start,
+                "end": self.end, "extractor": self.extractor}
+
+    def __str__(self):
+        return "<Entity "+str(self.entity)+": '"+str(self.value)+"' ("+ \
+               str(self.confidence)+")>"
+
+
+class Intent(object):
+    """An intent the NLU recognized, with its confidence."""
+    __slots__ = ("name", "confidence")
+
+    def __init__(self, name, confidence):
+        # (str, float) -> ()
+        self.name = name
+        self.confidence = confidence
+
+    @staticmethod
+    def from_dict(intent_dict):
+        # ({str: anything}) -> (Intent)
+        try:
+            return Intent(intent_dict["name"], float(intent_dict["confidence"]))
+        except (KeyError, TypeError, AttributeError) as e:
+            raise ValueError("Tried to create an intent from an invalid "+
+                             "description ("+str(intent_dict)+"): "+str(e))
+    def to_dict(self):
+        return {"name": self.name, "confidence": self.confidence}
+
+    def __str__(self):
+        return "<Intent "+str(self.name)+" ("+str(self.confidence)+")>"
+
+
+class NLUMessage(object):
+    """A message of the user as understood by the NLU."""
+    __slots__ = ("intent", "entities", "intent_ranking", "text")
+
+    def __init__(self, intent, entities=None, intent_ranking=None, text=""):
+        # (Intent, [Entity], [Intent], str) -> ()
+        if entities is None:
+            entities = []
+        if intent_ranking is None:
+            intent_ranking = [intent]
+        self.intent = intent
+        self.entities = entities
+        self.intent_ranking = intent_ranking
+        self.text = text
+
+    def get_ranked_confidence(self, intent_name):
+        """
+        Returns the confidence of the intent `intent_name` in the ranking of
+        the intents or `None` if it is not in the ranking.
+        """
+        # (str) -> (float or None)
+        for intent in self.intent_ranking:
+            if intent.name == intent_name:
+                return intent.confidence
+        return None
+
+    @staticmethod
+    def from_dict(message_dict):
+        """
+        Returns the message represented by the dict `message_dict` (from the
+        NLU, cf. above). Raises a `ValueError` if it is not a valid message.
+        """
+        # ({str: anything}) -> (NLUMessage)
+        if not isinstance(message_dict, dict) or "intent" not in message_dict:
+            raise ValueError("Tried to create a message from an invalid "+
+                             "description ("+str(message_dict)+").")
+        intent = Intent.from_dict(message_dict["intent"])
+        entities = [Entity.from_dict(entity_dict)
+                    for entity_dict in message_dict.get("entities") or []]
+        intent_ranking = None
+        if message_dict.get("intent_ranking") is not None:
+            intent_ranking = [Intent.from_dict(intent_dict)
+                              for intent_dict in message_dict["intent_ranking"]]
+        return NLUMessage(intent, entities, intent_ranking,
+                          message_dict.get("text", ""))
+
+    @staticmethod
+    def from_json(data):
+        """
+        Returns the message encoded in JSON in `data` (bytes in UTF-8 or str).
+        Raises a `ValueError` if it is not a valid message.
+        """
+        # (bytes or str) -> (NLUMessage)
+        if isinstance(data, bytes) and not isinstance(data, str):  # Python 3
+            data = data.decode("utf-8")  # raises a `ValueError` if invalid
+        return NLUMessage.from_dict(json.loads(data))
+
+    def to_dict(self):
+        return {"intent": self.intent.to_dict(),
+                "entities": [entity.to_dict() for entity in self.entities],
+                "intent_ranking": [intent.to_dict()
+                                   for intent in self.intent_ranking],
+                "text": self.text}
+
+    def __str__(self):
+        return "<NLUMessage "+str(self.intent)+" "+ \
+               str([str(entity) for entity in self.entities])+">"
+
+
+def to_nlu_message(intent_and_entities):
+    """
+    Returns `intent_and_entities` as an `NLUMessage`, converting it if it is
+    a dict (from the NLU).
+    """
+    # (NLUMessage or {str: anything}) -> (NLUMessage)
+    if isinstance(intent_and_entities, NLUMessage):
+        return intent_and_entities
+    return NLUMessage.from_dict(intent_and_entities)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a local, in-process stand-in for the planning API (module
+`Phi`) that the custom actions use. It generates deterministic synthetic plans
+of any size (lines, time buckets, orders and product families) so that the
+custom actions can be benchmarked and regression-tested without a planner.
+
+Usage:
+    from bot import phi_simulator
+    phi_simulator.install(phi_simulator.SimulatedPlan(nb_orders=100000))
+    # `import Phi` now gives the simulator (install it before the custom
+    # actions are loaded, e.g. before `ActionFactory.warm_up`)
+
+It can also be run to benchmark the custom actions on plans of growing size:
+    python -m bot.phi_simulator --orders 1000 100000 1000000
+"""
+
+import sys
+import time
+import types
+import argparse
+
+import numpy as np
+
+
+class SimulatedTimeBucket(object):
+    """A time bucket; dates are numbers of days since the start of the plan."""
+    __slots__ = ("index",)
+    def __init__(self, index):
+        self.index = index
+    def getStartDate(self):
+        return self.index
+    def getEndDate(self):
+        return self.index+1
+
+
+class SimulatedLine(object):
+    __slots__ = ("plan", "index", "name")
+    def __init__(self, plan, index, name):
+        self.plan = plan
+        self.index = index
+        self.name = name
+    def getName(self):
+        self.plan.count_call("Line.getName")
+        return self.name
+    def getUtilisation(self, time_bucket):
+        self.plan.count_call("Line.getUtilisation")
+        return float(self.plan.get_utilization_row(self.index)[time_bucket.index])
+    def isPFUsed(self, product_family):
+        self.plan.count_call("Line.isPFUsed")
+        return int(self.plan.pf_uses_line[product_family, self.index])
+
+
+class SimulatedOrder(object):
+    __slots__ = ("plan", "index")
+    def __init__(self, plan, index):
+        self.plan = plan
+        self.index = index
+    def getName(self):
+        self.plan.count_call("Order.getName")
+        return "ORD"+str(self.index).zfill(7)
+    def getPlannedBucketsOfLateness(self):
+        self.plan.count_call("Order.getPlannedBucketsOfLateness")
+        return int(self.plan.orders_lateness[self.index])
+    def isForbidden(self):
+        self.plan.count_call("Order.isForbidden")
+        return bool(self.plan.orders_forbidden[self.index])
+    def getCompletionDate(self):
+        self.plan.count_call("Order.getCompletionDate")
+        return int(self.plan.orders_completion_dates[self.index])
+    def getDueDate(self):
+        self.plan.count_call("Order.getDueDate")
+        return int(self.plan.orders_due_dates[self.index])
+    def getFinalPF(self):
+        self.plan.count_call("Order.getFinalPF")
+        product_family = int(self.plan.orders_product_families[self.index])
+        if product_family < 0:
+            return None
+        return product_family
+
+
+class SimulatedPlan(object):
+    """
+    A synthetic plan, entirely determined by its sizes and `seed`.
+    Product families are represented by their index. The utilization of a
+    line is only generated the first time it is needed. `nb_calls` counts
+    the calls made to the API, by function name.
+    """
+    LINE_PREFIXES = ["GLO", "LAL", "EXT", "STR"]
+    LINE_KINDS = ["SSP", "HSM", "SKP", "PCK", "CRM", "PAC", "SHP", "GLV",
+                  "PNT", "SLT", "CLI"]
+
+    def __init__(self, nb_lines=20, nb_buckets=52, nb_orders=1000,
+                 nb_product_families=30, seed=0, saturated_lines_ratio=0.1,
+                 late_orders_ratio=0.2, forbidden_orders_ratio=0.05,
+                 unplanned_orders_ratio=0.1, pf_line_density=0.3):
+        # (int, int, int, int, int, float, float, float, float, float) -> ()
+        if nb_lines <= 0 or nb_buckets <= 0 or nb_product_families <= 0:
+            raise ValueError("Tried to create a simulated plan without lines, "+
+                             "time buckets or product families.")
+        self.nb_lines = nb_lines
+        self.nb_buckets = nb_buckets
+        self.nb_orders = nb_orders
+        self.nb_product_families = nb_product_families
+        self.seed = seed
+        self.nb_calls = dict()
+
+        rng = np.random.RandomState(seed)
+        self.line_names = [self._make_line_name(i) for i in range(nb_lines)]
+        self.lines = [SimulatedLine(self, i, name)
+                      for (i, name) in enumerate(self.line_names)]
+        self.line_indices_by_name = {name: i
+                                     for (i, name) in enumerate(self.line_names)}
+        self.saturated_lines = rng.random_sample(nb_lines) < saturated_lines_ratio
+        self.lines_load = rng.uniform(0.1, 0.9, nb_lines)  # mean utilization of non-saturated lines
+        self._utilization_rows = dict()
+
+        self.pf_uses_line = rng.random_sample((nb_product_families, nb_lines)) \
+                            < pf_line_density
+
+        self.orders_lateness = np.where(rng.random_sample(nb_orders) < late_orders_ratio,
+                                        rng.randint(1, 5, nb_orders), 0)
+        self.orders_forbidden = rng.random_sample(nb_orders) < forbidden_orders_ratio
+        self.orders_due_dates = rng.randint(1, nb_buckets+1, nb_orders)
+        unplanned = rng.random_sample(nb_orders) < unplanned_orders_ratio
+        self.orders_completion_dates = \
+            np.where(unplanned, nb_buckets+1,
+                     np.minimum(self.orders_due_dates+self.orders_lateness,
+                                nb_buckets))
+        self.orders_product_families = rng.randint(-1, nb_product_families,
+                                                   nb_orders)  # -1: no final product family
+
+    def _make_line_name(self, index):
+        prefix = SimulatedPlan.LINE_PREFIXES[index % len(SimulatedPlan.LINE_PREFIXES)]
+        kind = SimulatedPlan.LINE_KINDS[(index // len(SimulatedPlan.LINE_PREFIXES))
+                                        % len(SimulatedPlan.LINE_KINDS)]
+        name = prefix+"_"+kind
+        nb_names_per_round = len(SimulatedPlan.LINE_PREFIXES)*len(SimulatedPlan.LINE_KINDS)
+        if index >= nb_names_per_round:
+            name += str(index // nb_names_per_round)
+        return name
+
+    def count_call(self, function_name):
+        self.nb_calls[function_name] = self.nb_calls.get(function_name, 0)+1
+    def get_total_nb_calls(self):
+        return sum(self.nb_calls.values())
+    def reset_calls(self):
+        self.nb_calls = dict()
+
+    def get_utilization_row(self, line_index):
+        """Returns the utilization of a line for every time bucket."""
+        # (int) -> (np.ndarray)
+        row = self._utilization_rows.get(line_index)
+        if row is None:
+            if self.saturated_lines[line_index]:
+                row = np.ones(self.nb_buckets)
+            else:
+                rng = np.random.RandomState([self.seed, line_index])
+                busy = rng.random_sample(self.nb_buckets) < self.lines_load[line_index]
+                row = np.where(busy, rng.uniform(0.3, 1.0, self.nb_buckets), 0.0)
+            self._utilization_rows[line_index] = row
+        return row
+
+    # Planning API (same names as in `Phi`)
+    def findLine(self, name):
+        self.count_call("findLine")
+        line_index = self.line_indices_by_name.get(name)
+        if line_index is None:
+            return None
+        return self.lines[line_index]
+    def getLine(self, index):
+        self.count_call("getLine")
+        if index < 0 or index >= self.nb_lines:
+            return None
+        return self.lines[index]
+    def getNumberOfLines(self):
+        self.count_call("getNumberOfLines")
+        return self.nb_lines
+    getNumLines = getNumberOfLines
+    def getOrder(self, index):
+        self.count_call("getOrder")
+        return SimulatedOrder(self, index)
+    def getNumOrders(self):
+        self.count_call("getNumOrders")
+        return self.nb_orders
+    def getTimeBucket(self, index):
+        self.count_call("getTimeBucket")
+        return SimulatedTimeBucket(index)
+    def getNumberOfTimeBuckets(self):
+        self.count_call("getNumberOfTimeBuckets")
+        return self.nb_buckets
+
+
+API_FUNCTIONS_NAMES = ["findLine", "getLine", "getNumberOfLines", "getNumLines",
+                       "getOrder", "getNumOrders", "getTimeBucket",
+                       "getNumberOfTimeBuckets"]
+_current_plan = None
+
+def install(plan):
+    """
+    Makes `import Phi` give a module that answers using the simulated plan
+    `plan`. Installing another plan later on replaces the plan used by this
+    module and publishes it as a new plan to the custom actions.
+    """
+    # (SimulatedPlan) -> (module)
+    global _current_plan
+    _current_plan = plan
+    phi_module = sys.modules.get("Phi")
+    if phi_module is None or not getattr(phi_module, "IS_SIMULATOR", False):
+        phi_module = types.ModuleType("Phi")
+        phi_module.IS_SIMULATOR = True
+        for function_name in API_FUNCTIONS_NAMES:
+            setattr(phi_module, function_name, _make_api_function(function_name))
+        sys.modules["Phi"] = phi_module
+    if "bot.actions.custom.plan_snapshot" in sys.modules:
+        sys.modules["bot.actions.custom.plan_snapshot"].publish_new_plan()
+    return phi_module
+
+def get_installed_plan():
+    return _current_plan
+
+def _make_api_function(function_name):
+    def api_function(*args):
+        if _current_plan is None:
+            raise RuntimeError("Tried to use the planning API simulator "+
+                               "while no simulated plan was installed.")
+        return getattr(_current_plan, function_name)(*args)
+    api_function.__name__ = function_name
+    return api_function
+
+
+#================ Benchmark ==================
+BENCHMARKED_QUESTIONS = [
+    ("describe_machine_planning", {"production_line": "LAL_SSP"}),
+    ("filter_orders_time", {"filter_time": "late"}),
+    ("explain_machine_utilization", {"production_line": "LAL_SSP",
+                                     "utilization": "0.5"}),
+]
+
+def benchmark_custom_actions(plans, nb_repetitions=5):
+    """
+    Asks each question of `BENCHMARKED_QUESTIONS` on each of the simulated
+    plans `plans` and measures the time the custom action takes to answer the
+    first time after the plan is published ("cold", which includes building
+    the plan data) and the mean time for the next `nb_repetitions` times
+    ("warm", with fresh actions on the already built plan data, the results
+    cache being cleared before each run). The actions are executed as the
+    dialog manager does (cf. `Action.execute`). The number of API calls made
+    is also reported.
+    Returns a list of reports (one per plan and question).
+    """
+    # ([SimulatedPlan], int) -> ([{str: anything}])
+    install(plans[0])
+    from .dialog_management_components import Context, Goal
+    from .actions.ActionFactory import ActionFactory
+    from .actions.Action import clear_results_cache
+    from . import config as cfg
+
+    action_factory = ActionFactory(cfg.get_utterances_templates())
+    action_factory.warm_up()
+    reports = []
+    for plan in plans:
+        install(plan)
+        for (goal_name, slot_values) in BENCHMARKED_QUESTIONS:
+            goal = Goal(goal_name)
+            context = Context(goal)
+            for slot_name in slot_values:
+                context.set_slot(slot_name, slot_values[slot_name])
+            plan.reset_calls()
+            times = []
+            for i in range(nb_repetitions+1):
+                clear_results_cache()
+                action = action_factory.new_action(goal.actions[0], context)
+                start_time = time.time()
+                action.execute()
+                times.append(time.time()-start_time)
+            reports.append({
+                "nb-orders": plan.nb_orders, "nb-buckets": plan.nb_buckets,
+                "nb-lines": plan.nb_lines, "goal": goal_name,
+                "cold-time": times[0],
+                "warm-time": sum(times[1:])/float(max(1, nb_repetitions)),
+                "nb-api-calls": plan.get_total_nb_calls(),
+            })
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the custom "+
+                                     "actions on synthetic plans.")
+    parser.add_argument("--orders", type=int, nargs="+", default=[1000, 100000])
+    parser.add_argument("--buckets", type=int, default=52)
+    parser.add_argument("--lines", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    plans = [SimulatedPlan(nb_lines=args.lines, nb_buckets=args.buckets,
+                           nb_orders=nb_orders, seed=args.seed)
+             for nb_orders in args.orders]
+    for report in benchmark_custom_actions(plans):
+        print(str(report["nb-orders"])+" orders\t"+report["goal"]+
+              "\tcold: "+"{:.4f}".format(report["cold-time"])+"s"+
+              "\twarm: "+"{:.6f}".format(report["warm-time"])+"s"+
+              "\tAPI calls: "+str(report["nb-api-calls"]))
@@ -0,0 +1,569 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the serving entry point of the bot: an asyncio server that
+receives the messages of the users (as understood by the NLU, in JSON) over
+HTTP or WebSocket and handles them in a pool of worker processes
+(cf. `worker_pool.py`).
+
+Routes:
+    - `POST /conversations/<conversation ID>/messages`: the body is the NLU
+      payload of a message (cf. `DialogManager.manage_user_msg`), the
+      response contains the events of the reply of the bot
+      (cf. `streaming.py`) as `{"events": [...]}`;
+    - `GET /conversations/<conversation ID>/websocket`: opens a WebSocket on
+      which each text message is an NLU payload and each event of the replies
+      is sent as soon as it is produced;
+    - `GET /health`: metrics of the server.
+The tenant a conversation is held with can be given in the header
+`X-Tenant-ID`.
+HTTP connections are kept alive. Messages of a conversation are handled in
+order. When too many messages are being handled (in total or for a
+conversation), new HTTP messages are rejected (status 429) and WebSocket
+connections are not read anymore until messages were handled.
+This requires Python 3.5+.
+"""
+
+import re
+import json
+import base64
+import signal
+import struct
+import asyncio
+import hashlib
+import functools
+
+from . import config as cfg
+from .nlu_message import NLUMessage
+from .session_store import SQLiteSessionStore
+from .trace_log import make_worker_trace_log
+from .worker_pool import ShardedWorkerPool, REPLY_EVENT, REPLY_ERROR
+
+
+_CONVERSATION_ROUTE_REGEX = \
+    re.compile(r"^/conversations/([A-Za-z0-9_.:\-]{1,128})/(messages|websocket)$")
+
+_HTTP_REASONS = {200: "OK", 101: "Switching Protocols", 400: "Bad Request",
+                 404: "Not Found", 405: "Method Not Allowed",
+                 413: "Payload Too Large", 429: "Too Many Requests",
+                 500: "Internal Server Error", 503: "Service Unavailable",
+                 504: "Gateway Timeout"}
+
+_WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_WS_CONTINUATION = 0x0
+_WS_TEXT = 0x1
+_WS_BINARY = 0x2
+_WS_CLOSE = 0x8
+_WS_PING = 0x9
+_WS_PONG = 0xA
+_WS_GOING_AWAY = 1001
+_WS_PROTOCOL_ERROR = 1002
+_WS_TOO_BIG = 1009
+
+
+class HTTPError(Exception):
+    """An error to answer to a request with the HTTP status `status`."""
+    def __init__(self, status, msg):
+        # (int, str) -> ()
+        super(HTTPError, self).__init__(msg)
+        self.status = status
+        self.msg = msg
+
+class _WebSocketError(Exception):
+    def __init__(self, close_code, msg):
+        super(_WebSocketError, self).__init__(msg)
+        self.close_code = close_code
+
+
+def parse_nlu_payload(data):
+    """
+    Returns the NLU payload encoded (in JSON) in `data`.
+    Raises an `HTTPError` if it is not a valid payload.
+    """
+    # (bytes) -> (NLUMessage)
+    try:
+        return NLUMessage.from_json(data)
+    except ValueError as e:  # includes JSON and decoding errors
+        raise HTTPError(400, "Invalid NLU payload: "+str(e))
+
+
+class _HTTPRequest(object):
+    def __init__(self, method, path, version, headers, body):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers  # lowercase names
+        self.body = body
+
+    def wants_keep_alive(self):
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return (connection == "keep-alive")
+        return (connection != "close")
+
+
+class _Connection(object):
+    """State of a client connection."""
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.write_lock = asyncio.Lock()
+        self._reading_stopped = asyncio.get_event_loop().create_future()
+
+    async def read(self, read_coroutine):
+        """
+        Returns the result of `read_coroutine` (a read of `self.reader`).
+        Raises a `ConnectionAbortedError` if reading was stopped before it
+        finished (cf. `stop_reading`), in which case the read is cancelled.
+        """
+        if self._reading_stopped.done():
+            read_coroutine.close()
+            raise ConnectionAbortedError("Stopped reading the connection.")
+        read_task = asyncio.ensure_future(read_coroutine)
+        try:
+            await asyncio.wait([read_task, self._reading_stopped],
+                               return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            read_task.cancel()
+            raise
+        if read_task.done():
+            return read_task.result()
+        read_task.cancel()
+        raise ConnectionAbortedError("Stopped reading the connection.")
+
+    async def send(self, data):
+        async with self.write_lock:
+            self.writer.write(data)
+            await self.writer.drain()  # waits if the client doesn't read fast enough
+
+    def stop_reading(self):
+        """
+        Makes the pending and next reads of this connection (cf. `read`)
+        end, while replies can still be sent.
+        """
+        if not self._reading_stopped.done():
+            self._reading_stopped.set_result(None)
+
+
+class DialogServer(object):
+    """
+    The HTTP/WebSocket server (cf. above). The messages are handled by `pool`,
+    or by a pool of `nb_workers` workers owned by the server if it is `None`
+    (whose workers spill their sessions to the stores made by
+    `session_store_factory` and record their turns in the trace logs made by
+    `trace_log_factory`, if any).
+    """
+    def __init__(self, host=None, port=None, pool=None, nb_workers=None,
+                 session_store_factory=None, trace_log_factory=None):
+        # (str, int, ShardedWorkerPool, int, () -> (SessionStore), () -> (TraceLogWriter)) -> ()
+        if host is None:
+            host = cfg.SERVER_HOST
+        if port is None:
+            port = cfg.SERVER_PORT
+        self.host = host
+        self.port = port
+        self._owns_pool = (pool is None)
+        if pool is None:
+            pool = ShardedWorkerPool(nb_workers,
+                                     session_store_factory=session_store_factory,
+                                     trace_log_factory=trace_log_factory)
+        self._pool = pool
+
+        self._server = None
+        self._connections = dict()  # task -> _Connection
+        self._closing = False
+        self._nb_pending = 0
+        self._nb_pending_by_session = dict()
+        self.metrics = {"connections": 0, "websockets": 0, "requests": 0,
+                        "rejected": 0, "errors": 0, "timeouts": 0}
+
+    async def start(self):
+        """Starts the workers (if owned) and listens for connections."""
+        if self._owns_pool:
+            self._pool.start()
+        self._server = \
+            await asyncio.start_server(self._serve_connection, self.host,
+                                       self.port,
+                                       limit=cfg.MAX_REQUEST_BYTES)
+        self.port = self._server.sockets[0].getsockname()[1]  # if port 0 was given
+        print("Serving on "+self.host+":"+str(self.port))
+
+    async def shutdown(self):
+        """
+        Stops accepting connections, lets the open ones finish handling the
+        messages they received (at most `SHUTDOWN_TIMEOUT` seconds) and stops
+        the workers (if owned).
+        """
+        self._closing = True
+        self._server.close()
+        for connection in list(self._connections.values()):
+            connection.stop_reading()
+        if len(self._connections) > 0:
+            (_, still_running) = await asyncio.wait(list(self._connections),
+                                                    timeout=cfg.SHUTDOWN_TIMEOUT)
+            for task in still_running:
+                task.cancel()
+        await self._server.wait_closed()
+        if self._owns_pool:
+            await asyncio.get_event_loop().run_in_executor(None,
+                                                           self._pool.close)
+
+    def get_health(self):
+        # () -> ({str: anything})
+        health = dict(self.metrics)
+        health["status"] = "closing" if self._closing else "ok"
+        health["pending"] = self._nb_pending
+        health["open-connections"] = len(self._connections)
+        return health
+
+    #============ Messages handling ==============
+    async def handle_message(self, conversation_id, tenant_id, data, on_event):
+        """
+        Handles the NLU payload `data` of a message of the conversation
+        `conversation_id` and awaits `on_event(event)` for each event of the
+        reply. Raises an `HTTPError` if the message is invalid, if too many
+        messages are pending or if the worker failed.
+        """
+        # (str, str, bytes, ({str: str}) -> (awaitable)) -> ()
+        intent_and_entities = parse_nlu_payload(data)
+        nb_pending_in_session = self._nb_pending_by_session.get(conversation_id, 0)
+        if (   self._nb_pending >= cfg.MAX_PENDING_REQUESTS
+            or nb_pending_in_session >= cfg.MAX_PENDING_REQUESTS_PER_SESSION):
+            self.metrics["rejected"] += 1
+            raise HTTPError(429, "Too many messages are being handled, "+
+                                 "retry later.")
+        self.metrics["requests"] += 1
+        self._nb_pending += 1
+        self._nb_pending_by_session[conversation_id] = nb_pending_in_session+1
+        try:
+            loop = asyncio.get_event_loop()
+            items = asyncio.Queue()
+            def listener(kind, payload):  # called from the collector thread of the pool
+                loop.call_soon_threadsafe(items.put_nowait, (kind, payload))
+            self._pool.submit(conversation_id, intent_and_entities, tenant_id,
+                              listener)
+            while True:
+                try:
+                    (kind, payload) = await asyncio.wait_for(items.get(),
+                                                             cfg.REPLY_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.metrics["timeouts"] += 1
+                    raise HTTPError(504, "The bot took too long to answer.")
+                if kind == REPLY_EVENT:
+                    await on_event(payload)
+                elif kind == REPLY_ERROR:
+                    self.metrics["errors"] += 1
+                    raise HTTPError(500, payload)
+                else:
+                    return
+        finally:
+            self._nb_pending -= 1
+            nb_pending_in_session = \
+                self._nb_pending_by_session.pop(conversation_id) - 1
+            if nb_pending_in_session > 0:
+                self._nb_pending_by_session[conversation_id] = nb_pending_in_session
+
+    #============ HTTP ==============
+    async def _serve_connection(self, reader, writer):
+        connection = _Connection(reader, writer)
+        task = _current_task()
+        self._connections[task] = connection
+        self.metrics["connections"] += 1
+        try:
+            while not self._closing:
+                try:
+                    request = await asyncio.wait_for(
+                        connection.read(_read_http_request(reader)),
+                        cfg.KEEP_ALIVE_TIMEOUT
+                    )
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as e:
+                    await self._send_response(connection, e.status,
+                                              {"error": e.msg}, False)
+                    break
+                if request is None:
+                    break
+                keep_alive = await self._serve_request(connection, request)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            del self._connections[task]
+            writer.close()
+
+    async def _serve_request(self, connection, request):
+        """Answers `request` and returns whether to keep the connection alive."""
+        # (_Connection, _HTTPRequest) -> (bool)
+        keep_alive = request.wants_keep_alive()
+        try:
+            if request.path == "/health":
+                if request.method != "GET":
+                    raise HTTPError(405, "Only GET is allowed.")
+                await self._send_response(connection, 200, self.get_health(),
+                                          keep_alive)
+                return keep_alive
+            match = _CONVERSATION_ROUTE_REGEX.match(request.path)
+            if match is None:
+                raise HTTPError(404, "No route for "+request.path+".")
+            (conversation_id, route) = match.groups()
+            tenant_id = request.headers.get("x-tenant-id")
+            if route == "websocket":
+                await self._serve_websocket(connection, request,
+                                            conversation_id, tenant_id)
+                return False
+            if request.method != "POST":
+                raise HTTPError(405, "Only POST is allowed.")
+            events = []
+            async def collect(event):
+                events.append(event)
+            await self.handle_message(conversation_id, tenant_id, request.body,
+                                      collect)
+            await self._send_response(connection, 200, {"events": events},
+                                      keep_alive)
+        except HTTPError as e:
+            await self._send_response(connection, e.status, {"error": e.msg},
+                                      keep_alive)
+        return keep_alive
+
+    async def _send_response(self, connection, status, content, keep_alive):
+        # (_Connection, int, {str: anything}, bool) -> ()
+        body = json.dumps(content).encode("utf-8")
+        keep_alive = keep_alive and not self._closing
+        headers = ("HTTP/1.1 "+str(status)+" "+_HTTP_REASONS.get(status, "")+"\r\n"+
+                   "Content-Type: application/json\r\n"+
+                   "Content-Length: "+str(len(body))+"\r\n"+
+                   "Connection: "+("keep-alive" if keep_alive else "close")+"\r\n"+
+                   "\r\n")
+        await connection.send(headers.encode("latin-1")+body)
+
+    #============ WebSocket ==============
+    async def _serve_websocket(self, connection, request, conversation_id,
+                               tenant_id):
+        key = request.headers.get("sec-websocket-key")
+        if (   request.method != "GET" or key is None
+            or request.headers.get("upgrade", "").lower() != "websocket"):
+            raise HTTPError(400, "Invalid WebSocket handshake.")
+        accept = hashlib.sha1((key+_WEBSOCKET_GUID).encode("ascii")).digest()
+        await connection.send(("HTTP/1.1 101 Switching Protocols\r\n"+
+                               "Upgrade: websocket\r\n"+
+                               "Connection: Upgrade\r\n"+
+                               "Sec-WebSocket-Accept: "+
+                               base64.b64encode(accept).decode("ascii")+"\r\n"+
+                               "\r\n").encode("latin-1"))
+        self.metrics["websockets"] += 1
+
+        # Bounded: when it is full, the socket is not read anymore (backpressure)
+        messages = asyncio.Queue(maxsize=cfg.MAX_PENDING_REQUESTS_PER_SESSION)
+        handler = asyncio.ensure_future(
+            self._handle_websocket_messages(connection, messages,
+                                            conversation_id, tenant_id)
+        )
+        close_code = _WS_GOING_AWAY
+        try:
+            while True:
+                (opcode, payload) = \
+                    await connection.read(_read_websocket_message(connection))
+                if opcode == _WS_CLOSE:
+                    close_code = 1000
+                    break
+                await messages.put(payload)
+        except _WebSocketError as e:
+            close_code = e.close_code
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            await messages.put(None)  # the handler keeps consuming the messages until this
+            await handler
+        try:
+            await connection.send(_encode_websocket_frame(_WS_CLOSE,
+                                                          struct.pack("!H", close_code)))
+        except ConnectionError:
+            pass
+
+    async def _handle_websocket_messages(self, connection, messages,
+                                         conversation_id, tenant_id):
+        async def send_event(event):
+            await connection.send(
+                _encode_websocket_frame(_WS_TEXT, json.dumps(event).encode("utf-8"))
+            )
+        is_connection_lost = False
+        while True:
+            payload = await messages.get()
+            if payload is None:
+                return
+            if is_connection_lost:
+                continue
+            try:
+                try:
+                    await self.handle_message(conversation_id, tenant_id,
+                                              payload, send_event)
+                except HTTPError as e:
+                    await send_event({"type": "error", "status": e.status,
+                                      "error": e.msg})
+            except ConnectionError:
+                is_connection_lost = True
+                connection.stop_reading()
+
+
+async def _read_http_request(reader):
+    """
+    Reads an HTTP request from `reader` and returns it, or `None` if the
+    connection was closed. Raises an `HTTPError` if the request is invalid.
+    """
+    # (asyncio.StreamReader) -> (_HTTPRequest or None)
+    try:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        try:
+            (method, target, version) = \
+                request_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Invalid request line.")
+        headers = dict()
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            (name, _, value) = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise HTTPError(400, "Too many headers.")
+    except (ValueError, asyncio.LimitOverrunError):  # line longer than the limit
+        raise HTTPError(413, "Request too large.")
+    try:
+        content_length = int(headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPError(400, "Invalid content length.")
+    if content_length > cfg.MAX_REQUEST_BYTES:
+        raise HTTPError(413, "Request too large.")
+    body = b""
+    if content_length > 0:
+        body = await reader.readexactly(content_length)
+    return _HTTPRequest(method, target.split("?", 1)[0], version, headers, body)
+
+
+async def _read_websocket_message(connection):
+    """
+    Reads frames from `connection` until a whole data message (or a close
+    frame) was received and returns its opcode and payload.
+    Pings are answered on the fly.
+    """
+    # (_Connection) -> ((int, bytes))
+    message_opcode = None
+    fragments = []
+    nb_bytes = 0
+    while True:
+        (is_final, opcode, payload) = await _read_websocket_frame(connection.reader)
+        if opcode == _WS_CLOSE:
+            return (_WS_CLOSE, payload)
+        elif opcode == _WS_PING:
+            await connection.send(_encode_websocket_frame(_WS_PONG, payload))
+            continue
+        elif opcode == _WS_PONG:
+            continue
+        elif opcode == _WS_CONTINUATION:
+            if message_opcode is None:
+                raise _WebSocketError(_WS_PROTOCOL_ERROR,
+                                      "Unexpected continuation frame.")
+        elif opcode in (_WS_TEXT, _WS_BINARY):
+            if message_opcode is not None:
+                raise _WebSocketError(_WS_PROTOCOL_ERROR,
+                                      "Expected a continuation frame.")
+            message_opcode = opcode
+        else:
+            raise _WebSocketError(_WS_PROTOCOL_ERROR,
+                                  "Unknown opcode "+str(opcode)+".")
+        fragments.append(payload)
+        nb_bytes += len(payload)
+        if nb_bytes > cfg.MAX_REQUEST_BYTES:
+            raise _WebSocketError(_WS_TOO_BIG, "Message too large.")
+        if is_final:
+            return (message_opcode, b"".join(fragments))
+
+async def _read_websocket_frame(reader):
+    # (asyncio.StreamReader) -> ((bool, int, bytes))
+    (first_byte, second_byte) = await reader.readexactly(2)
+    is_final = bool(first_byte & 0x80)
+    opcode = first_byte & 0x0f
+    length = second_byte & 0x7f
+    if not second_byte & 0x80:
+        raise _WebSocketError(_WS_PROTOCOL_ERROR,
+                              "Frames sent by clients must be masked.")
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    if length > cfg.MAX_REQUEST_BYTES:
+        raise _WebSocketError(_WS_TOO_BIG, "Message too large.")
+    mask = await reader.readexactly(4)
+    payload = await reader.readexactly(length)
+    return (is_final, opcode, _unmask(payload, mask))
+
+def _unmask(payload, mask):
+    # (bytes, bytes) -> (bytes)
+    length = len(payload)
+    if length <= 0:
+        return payload
+    full_mask = (mask*(length//4+1))[:length]
+    return (int.from_bytes(payload, "big") ^
+            int.from_bytes(full_mask, "big")).to_bytes(length, "big")
+
+def _encode_websocket_frame(opcode, payload):
+    # (int, bytes) -> (bytes)
+    header = bytearray([0x80 | opcode])  # never fragmented
+    length = len(payload)
+    if length < 126:
+        header.append(length)
+    elif length < 2**16:
+        header.append(126)
+        header += struct.pack("!H", length)
+    else:
+        header.append(127)
+        header += struct.pack("!Q", length)
+    return bytes(header)+payload
+
+
+def _current_task():
+    if hasattr(asyncio, "current_task"):  # Python >= 3.7
+        return asyncio.current_task()
+    return asyncio.Task.current_task()
+
+
+def serve_forever(host=None, port=None, nb_workers=None,
+                  sessions_db_filepath=None, trace_log_filepath=None):
+    """
+    Runs the server until it gets a SIGINT or a SIGTERM, then shuts it down
+    gracefully. If `sessions_db_filepath` is given, the sessions the workers
+    evict are spilled to this SQLite database (cf. `session_store.py`).
+    If `trace_log_filepath` is given, each worker records the turns it
+    handles in a trace log of its own (`trace_log_filepath` suffixed with its
+    process ID, cf. `trace_log.py`).
+    """
+    # (str, int, int, str, str) -> ()
+    session_store_factory = None
+    if sessions_db_filepath is not None:
+        session_store_factory = \
+            functools.partial(SQLiteSessionStore, sessions_db_filepath)
+    trace_log_factory = None
+    if trace_log_filepath is not None:
+        trace_log_factory = \
+            functools.partial(make_worker_trace_log, trace_log_filepath)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = DialogServer(host, port, nb_workers=nb_workers,
+                          session_store_factory=session_store_factory,
+                          trace_log_factory=trace_log_factory)
+    loop.run_until_complete(server.start())
+    stopped = asyncio.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    try:
+        loop.run_until_complete(stopped.wait())
+        print("Shutting down...")
+        loop.run_until_complete(server.shutdown())
+    finally:
+        loop.close()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the manager of the sessions (i.e. the dialog managers of
+the conversations) a process holds in memory.
+Sessions that were idle for too long expire and, when there are too many
+sessions or when they use too much memory, the least recently used ones are
+evicted. If a session store is given (cf. `session_store.py`), expired and
+evicted sessions are spilled to it instead of being forgotten, and they are
+restored from it when the conversation continues.
+"""
+
+import time
+import weakref
+
+from . import config as cfg
+from .caching import LRUCache, estimate_size
+from .DialogManager import DialogManager
+
+
+class SessionManager(object):
+    """
+    Holds the dialog managers of the conversations, indexed by conversation
+    ID, within the budgets `max_sessions` and `max_bytes` and for at most
+    `idle_ttl` seconds after their last turn (those default to the
+    configuration, in which they can be `None` to disable them).
+    The turns of the conversations are recorded in `trace_log` if it is given
+    (cf. `trace_log.py`).
+    The size of a session is only estimated again every
+    `SESSIONS_SIZE_ESTIMATE_INTERVAL` turns, as this walks all its objects.
+    """
+    def __init__(self, store=None, idle_ttl=None, max_sessions=None,
+                 max_bytes=None, clock=time.time, trace_log=None):
+        # (SessionStore, float, int, int, () -> (float), TraceLogWriter) -> ()
+        if idle_ttl is None:
+            idle_ttl = cfg.SESSIONS_IDLE_TTL
+        if max_sessions is None:
+            max_sessions = cfg.MAX_SESSIONS_PER_WORKER
+        if max_bytes is None:
+            max_bytes = cfg.SESSIONS_MEMORY_BUDGET_PER_WORKER
+        self.store = store
+        self.trace_log = trace_log
+        self._clock = clock
+        self._sessions = LRUCache(max_entries=max_sessions, max_bytes=max_bytes,
+                                  ttl=idle_ttl, size_of=self._get_session_size,
+                                  on_evict=self._spill, on_expire=self._spill,
+                                  clock=clock)
+        self._shared_objects_ids = dict()  # tenant ID -> IDs of the objects sessions share
+        self._size_estimates = weakref.WeakKeyDictionary()  # dialog manager -> [estimated size, number of turns since]
+        self._last_expiry_check_time = clock()
+        self.nb_created = 0
+        self.nb_restored = 0
+        self.nb_spilled = 0
+
+    def get(self, conversation_id, tenant_id=None):
+        """
+        Returns the dialog manager of the conversation `conversation_id`
+        (held with the tenant `tenant_id`), restoring it from the store if it
+        was spilled or creating it if the conversation is new.
+        `put` should be called once the turn is handled.
+        """
+        # (str, str) -> (DialogManager)
+        self._expire_if_needed()
+        dialog_manager = self._sessions.get(conversation_id)
+        if dialog_manager is not None:
+            return dialog_manager
+        dialog_manager = DialogManager(tenant_id)
+        dialog_manager.conversation_id = conversation_id
+        dialog_manager.trace_log = self.trace_log
+        data = None
+        if self.store is not None:
+            data = self.store.load(conversation_id)
+        if data is not None:
+            dialog_manager.set_serialized_context(data)
+            self.store.delete(conversation_id)
+            self.nb_restored += 1
+        else:
+            self.nb_created += 1
+        return dialog_manager
+
+    def put(self, conversation_id, dialog_manager):
+        """
+        Stores the dialog manager of the conversation `conversation_id` after a
+        turn (which marks it as used and updates its estimated size).
+        """
+        # (str, DialogManager) -> ()
+        self._sessions.put(conversation_id, dialog_manager)
+
+    def remove(self, conversation_id):
+        """Forgets the conversation `conversation_id` (in the store as well)."""
+        self._sessions.pop(conversation_id)
+        if self.store is not None:
+            self.store.delete(conversation_id)
+
+    def expire(self):
+        """Expires (and spills) the idle sessions, returns how many there were."""
+        # () -> (int)
+        self._last_expiry_check_time = self._clock()
+        return self._sessions.expire()
+
+    def close(self):
+        """Spills all the sessions to the store (if any) and forgets them."""
+        for (conversation_id, dialog_manager) in self._sessions.items():
+            self._spill(conversation_id, dialog_manager)
+        self._sessions.clear()
+        if self.store is not None:
+            self.store.flush()
+
+    def get_metrics(self):
+        # () -> ({str: int or float})
+        nb_sessions = len(self._sessions)
+        bytes_per_session = 0.0
+        if nb_sessions > 0:
+            bytes_per_session = float(self._sessions.nb_bytes)/nb_sessions
+        return {"live-sessions": nb_sessions,
+                "estimated-bytes": self._sessions.nb_bytes,
+                "estimated-bytes-per-session": bytes_per_session,
+                "created": self.nb_created, "restored": self.nb_restored,
+                "spilled": self.nb_spilled,
+                "evictions": self._sessions.metrics.evictions,
+                "expirations": self._sessions.metrics.expirations}
+
+    def estimate_session_size(self, dialog_manager):
+        """
+        Returns the estimated size (in bytes) of the objects that belong to
+        the dialog manager `dialog_manager` only (i.e. without the
+        configuration all the sessions of the tenant share).
+        """
+        # (DialogManager) -> (int)
+        seen_ids = set(self._get_shared_objects_ids(dialog_manager))
+        # The action factory (which only refers to the tenant's configuration)
+        # and the trace log are shared by the sessions as well
+        seen_ids.add(id(dialog_manager.action_factory))
+        if dialog_manager.trace_log is not None:
+            seen_ids.add(id(dialog_manager.trace_log))
+        return estimate_size(dialog_manager, seen_ids)
+
+    def _get_session_size(self, dialog_manager):
+        """
+        Returns the last estimated size of the session `dialog_manager`,
+        estimating it again if it is new or if it was estimated
+        `SESSIONS_SIZE_ESTIMATE_INTERVAL` turns ago.
+        """
+        # (DialogManager) -> (int)
+        estimate = self._size_estimates.get(dialog_manager)
+        if (   estimate is None
+            or estimate[1] >= cfg.SESSIONS_SIZE_ESTIMATE_INTERVAL):
+            estimate = [self.estimate_session_size(dialog_manager), 0]
+            self._size_estimates[dialog_manager] = estimate
+        estimate[1] += 1
+        return estimate[0]
+
+    def _get_shared_objects_ids(self, dialog_manager):
+        tenant_config = dialog_manager.tenant_config
+        shared_objects_ids = self._shared_objects_ids.get(tenant_config.tenant_id)
+        if shared_objects_ids is None:
+            shared_objects_ids = set()  # filled by `estimate_size`
+            for shared_object in (tenant_config, cfg.get_goals_descriptions(),
+                                  cfg.get_intents_descriptions(),
+                                  dialog_manager.policy):
+                estimate_size(shared_object, shared_objects_ids)
+            self._shared_objects_ids[tenant_config.tenant_id] = shared_objects_ids
+        return shared_objects_ids
+
+    def _spill(self, conversation_id, dialog_manager):
+        if self.store is not None:
+            self.store.save(conversation_id,
+                            dialog_manager.get_serialized_context())
+            self.nb_spilled += 1
+
+    def _expire_if_needed(self):
+        if (  self._clock() - self._last_expiry_check_time
+            >= cfg.SESSIONS_EXPIRY_CHECK_INTERVAL):
+            self.expire()
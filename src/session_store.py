@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the stores in which the contexts of the conversations
+(serialized, cf. `context_serialization.py`) can be persisted, so that the
+turns of a conversation can be handled by different workers and conversations
+survive restarts.
+A store only handles bytes indexed by conversation ID. Other stores (e.g.
+backed by a key-value server) can be plugged in by subclassing `SessionStore`.
+"""
+
+import time
+import sqlite3
+import threading
+
+from . import config as cfg
+from .context_serialization import serialize_context, deserialize_contexts
+
+
+class SessionStore(object):
+    """Interface of the stores of serialized contexts."""
+    def load(self, conversation_id):
+        """
+        Returns the serialized context of the conversation `conversation_id`
+        or `None` if there is none.
+        """
+        # (str) -> (bytes or None)
+        raise NotImplementedError()
+    def save(self, conversation_id, data):
+        """Stores `data` as the serialized context of `conversation_id`."""
+        # (str, bytes) -> ()
+        raise NotImplementedError()
+    def delete(self, conversation_id):
+        # (str) -> ()
+        raise NotImplementedError()
+    def flush(self):
+        """Makes sure all the saved contexts are persisted."""
+        pass
+    def close(self):
+        self.flush()
+
+    def load_contexts(self, conversation_id, slots_descriptions=None):
+        """
+        Returns the context of the conversation `conversation_id` and the
+        stack of its interrupted contexts (cf. `deserialize_contexts`),
+        or `None` if there is none.
+        """
+        # (str, {str: {"type": str, ...}}) -> ((Context, ContextStack) or None)
+        data = self.load(conversation_id)
+        if data is None:
+            return None
+        return deserialize_contexts(data, slots_descriptions)
+    def save_contexts(self, conversation_id, context, interrupted_contexts=None):
+        """
+        Stores the context `context` of the conversation `conversation_id`
+        with the stack of its interrupted contexts `interrupted_contexts`
+        (as `DialogManager.get_serialized_context` does).
+        """
+        # (str, Context, ContextStack) -> ()
+        self.save(conversation_id,
+                  serialize_context(context, interrupted_contexts))
+
+
+class MemorySessionStore(SessionStore):
+    """Store that keeps the serialized contexts in memory (not persistent)."""
+    def __init__(self):
+        self._sessions = dict()
+        self._lock = threading.Lock()
+
+    def load(self, conversation_id):
+        with self._lock:
+            return self._sessions.get(conversation_id)
+    def save(self, conversation_id, data):
+        with self._lock:
+            self._sessions[conversation_id] = data
+    def delete(self, conversation_id):
+        with self._lock:
+            self._sessions.pop(conversation_id, None)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Store backed by an SQLite database file.
+    Saved contexts are kept in memory and written in batches (in a single
+    transaction) when a context is saved or deleted while `batch_size` of
+    them are waiting or at least `flush_interval` seconds passed since the
+    last batch was written, hence saving a context usually doesn't touch the
+    disk. There is no timer: contexts saved after the last batch are only
+    written on the next save or delete, or by `flush` or `close`.
+    Loads see the contexts that are waiting to be written.
+    Contexts waiting to be written are lost if the process crashes.
+    """
+    def __init__(self, filepath=None, batch_size=None, flush_interval=None):
+        # (str, int, float) -> ()
+        if filepath is None:
+            filepath = cfg.SESSIONS_DB_FILEPATH
+        if batch_size is None:
+            batch_size = cfg.SESSIONS_WRITE_BATCH_SIZE
+        if flush_interval is None:
+            flush_interval = cfg.SESSIONS_FLUSH_INTERVAL
+        if batch_size <= 0:
+            raise ValueError("Tried to create a session store with an "+
+                             "invalid batch size ("+str(batch_size)+").")
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.RLock()
+        self._pending_writes = dict()  # conversation ID -> serialized context (`None` to delete it)
+        self._last_flush_time = time.time()
+        self._connection = sqlite3.connect(filepath, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS sessions ("+
+                                 "conversation_id TEXT PRIMARY KEY, "+
+                                 "context BLOB NOT NULL, "+
+                                 "updated_at REAL NOT NULL)")
+        self._connection.commit()
+
+    def load(self, conversation_id):
+        with self._lock:
+            if conversation_id in self._pending_writes:
+                return self._pending_writes[conversation_id]
+            row = self._connection.execute("SELECT context FROM sessions "+
+                                           "WHERE conversation_id = ?",
+                                           (conversation_id,)).fetchone()
+        if row is None:
+            return None
+        return bytes(row[0])
+
+    def save(self, conversation_id, data):
+        with self._lock:
+            self._pending_writes[conversation_id] = data
+            self._flush_if_needed()
+    def delete(self, conversation_id):
+        with self._lock:
+            self._pending_writes[conversation_id] = None
+            self._flush_if_needed()
+
+    def flush(self):
+        """Writes all the pending contexts in a single transaction."""
+        with self._lock:
+            self._last_flush_time = time.time()
+            if len(self._pending_writes) <= 0:
+                return
+            now = time.time()
+            updated = [(conversation_id, sqlite3.Binary(data), now)
+                       for (conversation_id, data) in self._pending_writes.items()
+                       if data is not None]
+            deleted = [(conversation_id,)
+                       for (conversation_id, data) in self._pending_writes.items()
+                       if data is None]
+            with self._connection:  # single transaction
+                if len(updated) > 0:
+                    self._connection.executemany("INSERT OR REPLACE INTO "+
+                                                 "sessions VALUES (?, ?, ?)",
+                                                 updated)
+                if len(deleted) > 0:
+                    self._connection.executemany("DELETE FROM sessions "+
+                                                 "WHERE conversation_id = ?",
+                                                 deleted)
+            self._pending_writes = dict()
+
+    def close(self):
+        with self._lock:
+            self.flush()
+            self._connection.close()
+
+    def _flush_if_needed(self):
+        if (   len(self._pending_writes) >= self.batch_size
+            or time.time() - self._last_flush_time >= self.flush_interval):
+            self.flush()
+
+
+def measure_store_overhead(store, context, nb_turns=1000,
+                           interrupted_contexts=None):
+    """
+    Saves and loads the context `context` (with the stack of interrupted
+    contexts `interrupted_contexts`) `nb_turns` times in the store `store`
+    (as would be done at each turn of a conversation) and returns
+    the mean time taken by a save ("save") and by a load ("load"),
+    in microseconds. Serialization is included.
+    """
+    # (SessionStore, Context, int, ContextStack) -> ({str: float})
+    conversation_ids = ["overhead-"+str(i) for i in range(nb_turns)]
+    start_time = time.time()
+    for conversation_id in conversation_ids:
+        store.save_contexts(conversation_id, context, interrupted_contexts)
+    save_time = time.time() - start_time
+    start_time = time.time()
+    for conversation_id in conversation_ids:
+        store.load_contexts(conversation_id)
+    load_time = time.time() - start_time
+    for conversation_id in conversation_ids:
+        store.delete(conversation_id)
+    store.flush()
+    return {"save": 1e6*save_time/nb_turns, "load": 1e6*load_time/nb_turns}
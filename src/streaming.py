@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the streaming of the answer of the bot: instead of giving
+the whole list of actions to the frontend and letting it run them, the
+actions are run one after the other and an event is yielded as soon as each
+of them finishes, so that the user sees the first messages without waiting
+for the slow lookups that come after them.
+The events are dicts with a "type":
+    - "typing": a (fetching) action started running, the frontend can display
+      a typing indicator;
+    - "message": a message to display to the user (in "text").
+Both contain the name of the action they come from in "action".
+"""
+
+from .actions.Action import ActionUtter, BotErrorMessage
+
+
+TYPING_EVENT_TYPE = "typing"
+MESSAGE_EVENT_TYPE = "message"
+
+
+def make_typing_event(action_name):
+    # (str) -> ({str: str})
+    return {"type": TYPING_EVENT_TYPE, "action": action_name}
+def make_message_event(text, action_name):
+    # (str, str) -> ({str: str})
+    return {"type": MESSAGE_EVENT_TYPE, "text": text, "action": action_name}
+
+
+def stream_actions(actions):
+    """
+    Runs the actions `actions` in order and yields the events they produce
+    (cf. above). The information fetched by an action is used to generate
+    the messages of the utterances that directly follow it (an error is
+    only displayed once).
+    """
+    # ([Action]) -> (generator of {str: str})
+    fetched_info = dict()
+    for action in actions:
+        if isinstance(action, ActionUtter):
+            yield make_message_event(action.generate_msg(fetched_info),
+                                     action.name)
+            if isinstance(fetched_info, BotErrorMessage):
+                fetched_info = dict()
+        else:
+            yield make_typing_event(action.name)
+            fetched_info = action.execute()
+
+def render_actions(actions):
+    """Runs the actions `actions` and returns the list of messages to display."""
+    # ([Action]) -> ([str])
+    return [event["text"] for event in stream_actions(actions)
+            if event["type"] == MESSAGE_EVENT_TYPE]
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the registry of the tenants' configurations.
+A tenant (i.e. a client) has its own slots descriptions, slot values synonyms
+and utterance templates, while the goals and intents descriptions are shared
+by all tenants (cf. `config.py`).
+The configuration of a tenant is only loaded the first time it is needed and
+tenants that were not used for a long time are unloaded when the registry
+exceeds its budgets.
+"""
+
+import os
+import threading
+
+from . import config as cfg
+from .caching import LRUCache, estimate_size
+
+
+class TenantConfig(object):
+    """
+    The configuration of a single tenant. Client-specific data is loaded from
+    the tenant's folder (cf. `cfg.TENANTS_DIR_PATH`) when the files exist and
+    falls back to the default (shared) data otherwise.
+    A `TenantConfig` with `tenant_id` `None` uses the default data only.
+    """
+    def __init__(self, tenant_id=None):
+        # (str) -> ()
+        self.tenant_id = tenant_id
+        self.nb_bytes = 0  # Estimated size of the data that belongs to this tenant only
+        self.slots_descriptions = \
+            self._load_part(cfg.TENANT_SLOTS_DESCRIPTIONS_FILENAME,
+                            cfg.parse_slots_descriptions,
+                            cfg.get_slots_descriptions)
+        self.slots_synonyms = \
+            self._load_part(cfg.TENANT_SLOTS_SYNONYMS_FILENAME,
+                            cfg.parse_slot_values_synonyms,
+                            cfg.get_slots_values_synonyms)
+        self.utterances_templates = \
+            self._load_part(cfg.TENANT_UTTERANCES_TEMPLATES_FILENAME,
+                            cfg.parse_utterances_templates,
+                            cfg.get_utterances_templates)
+
+    # Shared parts
+    @property
+    def goals_descriptions(self):
+        return cfg.get_goals_descriptions()
+    @property
+    def intents_descriptions(self):
+        return cfg.get_intents_descriptions()
+
+    def _load_part(self, filename, parse, get_default):
+        """
+        Returns the data parsed by `parse` from the tenant's file named
+        `filename` if it exists and the default data (`get_default()`)
+        otherwise.
+        """
+        if self.tenant_id is not None:
+            filepath = os.path.join(cfg.TENANTS_DIR_PATH, self.tenant_id,
+                                    filename)
+            if os.path.isfile(filepath):
+                data = parse(filepath)
+                self.nb_bytes += estimate_size(data)
+                return data
+        return get_default()
+
+    def __str__(self):
+        return "<TenantConfig: "+str(self.tenant_id)+">"
+
+
+class TenantConfigRegistry(object):
+    """
+    Gives access to the configurations of all the tenants, loading them on
+    first use. When more than `max_tenants` tenants are loaded or when their
+    data exceeds `max_bytes` bytes, the least recently used tenants are
+    unloaded (they will be loaded again if they are needed later on).
+    """
+    def __init__(self, max_tenants=None, max_bytes=None):
+        # (int, int) -> ()
+        if max_tenants is None:
+            max_tenants = cfg.MAX_LOADED_TENANTS
+        if max_bytes is None:
+            max_bytes = cfg.TENANTS_MEMORY_BUDGET
+        self._tenants = LRUCache(max_entries=max_tenants, max_bytes=max_bytes,
+                                 size_of=lambda tenant: tenant.nb_bytes)
+        self._loading_lock = threading.Lock()
+        self._default_config = None
+
+    def get(self, tenant_id=None):
+        """
+        Returns the configuration of the tenant `tenant_id`, loading it if
+        needed. If `tenant_id` is `None`, the default configuration is returned.
+        Raises a `KeyError` if the tenant doesn't exist.
+        """
+        # (str) -> (TenantConfig)
+        if tenant_id is None:
+            if self._default_config is None:
+                self._default_config = TenantConfig()
+            return self._default_config
+        tenant_config = self._tenants.get(tenant_id)
+        if tenant_config is None:
+            with self._loading_lock:  # Prevents loading the same tenant twice
+                tenant_config = self._tenants.get(tenant_id)
+                if tenant_config is None:
+                    if not os.path.isdir(os.path.join(cfg.TENANTS_DIR_PATH,
+                                                      tenant_id)):
+                        raise KeyError("Tried to get the configuration of an "+
+                                       "inexistant tenant ('"+tenant_id+"').")
+                    tenant_config = TenantConfig(tenant_id)
+                    self._tenants.put(tenant_id, tenant_config)
+        return tenant_config
+
+    def unload(self, tenant_id):
+        """Unloads the configuration of tenant `tenant_id` if it was loaded."""
+        self._tenants.pop(tenant_id)
+
+    def get_loaded_tenants(self):
+        """Returns the IDs of the loaded tenants, least recently used first."""
+        # () -> ([str])
+        return self._tenants.keys()
+
+    @property
+    def nb_bytes(self):
+        """Estimated size of the data of all the loaded tenants."""
+        return self._tenants.nb_bytes
+    @property
+    def metrics(self):
+        return self._tenants.metrics
+
+
+TENANTS_REGISTRY = None
+
+def get_tenants_registry():
+    """Creates the tenants registry if needed and returns it."""
+    # () -> (TenantConfigRegistry)
+    global TENANTS_REGISTRY
+    if TENANTS_REGISTRY is None:
+        TENANTS_REGISTRY = TenantConfigRegistry()
+    return TENANTS_REGISTRY
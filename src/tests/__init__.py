@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the bot.
+From the project the bot is part of (where the package `bot`, the modules
+`utils` and `Phi` and the configuration the bot loads are available):
+    python -m unittest discover -s bot/tests -t .
+From this repository (the directory `src` is then imported as the package
+`bot`, and the tests that need the project the bot is part of are skipped):
+    python -m unittest discover -s src/tests -t src
+"""
+
+import os
+import sys
+import unittest
+
+
+def _import_bot_package():
+    """
+    Imports the package this directory is in as `bot` if it isn't available
+    under this name (i.e. when the tests are run from the repository).
+    """
+    try:
+        import bot
+        return
+    except ImportError:
+        pass
+    package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    import importlib.util
+    spec = importlib.util.spec_from_file_location(
+        "bot", os.path.join(package_dir, "__init__.py"),
+        submodule_search_locations=[package_dir]
+    )
+    package = importlib.util.module_from_spec(spec)
+    sys.modules["bot"] = package
+    spec.loader.exec_module(package)
+
+_import_bot_package()
+
+
+def require_host_project():
+    """
+    Raises a `unittest.SkipTest` if the modules and the configuration the
+    project the bot is part of provides are not available (to be called
+    before importing the modules of the bot that need them).
+    """
+    try:
+        import bot.config as cfg
+    except ImportError as e:
+        raise unittest.SkipTest("The project the bot is part of is needed "+
+                                "("+str(e)+").")
+    if not os.path.isfile(cfg.GOALS_DESCRIPTIONS_FILEPATH):
+        raise unittest.SkipTest("The configuration of the bot is needed ("+
+                                cfg.GOALS_DESCRIPTIONS_FILEPATH+" is missing).")
+
+
+def make_message(intent_name, entities=(), confidence=0.95):
+    """Returns the NLU payload of a message (cf. `NLUMessage.from_json`)."""
+    # (str, [(str, str)], float) -> ({str: anything})
+    return {"intent": {"name": intent_name, "confidence": confidence},
+            "entities": [{"entity": slot_name, "value": value,
+                          "confidence": confidence}
+                         for (slot_name, value) in entities],
+            "intent_ranking": [{"name": intent_name,
+                                "confidence": confidence}],
+            "text": ""}
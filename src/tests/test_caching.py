@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the generic caching facilities (cf. `caching.py`).
+"""
+
+import sys
+import time
+import threading
+import unittest
+from collections import deque
+
+from bot.caching import LRUCache, SingleFlight, estimate_size
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.0
+    def __call__(self):
+        return self.now
+
+
+class TestLRUCache(unittest.TestCase):
+    def test_evicts_least_recently_used_entries(self):
+        evicted = []
+        cache = LRUCache(max_entries=2,
+                         on_evict=lambda key, value: evicted.append(key))
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)  # "b" is now the least recently used
+        cache.put("c", 3)
+        self.assertEqual(evicted, ["b"])
+        self.assertEqual(cache.keys(), ["a", "c"])
+        self.assertEqual(cache.metrics.evictions, 1)
+
+    def test_respects_memory_budget(self):
+        cache = LRUCache(max_bytes=10, size_of=lambda value: value)
+        cache.put("a", 4)
+        cache.put("b", 4)
+        cache.put("c", 4)
+        self.assertEqual(cache.keys(), ["b", "c"])
+        self.assertEqual(cache.nb_bytes, 8)
+        cache.put("d", 20)  # too big, but the last entry is always kept
+        self.assertEqual(cache.keys(), ["d"])
+
+    def test_expires_entries(self):
+        clock = FakeClock()
+        expired = []
+        cache = LRUCache(ttl=10, clock=clock,
+                         on_expire=lambda key, value: expired.append(key))
+        cache.put("a", 1)
+        clock.now = 5
+        cache.put("b", 2)
+        clock.now = 12
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        clock.now = 20
+        self.assertEqual(cache.expire(), 1)
+        self.assertEqual(expired, ["a", "b"])
+        self.assertEqual(len(cache), 0)
+
+    def test_get_or_compute_only_computes_missing_values(self):
+        cache = LRUCache(max_entries=4)
+        computed = []
+        def compute():
+            computed.append(1)
+            return "value"
+        self.assertEqual(cache.get_or_compute("key", compute), "value")
+        self.assertEqual(cache.get_or_compute("key", compute), "value")
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(cache.metrics.hits, 1)
+        self.assertEqual(cache.metrics.misses, 1)
+
+
+class TestEstimateSize(unittest.TestCase):
+    def test_counts_the_items_of_deques(self):
+        items = ["x"*1000, "y"*1000]
+        self.assertGreaterEqual(estimate_size(deque(items)),
+                                sys.getsizeof(deque())+2000)
+
+    def test_skips_seen_objects(self):
+        shared = "x"*1000
+        seen = set()
+        estimate_size(shared, seen)
+        self.assertLess(estimate_size([shared], seen), 1000)
+
+
+class TestSingleFlight(unittest.TestCase):
+    def _do_concurrently(self, single_flight, compute, nb_threads=4):
+        """
+        Calls `single_flight.do` with the same key from `nb_threads` threads
+        and returns what each of them got (result or exception).
+        """
+        outcomes = []
+        lock = threading.Lock()
+        def call():
+            try:
+                outcome = single_flight.do("key", compute)
+            except Exception as e:
+                outcome = e
+            with lock:
+                outcomes.append(outcome)
+        threads = [threading.Thread(target=call) for _ in range(nb_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_coalesces_concurrent_calls(self):
+        single_flight = SingleFlight()
+        def compute():
+            time.sleep(0.2)
+            return "result"
+        outcomes = self._do_concurrently(single_flight, compute)
+        self.assertEqual(outcomes, ["result"]*4)
+        self.assertEqual(single_flight.nb_executed, 1)
+        self.assertEqual(single_flight.nb_coalesced, 3)
+
+    def test_each_waiter_gets_its_own_exception(self):
+        single_flight = SingleFlight()
+        def compute():
+            time.sleep(0.2)
+            raise KeyError("missing")
+        outcomes = self._do_concurrently(single_flight, compute)
+        self.assertEqual(single_flight.nb_executed, 1)
+        for outcome in outcomes:
+            self.assertIsInstance(outcome, KeyError)
+            self.assertEqual(outcome.args, ("missing",))
+        self.assertEqual(len(set(id(outcome) for outcome in outcomes)), 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
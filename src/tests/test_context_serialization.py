@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the serialization of the contexts (cf. `context_serialization.py`).
+"""
+
+import marshal
+import unittest
+
+from . import require_host_project, make_message
+require_host_project()
+
+from bot.DialogManager import DialogManager
+from bot.context_serialization import serialize_context, \
+                                      deserialize_contexts, \
+                                      deserialize_context
+
+
+def make_interrupted_dialog_manager():
+    """
+    Returns a dialog manager whose goal (with slots filled) interrupted
+    another one.
+    """
+    # () -> (DialogManager)
+    dialog_manager = DialogManager()
+    dialog_manager.manage_user_msg(make_message("query_machine_planning",
+                                                [("production_line",
+                                                  "LAL_SKP")]))
+    dialog_manager.manage_user_msg(make_message("confirm"))
+    dialog_manager.manage_user_msg(make_message("query_filter_orders_time",
+                                                [("filter_time", "late")]))
+    dialog_manager.manage_user_msg(make_message("confirm"))
+    return dialog_manager
+
+def get_states(dialog_manager):
+    """Returns the states of the context and of the interrupted ones."""
+    states = [dialog_manager.context.get_state()]
+    for interrupted_context in dialog_manager.interrupted_contexts or ():
+        states.append(interrupted_context.get_state())
+    return states
+
+
+class TestContextSerialization(unittest.TestCase):
+    def test_round_trip_keeps_interrupted_contexts(self):
+        dialog_manager = make_interrupted_dialog_manager()
+        self.assertIsNotNone(dialog_manager.interrupted_contexts)
+        data = dialog_manager.get_serialized_context()
+
+        restored = DialogManager()
+        restored.set_serialized_context(data)
+        self.assertEqual(get_states(restored), get_states(dialog_manager))
+        self.assertEqual(restored.get_serialized_context(), data)
+
+    def test_deserialize_context_drops_interrupted_contexts(self):
+        dialog_manager = make_interrupted_dialog_manager()
+        (context, interrupted_contexts) = \
+            deserialize_contexts(dialog_manager.get_serialized_context())
+        self.assertEqual(context.get_state(),
+                         dialog_manager.context.get_state())
+        self.assertIsNotNone(interrupted_contexts)
+        context = deserialize_context(serialize_context(dialog_manager.context))
+        self.assertEqual(context.get_state(),
+                         dialog_manager.context.get_state())
+
+    def test_reads_first_version_of_the_format(self):
+        dialog_manager = make_interrupted_dialog_manager()
+        state = dialog_manager.context.get_state()
+        data = b"DLGC\x01"+marshal.dumps(state, 2)
+        (context, interrupted_contexts) = deserialize_contexts(data)
+        self.assertEqual(context.get_state(), state)
+        self.assertIsNone(interrupted_contexts)
+
+    def test_rejects_invalid_data(self):
+        data = DialogManager().get_serialized_context()
+        for invalid_data in (b"", b"nope", b"DLGC\x09"+data[5:],
+                             data[:5]+b"\x00"):
+            with self.assertRaises(ValueError):
+                deserialize_contexts(invalid_data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the interruption and resumption of goals (cf. `DialogManager.switch_goal`).
+"""
+
+import unittest
+
+from . import require_host_project, make_message
+require_host_project()
+
+from bot.DialogManager import DialogManager
+
+
+class TestGoalInterruption(unittest.TestCase):
+    def setUp(self):
+        self.dialog_manager = DialogManager()
+
+    def handle(self, intent_name, entities=()):
+        actions = self.dialog_manager.manage_user_msg(make_message(intent_name,
+                                                                   entities))
+        return [action.name for action in actions]
+
+    def test_resumed_goal_has_no_pending_new_goal(self):
+        self.handle("query_machine_planning",
+                    [("production_line", "LAL_SKP")])
+        self.handle("confirm")
+        self.handle("query_filter_orders_time", [("filter_time", "late")])
+        self.handle("confirm")
+        self.assertEqual(self.dialog_manager.context.current_goal.name,
+                         "filter_orders_time")
+
+        self.handle("inform_filter_time", [("filter_time", "late")])
+        context = self.dialog_manager.context
+        self.assertEqual(context.current_goal.name, "describe_machine_planning")
+        self.assertEqual(context.get_slot_value("production_line"), "LAL_SKP")
+        self.assertIsNone(context.potential_new_goal)
+        self.assertIsNone(context.entity_pending_for_confirmation)
+        self.assertIsNone(self.dialog_manager.interrupted_contexts)
+
+        action_names = self.handle("deny")
+        self.assertNotIn("ask-confirm-intent", action_names)
+        self.assertEqual(self.dialog_manager.context.current_goal.name,
+                         "describe_machine_planning")
+
+
+if __name__ == "__main__":
+    unittest.main()
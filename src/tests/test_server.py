@@ -0,0 +1,364 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the HTTP/WebSocket server (cf. `server.py`), made against local
+clients of a server listening on a free port.
+"""
+
+import os
+import json
+import base64
+import struct
+import asyncio
+import hashlib
+import unittest
+
+from . import require_host_project, make_message
+require_host_project()
+
+import bot.config as cfg
+from bot.server import DialogServer
+from bot.streaming import make_message_event, MESSAGE_EVENT_TYPE
+from bot.worker_pool import ShardedWorkerPool, REPLY_EVENT, REPLY_DONE
+
+
+TEST_TIMEOUT = 30  # seconds
+
+
+class HeldPool(object):
+    """
+    Stands for a worker pool in front of the server: the messages it is
+    given are only answered when the test releases them (cf. `release`).
+    """
+    def __init__(self):
+        self.submissions = []  # (conversation ID, NLU message, listener)
+
+    def submit(self, conversation_id, intent_and_entities, tenant_id=None,
+               listener=None):
+        self.submissions.append((conversation_id, intent_and_entities,
+                                 listener))
+
+    def release(self, index, text):
+        """Answers the `index`th message with a message event `text`."""
+        listener = self.submissions[index][2]
+        listener(REPLY_EVENT, make_message_event(text, "utter-test"))
+        listener(REPLY_DONE, None)
+
+    async def wait_for_submissions(self, nb_submissions):
+        while len(self.submissions) < nb_submissions:
+            await asyncio.sleep(0.01)
+
+
+#============ Clients ==============
+async def send_http_request(writer, method, path, body=None, headers=None,
+                            version="HTTP/1.1"):
+    if body is None:
+        body = b""
+    elif not isinstance(body, bytes):
+        body = json.dumps(body).encode("utf-8")
+    request = method+" "+path+" "+version+"\r\nHost: localhost\r\n"
+    for (name, value) in (headers or dict()).items():
+        request += name+": "+value+"\r\n"
+    request += "Content-Length: "+str(len(body))+"\r\n\r\n"
+    writer.write(request.encode("latin-1")+body)
+    await writer.drain()
+
+async def read_http_response(reader):
+    """Returns the status, the headers (lowercase) and the JSON content."""
+    status_line = await reader.readline()
+    status = int(status_line.split(b" ")[1])
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        (name, _, value) = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers["content-length"]))
+    return (status, headers, json.loads(body.decode("utf-8")))
+
+async def http_request(port, method, path, body=None):
+    """Makes a request on a new connection and returns the response."""
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        await send_http_request(writer, method, path, body,
+                                {"Connection": "close"})
+        return await read_http_response(reader)
+    finally:
+        writer.close()
+
+def encode_client_frame(opcode, payload, is_final=True, masked=True):
+    header = bytearray([(0x80 if is_final else 0) | opcode])
+    mask_bit = 0x80 if masked else 0
+    length = len(payload)
+    if length < 126:
+        header.append(mask_bit | length)
+    else:
+        header.append(mask_bit | 126)
+        header += struct.pack("!H", length)
+    if not masked:
+        return bytes(header)+payload
+    mask = os.urandom(4)
+    return bytes(header)+mask+bytes(byte ^ mask[i % 4]
+                                    for (i, byte) in enumerate(payload))
+
+async def read_server_frame(reader):
+    """Returns the opcode and payload of a frame sent by the server."""
+    (first_byte, second_byte) = await reader.readexactly(2)
+    length = second_byte & 0x7f
+    if length == 126:
+        length = struct.unpack("!H", await reader.readexactly(2))[0]
+    elif length == 127:
+        length = struct.unpack("!Q", await reader.readexactly(8))[0]
+    return (first_byte & 0x0f, await reader.readexactly(length))
+
+async def open_websocket(port, conversation_id):
+    """Returns the reader and writer of a WebSocket once opened."""
+    (reader, writer) = await asyncio.open_connection("127.0.0.1", port)
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    await send_http_request(writer, "GET",
+                            "/conversations/"+conversation_id+"/websocket",
+                            headers={"Upgrade": "websocket",
+                                     "Connection": "Upgrade",
+                                     "Sec-WebSocket-Key": key,
+                                     "Sec-WebSocket-Version": "13"})
+    response = await reader.readuntil(b"\r\n\r\n")
+    expected_accept = base64.b64encode(hashlib.sha1(
+        (key+"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").encode("ascii")
+    ).digest())
+    assert response.startswith(b"HTTP/1.1 101 "), response
+    assert b"Sec-WebSocket-Accept: "+expected_accept+b"\r\n" in response, \
+           response
+    return (reader, writer)
+
+async def read_events_until_message(reader):
+    """Reads the events of a WebSocket until a message, and returns it."""
+    while True:
+        (opcode, payload) = await read_server_frame(reader)
+        assert opcode == 0x1, opcode
+        event = json.loads(payload.decode("utf-8"))
+        if event["type"] != "typing":
+            return event
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs each test (a coroutine) in an event loop of its own."""
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_test(self, coroutine):
+        self.loop.run_until_complete(asyncio.wait_for(coroutine, TEST_TIMEOUT))
+
+
+class TestServerWithWorkers(ServerTestCase):
+    """Tests against a server that has a (small) pool of workers."""
+    @classmethod
+    def setUpClass(cls):
+        cls.pool = ShardedWorkerPool(1, warm_up_actions=False)
+        cls.pool.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def setUp(self):
+        super(TestServerWithWorkers, self).setUp()
+        self.server = DialogServer("127.0.0.1", 0, pool=self.pool)
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.server.shutdown())
+        super(TestServerWithWorkers, self).tearDown()
+
+    def test_keeps_http_connections_alive(self):
+        async def test():
+            (reader, writer) = await asyncio.open_connection("127.0.0.1",
+                                                             self.server.port)
+            for message in (make_message("query_machine_planning",
+                                         [("production_line", "LAL_SKP")]),
+                            make_message("confirm")):
+                await send_http_request(writer, "POST",
+                                        "/conversations/keep-alive/messages",
+                                        message)
+                (status, headers, content) = await read_http_response(reader)
+                self.assertEqual(status, 200)
+                self.assertEqual(headers["connection"], "keep-alive")
+                self.assertIn(MESSAGE_EVENT_TYPE,
+                              [event["type"] for event in content["events"]])
+            # Errors don't close the connection either
+            await send_http_request(writer, "POST",
+                                    "/conversations/keep-alive/messages",
+                                    b"{not json")
+            self.assertEqual((await read_http_response(reader))[0], 400)
+            await send_http_request(writer, "GET", "/nowhere")
+            self.assertEqual((await read_http_response(reader))[0], 404)
+            await send_http_request(writer, "GET", "/health")
+            (status, _, health) = await read_http_response(reader)
+            self.assertEqual(status, 200)
+            self.assertEqual(health["connections"], 1)
+            self.assertEqual(health["requests"], 2)
+            writer.close()
+        self.run_test(test())
+
+    def test_closes_connections_not_kept_alive(self):
+        async def test():
+            (reader, writer) = await asyncio.open_connection("127.0.0.1",
+                                                             self.server.port)
+            await send_http_request(writer, "GET", "/health",
+                                    version="HTTP/1.0")
+            (status, headers, _) = await read_http_response(reader)
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["connection"], "close")
+            self.assertEqual(await reader.read(), b"")
+            writer.close()
+        self.run_test(test())
+
+    def test_websocket(self):
+        async def test():
+            (reader, writer) = await open_websocket(self.server.port,
+                                                    "websocket")
+            message = json.dumps(make_message("confirm")).encode("utf-8")
+            writer.write(encode_client_frame(0x1, message))
+            event = await read_events_until_message(reader)
+            self.assertEqual(event["type"], MESSAGE_EVENT_TYPE)
+
+            # Fragmented message
+            writer.write(encode_client_frame(0x1, message[:10], is_final=False))
+            writer.write(encode_client_frame(0x0, message[10:]))
+            event = await read_events_until_message(reader)
+            self.assertEqual(event["type"], MESSAGE_EVENT_TYPE)
+
+            writer.write(encode_client_frame(0x9, b"ping"))
+            self.assertEqual(await read_server_frame(reader), (0xA, b"ping"))
+
+            writer.write(encode_client_frame(0x1, b"{not json"))
+            event = await read_events_until_message(reader)
+            self.assertEqual((event["type"], event["status"]), ("error", 400))
+
+            writer.write(encode_client_frame(0x8, struct.pack("!H", 1000)))
+            self.assertEqual(await read_server_frame(reader),
+                             (0x8, struct.pack("!H", 1000)))
+            writer.close()
+        self.run_test(test())
+
+    def test_websocket_rejects_unmasked_frames(self):
+        async def test():
+            (reader, writer) = await open_websocket(self.server.port,
+                                                    "unmasked")
+            writer.write(encode_client_frame(0x1, b"{}", masked=False))
+            self.assertEqual(await read_server_frame(reader),
+                             (0x8, struct.pack("!H", 1002)))
+            writer.close()
+        self.run_test(test())
+
+    def test_rejects_invalid_websocket_handshake(self):
+        async def test():
+            (status, _, _) = await http_request(self.server.port, "GET",
+                                                "/conversations/x/websocket")
+            self.assertEqual(status, 400)
+        self.run_test(test())
+
+
+class TestServerFlowControl(ServerTestCase):
+    """Tests against a server whose replies are held by the test."""
+    def setUp(self):
+        super(TestServerFlowControl, self).setUp()
+        self.previous_limits = (cfg.MAX_PENDING_REQUESTS,
+                                cfg.MAX_PENDING_REQUESTS_PER_SESSION)
+        cfg.MAX_PENDING_REQUESTS = 2
+        cfg.MAX_PENDING_REQUESTS_PER_SESSION = 1
+        self.pool = HeldPool()
+        self.server = DialogServer("127.0.0.1", 0, pool=self.pool)
+        self.loop.run_until_complete(self.server.start())
+
+    def tearDown(self):
+        if not self.server._closing:
+            self.loop.run_until_complete(self.server.shutdown())
+        (cfg.MAX_PENDING_REQUESTS, cfg.MAX_PENDING_REQUESTS_PER_SESSION) = \
+            self.previous_limits
+        super(TestServerFlowControl, self).tearDown()
+
+    def post(self, conversation_id):
+        """Returns a task that posts a message in the conversation."""
+        return asyncio.ensure_future(
+            http_request(self.server.port, "POST",
+                         "/conversations/"+conversation_id+"/messages",
+                         make_message("confirm"))
+        )
+
+    def test_rejects_messages_beyond_the_limits(self):
+        async def test():
+            first = self.post("a")
+            await self.pool.wait_for_submissions(1)
+            (status, _, _) = await self.post("a")  # limit of the conversation
+            self.assertEqual(status, 429)
+            other = self.post("b")
+            await self.pool.wait_for_submissions(2)
+            (status, _, _) = await self.post("c")  # limit of the server
+            self.assertEqual(status, 429)
+
+            self.pool.release(0, "first")
+            self.pool.release(1, "other")
+            (status, _, content) = await first
+            self.assertEqual((status, content["events"][0]["text"]),
+                             (200, "first"))
+            self.assertEqual((await other)[0], 200)
+            again = self.post("a")  # accepted again
+            await self.pool.wait_for_submissions(3)
+            self.pool.release(2, "again")
+            self.assertEqual((await again)[0], 200)
+            self.assertEqual(self.server.get_health()["rejected"], 2)
+        self.run_test(test())
+
+    def test_handles_messages_of_a_conversation_in_order(self):
+        async def test():
+            (reader, writer) = await open_websocket(self.server.port,
+                                                    "ordered")
+            for text in ("1", "2", "3"):
+                message = make_message("confirm")
+                message["text"] = text
+                writer.write(encode_client_frame(
+                    0x1, json.dumps(message).encode("utf-8")
+                ))
+            for (index, text) in enumerate(("1", "2", "3")):
+                await self.pool.wait_for_submissions(index+1)
+                await asyncio.sleep(0.05)
+                # The next message is only submitted once this one is answered
+                self.assertEqual(len(self.pool.submissions), index+1)
+                self.assertEqual(self.pool.submissions[index][1].text, text)
+                self.pool.release(index, "reply "+text)
+                event = await read_events_until_message(reader)
+                self.assertEqual(event["text"], "reply "+text)
+            writer.close()
+        self.run_test(test())
+
+    def test_shuts_down_gracefully(self):
+        async def test():
+            pending = self.post("a")
+            await self.pool.wait_for_submissions(1)
+            (idle_reader, idle_writer) = \
+                await asyncio.open_connection("127.0.0.1", self.server.port)
+            await asyncio.sleep(0.05)
+
+            shutdown = asyncio.ensure_future(self.server.shutdown())
+            self.assertEqual(await idle_reader.read(), b"")  # idle connections are closed
+            idle_writer.close()
+            self.assertFalse(shutdown.done())  # waits for the pending message
+            self.pool.release(0, "last words")
+            (status, headers, content) = await pending
+            self.assertEqual((status, headers["connection"]), (200, "close"))
+            self.assertEqual(content["events"][0]["text"], "last words")
+            await shutdown
+            with self.assertRaises(OSError):
+                await asyncio.open_connection("127.0.0.1", self.server.port)
+        self.run_test(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
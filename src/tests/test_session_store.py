@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the stores of serialized contexts (cf. `session_store.py`).
+"""
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from . import require_host_project
+require_host_project()
+
+from bot.session_store import SQLiteSessionStore, MemorySessionStore
+from .test_context_serialization import make_interrupted_dialog_manager, \
+                                        get_states
+
+
+class TestSQLiteSessionStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "sessions.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def count_written(self):
+        """Returns the number of contexts written in the database."""
+        connection = sqlite3.connect(self.filepath)
+        try:
+            return connection.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        finally:
+            connection.close()
+
+    def test_round_trip_across_reopening(self):
+        store = SQLiteSessionStore(self.filepath, batch_size=64,
+                                   flush_interval=3600)
+        store.save("a", b"context a")
+        store.save("b", b"context b")
+        store.delete("b")
+        store.close()
+
+        store = SQLiteSessionStore(self.filepath)
+        self.assertEqual(store.load("a"), b"context a")
+        self.assertIsNone(store.load("b"))
+        self.assertIsNone(store.load("c"))
+        store.close()
+
+    def test_writes_in_batches(self):
+        store = SQLiteSessionStore(self.filepath, batch_size=3,
+                                   flush_interval=3600)
+        store.save("a", b"1")
+        store.save("b", b"2")
+        self.assertEqual(self.count_written(), 0)
+        self.assertEqual(store.load("a"), b"1")  # pending writes are visible
+        store.save("c", b"3")
+        self.assertEqual(self.count_written(), 3)
+        store.save("a", b"4")
+        store.flush()
+        self.assertEqual(store.load("a"), b"4")
+        store.close()
+
+    def test_round_trip_of_contexts_with_interrupted_ones(self):
+        dialog_manager = make_interrupted_dialog_manager()
+        store = SQLiteSessionStore(self.filepath)
+        store.save_contexts("conversation", dialog_manager.context,
+                            dialog_manager.interrupted_contexts)
+        store.close()
+
+        store = SQLiteSessionStore(self.filepath)
+        (context, interrupted_contexts) = store.load_contexts("conversation")
+        self.assertIsNone(store.load_contexts("other conversation"))
+        store.close()
+        states = [context.get_state()]
+        states += [interrupted_context.get_state()
+                   for interrupted_context in interrupted_contexts]
+        self.assertEqual(states, get_states(dialog_manager))
+
+    def test_rejects_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            SQLiteSessionStore(self.filepath, batch_size=0)
+
+
+class TestMemorySessionStore(unittest.TestCase):
+    def test_round_trip(self):
+        dialog_manager = make_interrupted_dialog_manager()
+        store = MemorySessionStore()
+        store.save("conversation", dialog_manager.get_serialized_context())
+        self.assertEqual(store.load("conversation"),
+                         dialog_manager.get_serialized_context())
+        store.delete("conversation")
+        self.assertIsNone(store.load("conversation"))
+
+
+if __name__ == "__main__":
+    unittest.main()
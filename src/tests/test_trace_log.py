@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests of the trace log of the conversations (cf. `trace_log.py`).
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from . import require_host_project, make_message
+require_host_project()
+
+from bot.DialogManager import DialogManager
+from bot.trace_log import TraceLogWriter, TracesCollector, read_trace_log, \
+                          replay_traces
+
+
+MESSAGES = [make_message("query_machine_planning",
+                         [("production_line", "LAL_SKP")]),
+            make_message("confirm"),
+            make_message("query_filter_orders_time", [("filter_time", "late")])]
+
+
+class TestTraceLog(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.directory, "traces.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record_conversation(self, conversation_id):
+        """Handles `MESSAGES` in a conversation traced in `self.filepath`."""
+        writer = TraceLogWriter(self.filepath)
+        dialog_manager = DialogManager()
+        dialog_manager.conversation_id = conversation_id
+        dialog_manager.trace_log = writer
+        for message in MESSAGES:
+            dialog_manager.manage_user_msg(message)
+        writer.close()
+
+    def test_round_trip(self):
+        self.record_conversation("a")
+        traces = list(read_trace_log(self.filepath))
+        self.assertEqual(len(traces), len(MESSAGES))
+        self.assertEqual([trace.message.intent.name for trace in traces],
+                         [message["intent"]["name"] for message in MESSAGES])
+        self.assertIsNotNone(traces[0].initial_context)
+        self.assertIsNone(traces[1].initial_context)
+        self.assertTrue(all(trace.conversation_id == "a" and
+                            trace.tenant_id is None for trace in traces))
+
+    def test_recovers_from_truncated_last_trace(self):
+        self.record_conversation("a")
+        with open(self.filepath, "rb") as log_file:
+            data = log_file.read()
+        with open(self.filepath, "wb") as log_file:
+            log_file.write(data[:-5])  # as if the process crashed while writing
+        self.assertEqual(len(list(read_trace_log(self.filepath))),
+                         len(MESSAGES)-1)
+
+        self.record_conversation("b")  # cuts the truncated trace off first
+        traces = list(read_trace_log(self.filepath))
+        self.assertEqual([trace.conversation_id for trace in traces],
+                         ["a"]*(len(MESSAGES)-1) + ["b"]*len(MESSAGES))
+
+    def test_skips_corrupted_traces(self):
+        self.record_conversation("a")
+        with open(self.filepath, "ab") as log_file:
+            log_file.write(b"\x03\x00\x00\x00abc")
+        self.assertEqual(len(list(read_trace_log(self.filepath))),
+                         len(MESSAGES))
+
+    def test_rejects_other_files(self):
+        with open(self.filepath, "wb") as log_file:
+            log_file.write(b"not a trace log")
+        with self.assertRaises(ValueError):
+            TraceLogWriter(self.filepath)
+        with self.assertRaises(ValueError):
+            list(read_trace_log(self.filepath))
+
+    def test_flush_after_close_returns(self):
+        writer = TraceLogWriter(self.filepath)
+        writer.close()
+        writer.flush()
+        writer.close()
+
+    def test_replay_uses_recorded_tenant(self):
+        collector = TracesCollector()
+        dialog_manager = DialogManager()
+        dialog_manager.conversation_id = "a"
+        dialog_manager.trace_log = collector
+        for message in MESSAGES:
+            dialog_manager.manage_user_msg(message)
+        for trace in collector.traces:
+            trace.tenant_id = "some-tenant"
+
+        tenants_ids = []
+        def make_dialog_manager(tenant_id):
+            tenants_ids.append(tenant_id)
+            return DialogManager()
+        report = replay_traces(collector.traces, make_dialog_manager)
+        self.assertEqual(tenants_ids, ["some-tenant"])
+        self.assertEqual(report["nb-turns"], len(MESSAGES))
+        self.assertEqual(report["nb-mismatches"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
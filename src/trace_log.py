@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains the trace log of the conversations: when a dialog manager
+has a trace log (cf. `DialogManager.trace_log`), each turn it handles is
+recorded (cf. `TurnTrace`) with the message of the NLU, the entities once
+corrected, the final confidence, the transition of the policy that was taken,
+the actions, the changes of the context and the time each stage took.
+Traces are handed to a `TraceLogWriter`, which serializes them and appends
+them to a file in batches from its own thread, so that recording a turn only
+costs putting the trace in a queue.
+A trace log is made of a magic header and a format version (one byte),
+followed by the traces, each of them being its length (4 bytes) and the trace
+serialized with `marshal` (cf. `TurnTrace.to_record`). The file is only
+appended to; a truncated last trace (if the process crashed while writing it)
+is ignored when reading the log and cut off before appending to it again.
+The traces can be replayed against the current code to compare the decisions
+and latencies to the recorded ones (cf. `replay_traces`).
+
+Usage:
+    python -m bot.trace_log replay traces.log
+"""
+
+import os
+import sys
+import time
+import struct
+import marshal
+import argparse
+import threading
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from . import config as cfg
+from .nlu_message import NLUMessage, Intent, Entity
+from .dialog_management_components import get_stack_depth
+
+
+TRACE_LOG_MAGIC = b"DLGT"
+TRACE_LOG_FORMAT_VERSION = 2
+_MARSHAL_VERSION = 2  # supported by all Python versions the bot runs on
+_HEADER = TRACE_LOG_MAGIC + struct.pack("B", TRACE_LOG_FORMAT_VERSION)
+_LENGTH_FORMAT = "<I"
+_LENGTH_SIZE = struct.calcsize(_LENGTH_FORMAT)
+
+# Stages of a turn that are timed (cf. `TurnTrace.end_stage`)
+TURN_STAGES = ("entities-checking", "decision", "context-update", "total")
+# Transition recorded for the messages that restart the conversation
+RESTART_BRANCH = ("restart",)
+# Names of the parts of the state of a context (cf. `Context.get_state`)
+CONTEXT_STATE_PARTS = ("goal", "potential-new-goal", "slots",
+                       "expected-replies", "counts", "pending-entity")
+CONFIDENCE_TOLERANCE = 1e-6
+
+
+class TurnTrace(object):
+    """
+    What happened during a turn of the conversation `conversation_id` (held
+    with the tenant `tenant_id`, `None` for the default configuration),
+    which started at `start_time` with the message `message` (as the NLU
+    gave it). `initial_context` is the serialized context (cf.
+    `DialogManager.get_serialized_context`) before the turn, only set for the
+    first traced turn of a dialog manager so that the conversation can be
+    replayed from there.
+    """
+    __slots__ = ("conversation_id", "tenant_id", "start_time", "message",
+                 "corrected_entities", "final_confidence", "branch",
+                 "action_names", "context_before", "context_after",
+                 "_context_diff", "timings", "initial_context",
+                 "_last_stage_time")
+
+    def __init__(self, conversation_id, message, start_time=None,
+                 tenant_id=None):
+        # (str, NLUMessage, float, str) -> ()
+        if start_time is None:
+            start_time = time.time()
+        self.conversation_id = conversation_id
+        self.tenant_id = tenant_id
+        self.start_time = start_time
+        self.message = message
+        self.corrected_entities = []
+        self.final_confidence = None
+        self.branch = None  # key of the transition of the policy
+        self.action_names = []
+        self.context_before = None  # (state, number of interrupted contexts)
+        self.context_after = None
+        self._context_diff = None
+        self.timings = dict()  # stage -> seconds
+        self.initial_context = None
+        self._last_stage_time = start_time
+
+    def end_stage(self, stage):
+        """Records the time spent since the end of the previous stage."""
+        # (str) -> ()
+        now = time.time()
+        self.timings[stage] = now - self._last_stage_time
+        self._last_stage_time = now
+    def end(self):
+        self.timings["total"] = time.time() - self.start_time
+
+    def get_context_diff(self):
+        """
+        Returns the parts of the state of the context that changed during the
+        turn (cf. `CONTEXT_STATE_PARTS`) with their new values. For the
+        slots, only the slots whose value changed are given (with `None` if
+        they were unset), and the number of interrupted contexts is given
+        as "interrupted-goals" if it changed.
+        """
+        # () -> ({str: anything})
+        if self._context_diff is None and self.context_after is not None:
+            self._context_diff = get_context_diff(self.context_before,
+                                                  self.context_after)
+        return self._context_diff
+
+    def to_record(self):
+        """Returns `self` as a tuple only made of builtin types."""
+        # () -> (tuple)
+        final_confidence = self.final_confidence
+        if final_confidence is not None:
+            final_confidence = float(final_confidence)  # might be a numpy float
+        return (self.conversation_id, self.start_time,
+                _pack_message(self.message),
+                tuple(_pack_entity(entity)
+                      for entity in self.corrected_entities),
+                final_confidence, self.branch, tuple(self.action_names),
+                self.get_context_diff(),
+                tuple(int(1e6*self.timings.get(stage, 0.0))
+                      for stage in TURN_STAGES),
+                self.initial_context, self.tenant_id)
+    @staticmethod
+    def from_record(record):
+        """Returns the trace represented by `record` (cf. `to_record`)."""
+        # (tuple) -> (TurnTrace)
+        (conversation_id, start_time, message_record, entities_records,
+         final_confidence, branch, action_names, context_diff,
+         timings_record, initial_context, tenant_id) = record
+        trace = TurnTrace(conversation_id, _unpack_message(message_record),
+                          start_time, tenant_id)
+        trace.corrected_entities = [_unpack_entity(entity_record)
+                                    for entity_record in entities_records]
+        trace.final_confidence = final_confidence
+        trace.branch = branch
+        trace.action_names = list(action_names)
+        trace._context_diff = context_diff
+        trace.timings = {stage: microseconds/1e6
+                         for (stage, microseconds) in zip(TURN_STAGES,
+                                                          timings_record)}
+        trace.initial_context = initial_context
+        return trace
+
+    def __str__(self):
+        return "<TurnTrace "+str(self.conversation_id)+" "+ \
+               str(self.message.intent)+" -> "+str(self.branch)+" "+ \
+               str(self.action_names)+">"
+
+
+def get_context_state(dialog_manager):
+    """Returns what is traced of the context of `dialog_manager`."""
+    # (DialogManager) -> ((tuple, int))
+    return (dialog_manager.context.get_state(),
+            get_stack_depth(dialog_manager.interrupted_contexts))
+
+def get_context_diff(context_before, context_after):
+    """
+    Returns the changes from `context_before` to `context_after` (cf.
+    `get_context_state` and `TurnTrace.get_context_diff`).
+    """
+    # ((tuple, int), (tuple, int)) -> ({str: anything})
+    ((state_before, depth_before), (state_after, depth_after)) = \
+        (context_before, context_after)
+    diff = dict()
+    for (part, value_before, value_after) in zip(CONTEXT_STATE_PARTS,
+                                                 state_before, state_after):
+        if value_before == value_after:
+            continue
+        if part == "slots":
+            slots_before = dict(value_before)
+            slots_after = dict(value_after)
+            value_after = tuple((slot_name, slots_after.get(slot_name))
+                                for slot_name in sorted(set(slots_before) |
+                                                        set(slots_after))
+                                if slots_before.get(slot_name) !=
+                                   slots_after.get(slot_name))
+        diff[part] = value_after
+    if depth_before != depth_after:
+        diff["interrupted-goals"] = depth_after
+    return diff
+
+
+def _pack_entity(entity):
+    return (entity.entity, entity.value, entity.confidence, entity.start,
+            entity.end, entity.extractor)
+def _unpack_entity(entity_record):
+    return Entity(*entity_record)
+
+def _pack_message(message):
+    return (message.intent.name, message.intent.confidence,
+            tuple((intent.name, intent.confidence)
+                  for intent in message.intent_ranking),
+            tuple(_pack_entity(entity) for entity in message.entities),
+            message.text)
+def _unpack_message(message_record):
+    (intent_name, confidence, ranking, entities_records, text) = \
+        message_record
+    return NLUMessage(Intent(intent_name, confidence),
+                      [_unpack_entity(entity_record)
+                       for entity_record in entities_records],
+                      [Intent(name, ranked_confidence)
+                       for (name, ranked_confidence) in ranking],
+                      text)
+
+
+def encode_trace(trace):
+    """Returns the trace `trace` as it is written in a trace log."""
+    # (TurnTrace) -> (bytes)
+    data = marshal.dumps(trace.to_record(), _MARSHAL_VERSION)
+    return struct.pack(_LENGTH_FORMAT, len(data)) + data
+
+
+class TraceLogWriter(object):
+    """
+    Appends the traces it is given (cf. `record`) to the trace log
+    `filepath`. The traces are serialized and written by a thread of
+    `self`, in batches of at most `batch_size` traces, at most
+    `flush_interval` seconds after they were recorded. If `max_pending`
+    traces are already waiting to be written, the traces are dropped
+    (counted in `nb_dropped`) rather than slowing the turns down.
+    """
+    def __init__(self, filepath, batch_size=None, flush_interval=None,
+                 max_pending=None):
+        # (str, int, float, int) -> ()
+        if batch_size is None:
+            batch_size = cfg.TRACE_LOG_BATCH_SIZE
+        if flush_interval is None:
+            flush_interval = cfg.TRACE_LOG_FLUSH_INTERVAL
+        if max_pending is None:
+            max_pending = cfg.TRACE_LOG_MAX_PENDING
+        if batch_size <= 0:
+            raise ValueError("Tried to create a trace log writer with an "+
+                             "invalid batch size ("+str(batch_size)+").")
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.nb_written = 0
+        self.nb_dropped = 0
+
+        self._file = open(filepath, "ab")
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() == 0:
+            self._file.write(_HEADER)
+            self._file.flush()
+        else:
+            with open(filepath, "rb") as log_file:
+                header = log_file.read(len(_HEADER))
+                end = _find_end_of_complete_traces(log_file)
+            if header != _HEADER:
+                self._file.close()
+                raise ValueError("Tried to append traces to a file that is "+
+                                 "not a trace log of this version ("+
+                                 filepath+").")
+            self._file.truncate(end)  # drops a trace truncated by a crash
+        self._queue = queue.Queue(max_pending)
+        self._thread = threading.Thread(target=self._write_loop,
+                                        name="trace-log-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def record(self, trace):
+        """Queues the trace `trace` to be written (never blocks)."""
+        # (TurnTrace) -> ()
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.nb_dropped += 1
+
+    def flush(self):
+        """Waits until all the traces recorded until now are written."""
+        if self._thread is None:  # closed: everything was written
+            return
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        """Writes the pending traces and stops the writing thread."""
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+        self._file.close()
+
+    def _write_loop(self):
+        closing = False
+        while not closing:
+            batch = []
+            flush_requests = []
+            item = self._queue.get()  # waits for the first trace of the batch
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is None:
+                    closing = True
+                    break
+                if not isinstance(item, TurnTrace):
+                    flush_requests.append(item)
+                    break
+                try:
+                    batch.append(encode_trace(item))
+                except ValueError:  # a value that can't be serialized
+                    self.nb_dropped += 1
+                if len(batch) >= self.batch_size:
+                    break
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if len(batch) > 0:
+                self._file.write(b"".join(batch))
+                self._file.flush()
+                self.nb_written += len(batch)
+            for flushed in flush_requests:
+                flushed.set()
+
+
+def make_worker_trace_log(filepath):
+    """
+    Returns a writer to a trace log of its own for the current process
+    (`filepath` suffixed with the process ID), as several processes can't
+    append to the same log.
+    """
+    # (str) -> (TraceLogWriter)
+    return TraceLogWriter(filepath+"."+str(os.getpid()))
+
+
+def _find_end_of_complete_traces(log_file):
+    """
+    Returns the position in the trace log `log_file` (positioned after the
+    header) of the end of its last complete trace.
+    """
+    # (file) -> (int)
+    end = log_file.tell()
+    while True:
+        length_data = log_file.read(_LENGTH_SIZE)
+        if len(length_data) < _LENGTH_SIZE:
+            return end
+        length = struct.unpack(_LENGTH_FORMAT, length_data)[0]
+        if len(log_file.read(length)) < length:
+            return end
+        end = log_file.tell()
+
+
+def read_trace_log(filepath):
+    """
+    Yields the traces of the trace log `filepath` in the order they were
+    written, skipping the traces that can't be deserialized.
+    Raises a `ValueError` if it is not a trace log of this version.
+    """
+    # (str) -> (generator of TurnTrace)
+    with open(filepath, "rb") as log_file:
+        if log_file.read(len(_HEADER)) != _HEADER:
+            raise ValueError("Tried to read a file that is not a trace log "+
+                             "of this version ("+filepath+").")
+        while True:
+            length_data = log_file.read(_LENGTH_SIZE)
+            if len(length_data) < _LENGTH_SIZE:
+                return
+            length = struct.unpack(_LENGTH_FORMAT, length_data)[0]
+            data = log_file.read(length)
+            if len(data) < length:  # truncated by a crash
+                return
+            try:
+                trace = TurnTrace.from_record(marshal.loads(data))
+            except (EOFError, ValueError, TypeError):  # corrupted
+                continue
+            yield trace
+
+
+#============= Replay =============
+class TracesCollector(object):
+    """A trace log that keeps the traces in memory (e.g. for the replays)."""
+    def __init__(self):
+        self.traces = []
+    def record(self, trace):
+        # (TurnTrace) -> ()
+        self.traces.append(trace)
+
+
+def replay_traces(traces, make_dialog_manager=None):
+    """
+    Handles the messages of the traces `traces` again, with a dialog manager
+    made by `make_dialog_manager(tenant_id)` (defaults to `DialogManager`)
+    for each conversation, with the tenant recorded in its traces, and returns a report that compares the new decisions and
+    timings to the recorded ones:
+        - "nb-turns": the number of replayed turns;
+        - "nb-mismatches" and "mismatches": the turns whose transition,
+          final confidence or actions changed (as dicts with the
+          "conversation-id", "message", "recorded" and "replayed" decisions);
+        - "recorded-timings" and "replayed-timings": the mean time (in
+          microseconds) each stage took (cf. `TURN_STAGES`).
+    A conversation is replayed from the context recorded in its first trace
+    (or in later ones, if its dialog manager was evicted and restored).
+    """
+    # (iterable of TurnTrace, (str) -> (DialogManager)) -> ({str: anything})
+    if make_dialog_manager is None:
+        from .DialogManager import DialogManager
+        make_dialog_manager = DialogManager
+    collector = TracesCollector()
+    dialog_managers = dict()  # conversation ID -> DialogManager
+    nb_turns = 0
+    mismatches = []
+    recorded_timings = {stage: 0.0 for stage in TURN_STAGES}
+    replayed_timings = {stage: 0.0 for stage in TURN_STAGES}
+    for trace in traces:
+        dialog_manager = dialog_managers.get(trace.conversation_id)
+        if dialog_manager is None:
+            dialog_manager = make_dialog_manager(trace.tenant_id)
+            dialog_manager.conversation_id = trace.conversation_id
+            dialog_manager.trace_log = collector
+            dialog_managers[trace.conversation_id] = dialog_manager
+        if trace.initial_context is not None:
+            dialog_manager.set_serialized_context(trace.initial_context)
+        message = trace.message
+        dialog_manager.manage_user_msg(NLUMessage(message.intent,
+                                                  list(message.entities),
+                                                  message.intent_ranking,
+                                                  message.text))
+        replayed_trace = collector.traces.pop()
+        nb_turns += 1
+        for stage in TURN_STAGES:
+            recorded_timings[stage] += 1e6*trace.timings.get(stage, 0.0)
+            replayed_timings[stage] += 1e6*replayed_trace.timings.get(stage, 0.0)
+        if not _are_same_decisions(trace, replayed_trace):
+            mismatches.append({"conversation-id": trace.conversation_id,
+                               "message": str(message),
+                               "recorded": _get_decision(trace),
+                               "replayed": _get_decision(replayed_trace)})
+    if nb_turns > 0:
+        for timings in (recorded_timings, replayed_timings):
+            for stage in TURN_STAGES:
+                timings[stage] /= nb_turns
+    return {"nb-turns": nb_turns, "nb-mismatches": len(mismatches),
+            "mismatches": mismatches, "recorded-timings": recorded_timings,
+            "replayed-timings": replayed_timings}
+
+def _get_decision(trace):
+    return {"branch": trace.branch, "confidence": trace.final_confidence,
+            "actions": trace.action_names}
+
+def _are_same_decisions(trace, other_trace):
+    if (   tuple(trace.branch or ()) != tuple(other_trace.branch or ())
+        or trace.action_names != other_trace.action_names):
+        return False
+    if trace.final_confidence is None or other_trace.final_confidence is None:
+        return trace.final_confidence is other_trace.final_confidence
+    return (abs(trace.final_confidence - other_trace.final_confidence)
+            <= CONFIDENCE_TOLERANCE)
+
+
+def print_replay_report(report, max_mismatches=10):
+    # ({str: anything}, int) -> ()
+    print("Replay report ("+str(report["nb-turns"])+" turns)")
+    print("  decisions that changed: "+str(report["nb-mismatches"]))
+    for mismatch in report["mismatches"][:max_mismatches]:
+        print("    "+str(mismatch["conversation-id"])+" "+mismatch["message"])
+        print("      recorded: "+str(mismatch["recorded"]))
+        print("      replayed: "+str(mismatch["replayed"]))
+    print("  mean time per stage (recorded -> replayed):")
+    for stage in TURN_STAGES:
+        recorded = report["recorded-timings"][stage]
+        replayed = report["replayed-timings"][stage]
+        change = ""
+        if recorded > 0:
+            change = "  ({:+.1f}%)".format(100*(replayed-recorded)/recorded)
+        print("    "+stage+": "+"{:.0f}".format(recorded)+" us -> "+
+              "{:.0f}".format(replayed)+" us"+change)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reads or replays trace "+
+                                     "logs of conversations.")
+    subparsers = parser.add_subparsers(dest="command")
+    dump_parser = subparsers.add_parser("dump", help="print the traces")
+    dump_parser.add_argument("logs", nargs='+')
+    replay_parser = subparsers.add_parser("replay", help="replay the traces "+
+                                          "and compare the decisions and "+
+                                          "latencies")
+    replay_parser.add_argument("logs", nargs='+',
+                               help="trace logs (the traces of a "+
+                                    "conversation must all be in one log)")
+    replay_parser.add_argument("--max-mismatches", type=int, default=10,
+                               help="number of changed decisions displayed")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        for filepath in args.logs:
+            for trace in read_trace_log(filepath):
+                print(str(trace)+" "+str(trace.get_context_diff())+" "+
+                      str(trace.timings))
+    elif args.command == "replay":
+        for filepath in args.logs:
+            report = replay_traces(read_trace_log(filepath))
+            print_replay_report(report, args.max_mismatches)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+This file contains a pool of worker processes that handle the messages of
+many conversations in parallel (a single process is limited by the GIL).
+Conversations are sharded by their ID: all the messages of a conversation
+are handled by the same worker, in the order they were submitted, and the
+worker keeps the dialog manager (thus the context) of the conversation
+in its memory (cf. `session_manager.py`), spilling idle or least recently used
+sessions to a session store if one is given.
+The configuration is loaded before the workers are forked, so that they all
+share it (copy-on-write) instead of each loading its own copy.
+
+Usage:
+    pool = ShardedWorkerPool(nb_workers=4)
+    pool.start()
+    events = pool.submit(conversation_id, intent_and_entities).get()
+    pool.close()
+"""
+
+import gc
+import zlib
+import threading
+import multiprocessing
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from . import config as cfg
+from . import streaming
+from .tenant_config import get_tenants_registry
+
+
+def preload_configuration(warm_up_actions=True):
+    """
+    Loads everything the workers need and that doesn't depend on the
+    conversations (descriptions, templates, default tenant and, if
+    `warm_up_actions` is `True`, custom action classes).
+    Objects that exist at this point are excluded from the garbage collector
+    (where possible) so that it doesn't write to the memory pages they are
+    in, which would copy those pages in each worker.
+    """
+    # (bool) -> ()
+    cfg.get_intents_descriptions()
+    cfg.get_slots_descriptions()
+    cfg.get_slots_values_synonyms()
+    cfg.get_goals_descriptions()
+    cfg.get_utterances_templates()
+    get_tenants_registry().get(None)
+    if warm_up_actions:
+        from .actions.ActionFactory import ActionFactory
+        ActionFactory(cfg.get_utterances_templates()).warm_up()
+    gc.collect()
+    if hasattr(gc, "freeze"):  # Python >= 3.7
+        gc.freeze()
+
+
+def get_shard(conversation_id, nb_shards):
+    """Returns the index of the shard the conversation `conversation_id` is in."""
+    # (str, int) -> (int)
+    if not isinstance(conversation_id, bytes):
+        conversation_id = conversation_id.encode("utf-8")
+    return (zlib.crc32(conversation_id) & 0xffffffff) % nb_shards
+
+
+class PendingReply(object):
+    """
+    The reply of the bot to a message submitted to the pool, whose events
+    (cf. `streaming.py`) arrive as the worker produces them.
+    If a `listener` is given, it is called (from the thread of the pool
+    collecting the events) with each kind of item (`REPLY_EVENT`,
+    `REPLY_ERROR` or `REPLY_DONE`) and its payload instead of queueing
+    them, e.g. to hand them over to an event loop.
+    """
+    def __init__(self, listener=None):
+        # ((str, anything) -> ()) -> ()
+        self._listener = listener
+        self._events = queue.Queue()
+
+    def iter_events(self, timeout=None):
+        """
+        Yields the events of the reply as they arrive. Raises a `RuntimeError`
+        if the worker failed to handle the message and `queue.Empty` if no event
+        arrived during `timeout` seconds.
+        """
+        # (float) -> (generator of {str: str})
+        if self._listener is not None:
+            raise RuntimeError("Tried to wait for the events of a reply that "+
+                               "are given to a listener.")
+        while True:
+            (kind, payload) = self._events.get(timeout=timeout)
+            if kind == REPLY_EVENT:
+                yield payload
+            elif kind == REPLY_ERROR:
+                raise RuntimeError("A worker failed to handle a message: "+
+                                   payload)
+            else:
+                return
+    def get(self, timeout=None):
+        """Waits for the whole reply and returns the list of its events."""
+        # (float) -> ([{str: str}])
+        return list(self.iter_events(timeout))
+
+    def _put(self, kind, payload):
+        if self._listener is not None:
+            self._listener(kind, payload)
+        else:
+            self._events.put((kind, payload))
+
+REPLY_EVENT = "event"  # payload: the event
+REPLY_ERROR = "error"  # payload: a description of the error
+REPLY_DONE = "done"
+
+
+class ShardedWorkerPool(object):
+    """
+    Pool of `nb_workers` worker processes (defaults to the number of CPUs)
+    between which the conversations are sharded (cf. above).
+    Each worker has its own queue of messages, and a single thread collects
+    the events of all the workers and dispatches them to the pending replies.
+    """
+    def __init__(self, nb_workers=None, warm_up_actions=True,
+                 session_store_factory=None, trace_log_factory=None):
+        # (int, bool, () -> (SessionStore), () -> (TraceLogWriter)) -> ()
+        if nb_workers is None:
+            nb_workers = cfg.NB_WORKERS
+        if nb_workers is None:
+            nb_workers = multiprocessing.cpu_count()
+        if nb_workers <= 0:
+            raise ValueError("Tried to create a pool with an invalid number "+
+                             "of workers ("+str(nb_workers)+").")
+        self.nb_workers = nb_workers
+        self.warm_up_actions = warm_up_actions
+        # Called in each worker (after the fork) to make its own session store
+        self.session_store_factory = session_store_factory
+        # Called in each worker to make the trace log of its turns (cf. `trace_log.py`)
+        self.trace_log_factory = trace_log_factory
+
+        if hasattr(multiprocessing, "get_context"):
+            self._mp = multiprocessing.get_context("fork")
+        else:  # Python 2 always forks
+            self._mp = multiprocessing
+        self._requests_queues = []
+        self._events_queue = None
+        self._workers = []
+        self._collector = None
+
+        self._lock = threading.Lock()
+        self._pending_replies = dict()  # request ID -> PendingReply
+        self._next_request_id = 0
+        self.nb_submitted_by_worker = [0]*nb_workers
+
+    def start(self):
+        """Loads the configuration and forks the workers."""
+        if len(self._workers) > 0:
+            raise RuntimeError("Tried to start a worker pool twice.")
+        preload_configuration(self.warm_up_actions)
+        self._events_queue = self._mp.Queue()
+        for worker_index in range(self.nb_workers):
+            requests_queue = self._mp.Queue()
+            worker = self._mp.Process(target=_work,
+                                      args=(requests_queue, self._events_queue,
+                                            self.session_store_factory,
+                                            self.trace_log_factory),
+                                      name="dialog-worker-"+str(worker_index))
+            worker.daemon = True
+            worker.start()
+            self._requests_queues.append(requests_queue)
+            self._workers.append(worker)
+        self._collector = threading.Thread(target=self._collect,
+                                           name="dialog-pool-collector")
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, conversation_id, intent_and_entities, tenant_id=None,
+               listener=None):
+        """
+        Sends the message `intent_and_entities` of the conversation
+        `conversation_id` (held with the tenant `tenant_id`) to the worker
+        handling this conversation and returns its pending reply (whose events
+        are given to `listener` if it is not `None`, cf. `PendingReply`).
+        """
+        # (str, {str: anything}, str, (str, anything) -> ()) -> (PendingReply)
+        if len(self._workers) <= 0:
+            raise RuntimeError("Tried to submit a message to a worker pool "+
+                               "that is not running.")
+        worker_index = get_shard(conversation_id, self.nb_workers)
+        reply = PendingReply(listener)
+        with self._lock:
+            request_id = self._next_request_id
+            self._next_request_id += 1
+            self._pending_replies[request_id] = reply
+            self.nb_submitted_by_worker[worker_index] += 1
+            # Put while holding the lock to keep the order of the submissions
+            self._requests_queues[worker_index].put((request_id, conversation_id,
+                                                     tenant_id,
+                                                     intent_and_entities))
+        return reply
+
+    def handle(self, conversation_id, intent_and_entities, tenant_id=None,
+               timeout=None):
+        """Same as `submit` but waits for the reply and returns its events."""
+        # (str, {str: anything}, str, float) -> ([{str: str}])
+        return self.submit(conversation_id, intent_and_entities,
+                           tenant_id).get(timeout)
+
+    def close(self):
+        """
+        Stops the workers once they handled the messages that were already
+        submitted.
+        """
+        for requests_queue in self._requests_queues:
+            requests_queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._collector is not None:
+            self._events_queue.put(None)
+            self._collector.join()
+        self._requests_queues = []
+        self._workers = []
+        self._collector = None
+
+    def _collect(self):
+        while True:
+            item = self._events_queue.get()
+            if item is None:
+                return
+            (request_id, kind, payload) = item
+            with self._lock:
+                reply = self._pending_replies.get(request_id)
+                if kind != REPLY_EVENT:
+                    self._pending_replies.pop(request_id, None)
+            if reply is not None:
+                reply._put(kind, payload)
+
+
+def _work(requests_queue, events_queue, session_store_factory=None,
+          trace_log_factory=None):
+    """Main loop of a worker process."""
+    from .session_manager import SessionManager
+    store = None
+    if session_store_factory is not None:
+        store = session_store_factory()
+    trace_log = None
+    if trace_log_factory is not None:
+        trace_log = trace_log_factory()
+    sessions = SessionManager(store, trace_log=trace_log)
+    while True:
+        request = requests_queue.get()
+        if request is None:
+            sessions.close()
+            if store is not None:
+                store.close()
+            if trace_log is not None:
+                trace_log.close()
+            return
+        (request_id, conversation_id, tenant_id, intent_and_entities) = request
+        try:
+            dialog_manager = sessions.get(conversation_id, tenant_id)
+            for event in dialog_manager.stream_user_msg(intent_and_entities):
+                events_queue.put((request_id, REPLY_EVENT, event))
+            sessions.put(conversation_id, dialog_manager)
+            events_queue.put((request_id, REPLY_DONE, None))
+        except Exception as e:
+            events_queue.put((request_id, REPLY_ERROR,
+                              type(e).__name__+": "+str(e)))